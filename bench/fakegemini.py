@@ -0,0 +1,181 @@
+import re
+import json
+import random
+import asyncio
+from time import sleep, monotonic
+from threading import Lock
+from collections import deque
+from google.api_core.exceptions import ResourceExhausted
+
+# canned replies, picked by a phrase of the system instructions every workflow step sends
+SALE_INFO = {"Vendor name": "Aero Parts Co", "Part No": "123-4567-01", "CC": "NE", "QTY": "2 EA", "Lead Time": "5 days", "Unit Price (USD)": "USD 1250.00", "description": "ACTUATOR", "Warranty": "6 months"}
+AUTHORIZATION_INFO = {"Tagged by": "Aero Parts Co", "Tag date": "12/03/2024", "Tag type(FAA/EASA)": "FAA", "Dual": "Yes"}
+NORMALIZED_INFO = {"vendor_name": "Aero Parts Co", "part_no": "123-4567-01", "cond": "NE", "qty": "2", "lead_time": "5 days", "price": "1250.00", "description": "ACTUATOR", "warranty": "6 months", "tagged_by": "Aero Parts Co", "tag_date": "2024-03-12", "tag_type": "FAA", "dual": "YES"}
+
+PART_LINE = re.compile(r'P/N:\s*(\S+)\s+CC:\s*(\S+)\s+QTY:\s*(\S+)\s+Price:\s*(\S+)')
+
+class FakeUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+class FakeResponse:
+    def __init__(self, text: str, usage_metadata: FakeUsage = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+class FakeModel:
+    # stands in for genai.GenerativeModel, replies are instant json with an optional simulated latency
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, requests_per_minute: int = 0, stream_chunks: int = 4, seed: int = 0, model_name: str = "fake-gemini"):
+        self.model_name = model_name
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute
+        self.stream_chunks = stream_chunks
+
+        self.calls = {}
+        self.rejected = 0
+        self.images = 0
+
+        self.__random = random.Random(seed)
+        self.__recent = deque()
+        self.__lock = Lock()
+
+    def __admit(self, kind: str, content: list):
+        # a sliding one minute window, like the free tier quota of the real api
+        with self.__lock:
+            now = monotonic()
+
+            while len(self.__recent) > 0 and now - self.__recent[0] > 60:
+                self.__recent.popleft()
+
+            if self.requests_per_minute > 0 and len(self.__recent) >= self.requests_per_minute:
+                self.rejected += 1
+                raise ResourceExhausted("fake quota exhausted")
+
+            self.__recent.append(now)
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.images += sum(1 for item in content if not isinstance(item, str))
+
+            return max(0.0, self.latency + self.__random.uniform(-self.jitter, self.jitter))
+
+    def __documentType(self):
+        with self.__lock:
+            return self.__random.choice(["Sale Quotation Form-1", "Sale Quotation Form-1", "Authorization Form-2", "Other-3"])
+
+    def classify(self, content: list):
+        instructions = content[0] if len(content) > 0 else ""
+
+        if "reading emails" in instructions:
+            return "step1"
+        if "giving type every document" in instructions:
+            return "step2"
+        if "sale quotation forms" in instructions:
+            return "step3-sale"
+        if "authorization forms" in instructions:
+            return "step3-auth"
+        if "merging json files" in instructions:
+            return "step4"
+        if "Every document that we give you" in instructions:
+            return "step23"
+        if "merging the part information" in instructions:
+            return "step45"
+        if "Normalize the json data" in instructions:
+            return "step5"
+
+        return "other"
+
+    def reply(self, kind: str, content: list):
+        prompt = content[1] if len(content) > 1 else ""
+
+        if kind == "step1":
+            parts = [{"Vendor name": "Aero Parts Co", "Part No": part_no, "CC": cond, "QTY": qty, "Unit Price (USD)": price} for part_no, cond, qty, price in PART_LINE.findall(prompt)]
+            return "\n".join(json.dumps(part) for part in parts) if parts else json.dumps(SALE_INFO)
+
+        if kind == "step2":
+            return json.dumps({"Type": self.__documentType()})
+
+        if kind == "step3-sale":
+            return "```json\n" + json.dumps(SALE_INFO) + "\n```"
+
+        if kind == "step3-auth":
+            return json.dumps(AUTHORIZATION_INFO)
+
+        if kind == "step4":
+            merged = {}
+
+            for info in re.findall(r'\{[^{}]*\}', prompt):
+                try:
+                    merged.update(json.loads(info))
+                except ValueError:
+                    continue
+
+            return json.dumps(merged)
+
+        if kind == "step23":
+            match = re.search(r'(\d+) documents are given', prompt)
+            count = int(match.group(1)) if match else 1
+            documents = []
+
+            for document in range(1, count+1):
+                document_type = self.__documentType()
+                info = SALE_INFO if document_type.endswith("1") else AUTHORIZATION_INFO if document_type.endswith("2") else None
+                documents.append({"document": document, "type": document_type, "info": info})
+
+            return json.dumps(documents)
+
+        if kind == "step45":
+            match = re.search(r'Parts: (\[.*?\]), Documents:', prompt)
+
+            try:
+                count = len(json.loads(match.group(1))) if match else 1
+            except ValueError:
+                count = 1
+
+            return json.dumps([NORMALIZED_INFO for _ in range(count)])
+
+        if kind == "step5":
+            return json.dumps(NORMALIZED_INFO)
+
+        return "{}"
+
+    def __response(self, kind: str, content: list):
+        text = self.reply(kind, content)
+        prompt_tokens = sum(len(item) // 4 + 1 if isinstance(item, str) else 258 for item in content)
+
+        return FakeResponse(text, FakeUsage(prompt_tokens, len(text) // 4 + 1))
+
+    def __chunks(self, text: str):
+        size = max(1, len(text) // max(1, self.stream_chunks) + 1)
+
+        return [FakeResponse(text[i:i+size]) for i in range(0, len(text), size)]
+
+    def generate_content(self, content, generation_config = None, stream: bool = False):
+        kind = self.classify(content)
+        delay = self.__admit(kind, content)
+
+        if not stream:
+            sleep(delay)
+            return self.__response(kind, content)
+
+        def generate():
+            chunks = self.__chunks(self.__response(kind, content).text)
+
+            for chunk in chunks:
+                sleep(delay / len(chunks))
+                yield chunk
+
+        return generate()
+
+    async def generate_content_async(self, content, generation_config = None):
+        kind = self.classify(content)
+        delay = self.__admit(kind, content)
+
+        await asyncio.sleep(delay)
+
+        return self.__response(kind, content)
+
+    def getCallCount(self):
+        with self.__lock:
+            return sum(self.calls.values())
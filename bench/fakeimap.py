@@ -0,0 +1,169 @@
+import re
+import email
+import threading
+import socketserver
+
+# uids start here so they never look like sequence numbers
+FIRST_UID = 1001
+
+def parseSequenceSet(sequence_set: str, largest: int):
+    numbers = set()
+
+    for item in sequence_set.split(","):
+        if ":" in item:
+            first, last = item.split(":")
+            first = largest if first == "*" else int(first)
+            last = largest if last == "*" else int(last)
+            numbers.update(range(min(first, last), max(first, last) + 1))
+        else:
+            numbers.add(largest if item == "*" else int(item))
+
+    return numbers
+
+def quote(value):
+    if value is None:
+        return "NIL"
+
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def envelope(message):
+    def addresses(header):
+        value = message.get(header)
+
+        if value is None:
+            return "NIL"
+
+        result = []
+
+        for name, address in email.utils.getaddresses([value]):
+            mailbox, _, host = address.partition("@")
+            result.append(f"({quote(name or None)} NIL {quote(mailbox)} {quote(host)})")
+
+        return "(" + "".join(result) + ")"
+
+    return f"({quote(message.get('Date'))} {quote(message.get('Subject'))} {addresses('From')} {addresses('From')} {addresses('From')} {addresses('To')} NIL NIL NIL {quote(message.get('Message-ID'))})"
+
+def bodyStructure(message):
+    if message.is_multipart():
+        return "(" + "".join(bodyStructure(part) for part in message.get_payload()) + f" {quote(message.get_content_subtype().upper())})"
+
+    payload = message.get_payload(decode=False) or ""
+    size = len(payload.encode() if isinstance(payload, str) else payload)
+
+    return f"({quote(message.get_content_maintype().upper())} {quote(message.get_content_subtype().upper())} NIL NIL NIL {quote(message.get('Content-Transfer-Encoding', '7BIT'))} {size} NIL NIL NIL)"
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data: bytes):
+        self.wfile.write(data)
+
+    def sendLine(self, line: str):
+        self.send(line.encode() + b"\r\n")
+
+    def fetchItems(self, sequence_number: int, items: str, with_uid: bool):
+        raw = self.server.messages[sequence_number - 1]
+        uid = FIRST_UID + sequence_number - 1
+        names = items.strip("()").upper().split()
+
+        response = f"* {sequence_number} FETCH (".encode()
+        parts = []
+
+        if with_uid or "UID" in names:
+            parts.append(f"UID {uid}".encode())
+
+        if "RFC822" in names or "BODY[]" in names:
+            parts.append(f"RFC822 {{{len(raw)}}}\r\n".encode() + raw)
+
+        if "ENVELOPE" in names or "BODYSTRUCTURE" in names:
+            message = email.message_from_bytes(raw)
+
+            if "BODYSTRUCTURE" in names:
+                parts.append(b"BODYSTRUCTURE " + bodyStructure(message).encode())
+
+            if "ENVELOPE" in names:
+                parts.append(b"ENVELOPE " + envelope(message).encode())
+
+        self.send(response + b" ".join(parts) + b")\r\n")
+
+    def handle(self):
+        self.sendLine("* OK fake IMAP4rev1 server ready")
+        messages = self.server.messages
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            with self.server.lock:
+                self.server.commands += 1
+
+            tag, _, rest = line.decode().rstrip("\r\n").partition(" ")
+            command, _, arguments = rest.partition(" ")
+            command = command.upper()
+
+            if command == "CAPABILITY":
+                self.sendLine("* CAPABILITY IMAP4rev1")
+            elif command in ("LOGIN", "NOOP", "CLOSE"):
+                pass
+            elif command == "LOGOUT":
+                self.sendLine("* BYE")
+                self.sendLine(f"{tag} OK LOGOUT completed")
+                return
+            elif command in ("SELECT", "EXAMINE"):
+                self.sendLine(f"* {len(messages)} EXISTS")
+                self.sendLine(f"* OK [UIDVALIDITY {self.server.uidvalidity}] UIDs valid")
+                self.sendLine(f"* OK [UIDNEXT {FIRST_UID + len(messages)}] next uid")
+            elif command == "STATUS":
+                mailbox = arguments.split(" ")[0]
+                self.sendLine(f"* STATUS {mailbox} (UIDVALIDITY {self.server.uidvalidity} UIDNEXT {FIRST_UID + len(messages)} MESSAGES {len(messages)})")
+            elif command == "SEARCH":
+                self.sendLine("* SEARCH " + " ".join(str(number) for number in range(1, len(messages) + 1)))
+            elif command == "FETCH":
+                sequence_set, _, items = arguments.partition(" ")
+
+                for sequence_number in sorted(parseSequenceSet(sequence_set, len(messages))):
+                    if 1 <= sequence_number <= len(messages):
+                        self.fetchItems(sequence_number, items, False)
+            elif command == "UID":
+                sub_command, _, sub_arguments = arguments.partition(" ")
+                sub_command = sub_command.upper()
+                largest_uid = FIRST_UID + len(messages) - 1
+
+                if sub_command == "SEARCH":
+                    match = re.search(r'UID (\S+)', sub_arguments, re.IGNORECASE)
+                    uids = parseSequenceSet(match.group(1), largest_uid) if match else range(FIRST_UID, largest_uid + 1)
+                    found = [uid for uid in sorted(uids) if FIRST_UID <= uid <= largest_uid]
+                    self.sendLine("* SEARCH " + " ".join(str(uid) for uid in found))
+                elif sub_command == "FETCH":
+                    uid_set, _, items = sub_arguments.partition(" ")
+
+                    for uid in sorted(parseSequenceSet(uid_set, largest_uid)):
+                        if FIRST_UID <= uid <= largest_uid:
+                            self.fetchItems(uid - FIRST_UID + 1, items, True)
+                else:
+                    self.sendLine(f"{tag} BAD unknown UID command")
+                    continue
+            else:
+                self.sendLine(f"{tag} BAD unknown command")
+                continue
+
+            self.sendLine(f"{tag} OK {command} completed")
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    # a plain text IMAP stand-in that serves a list of raw messages from memory
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: list, host: str = "127.0.0.1", port: int = 0, uidvalidity: int = 1):
+        super().__init__((host, port), FakeIMAPHandler)
+
+        self.messages = messages
+        self.uidvalidity = uidvalidity
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+        return self.server_address
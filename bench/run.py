@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import multiprocessing
+from time import sleep, perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cache
+import client
+import gemini
+import metrics
+import ocr
+import prefilter
+import synthetic
+from sinks import createSink
+from fakeimap import FakeIMAPServer
+from fakegemini import FakeModel
+
+# peak memory is read with getrusage, which windows does not have
+if sys.platform != "win32":
+    import resource
+else:
+    resource = None
+
+# canned OCR output, the keywords match the pre-filter page classifier
+FAKE_PAGE_TEXT = "SALE QUOTATION\nPart Number: 123-4567-01\nCondition: NE\nQty: 2 EA\nUnit Price: USD 1250.00\nLead Time: 5 days\n"
+
+class FakeOCRBackend:
+    name = "fake"
+
+    def __init__(self, language: str = "eng", tessdata_path: str = None, latency: float = 0.3):
+        self.latency = latency
+
+    def osd(self, image):
+        sleep(self.latency / 4)
+        return {"orientation": 0, "rotate": 0}
+
+    def text(self, image):
+        sleep(self.latency)
+        return FAKE_PAGE_TEXT
+
+def installFakeOCR(latency: float):
+    ocr.registerBackend("fake", lambda language, tessdata_path: FakeOCRBackend(language, tessdata_path, latency))
+    ocr.setBackend("fake")
+
+    # page pool processes only know the fake engine when they are forked from this one
+    if sys.platform != "win32":
+        multiprocessing.set_start_method("fork", force=True)
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Runs the email pipeline against a synthetic mailbox and a fake Gemini backend.")
+
+    parser.add_argument("--emails", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=3, help="pages per pdf attachment")
+    parser.add_argument("--pdfs", type=int, default=1, help="pdf attachments per email")
+    parser.add_argument("--images", type=int, default=1, help="image attachments per email")
+    parser.add_argument("--parts", type=int, default=1, help="parts listed in every email body")
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--mode", choices=["serial", "batch", "sync"], default="serial", help="fetchAndParse one by one, processRange or syncNew")
+    parser.add_argument("--workflow", choices=["per_step", "batched"], default="per_step")
+    parser.add_argument("--pages-per-call", type=int, default=4)
+    parser.add_argument("--local-normalization", action="store_true")
+    parser.add_argument("--no-llm-fallback", action="store_true")
+    parser.add_argument("--prefilter", action="store_true", help="text layer and keyword page classification")
+    parser.add_argument("--stream-pages", action="store_true")
+    parser.add_argument("--sink", default=None, help="result file, the extension picks the sink (.csv, .ndjson, .db, .parquet)")
+    parser.add_argument("--cache", default=None, help="cache folder, the cache is off without it")
+    parser.add_argument("--job-store", default=None, help="job store path, checkpoints are off without it")
+    parser.add_argument("--dedup", default=None, help="dedup index path, repeated pages and rows are processed again without it")
+
+    parser.add_argument("--fetch-workers", type=int, default=2)
+    parser.add_argument("--ocr-workers", type=int, default=4)
+    parser.add_argument("--gemini-workers", type=int, default=4)
+    parser.add_argument("--page-workers", type=int, default=0, help="processes of the page pool, 0 keeps OCR in process")
+    parser.add_argument("--queue-size", type=int, default=8)
+
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per fake Gemini call")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--rpm", type=int, default=0, help="fake requests per minute quota, 0 is unlimited")
+    parser.add_argument("--client-rpm", type=int, default=0, help="requests per minute the client's rate limiter admits, 0 is unlimited")
+    parser.add_argument("--exhausted-delay", type=float, default=5, help="longest wait of the client after a quota error")
+    parser.add_argument("--fake-ocr", action="store_true", help="replaces tesseract with a fixed text")
+    parser.add_argument("--ocr-engine", choices=["auto", "tesserocr", "pytesseract"], default="auto")
+    parser.add_argument("--ocr-latency", type=float, default=0.3)
+    parser.add_argument("--poppler-path", default=None, help="folder of the poppler binaries, PATH is used without it")
+    parser.add_argument("--tesseract-path", default=None)
+
+    parser.add_argument("--profile", action="store_true", help="saves a cProfile dump of every email in <output>/profiles")
+    parser.add_argument("--metrics-log", default=None, help="json-lines file for every timing span")
+
+    parser.add_argument("--output", default=None, help="output folder, a temporary one without it")
+    parser.add_argument("--json", action="store_true", help="prints the report as json")
+
+    return parser.parse_args()
+
+def main():
+    arguments = parseArguments()
+    output_folder = arguments.output or tempfile.mkdtemp(prefix="bench-")
+
+    print(f"Generating {arguments.emails} synthetic emails...")
+    messages = synthetic.makeMailbox(arguments.emails, pages_per_pdf=arguments.pages, pdfs=arguments.pdfs, images=arguments.images, parts=arguments.parts, seed=arguments.seed)
+
+    server = FakeIMAPServer(messages)
+    host, port = server.start()
+
+    model = FakeModel(arguments.latency, arguments.jitter, arguments.rpm, seed=arguments.seed)
+    # quota errors make the client wait, a short ceiling on the wait keeps the runs comparable
+    gemini.setClient(gemini.GeminiClient(model, requests_per_minute=arguments.client_rpm or 1000000000, max_delay=arguments.exhausted_delay))
+
+    if arguments.fake_ocr:
+        installFakeOCR(arguments.ocr_latency)
+    else:
+        ocr.setBackend(arguments.ocr_engine)
+
+        if arguments.tesseract_path:
+            client.setTesseractPath(arguments.tesseract_path)
+
+    # the client uses the poppler/bin folder of the windows setup unless it is told otherwise
+    client.setPopplerPath(arguments.poppler_path)
+
+    if arguments.profile:
+        metrics.enableProfiling(os.path.join(output_folder, "profiles"))
+
+    if arguments.metrics_log:
+        metrics.enableEventLog(arguments.metrics_log)
+
+    if arguments.cache:
+        cache.enableCache(arguments.cache)
+
+    client.setPageWorkers(arguments.page_workers)
+
+    email_client = client.EmailClient()
+    email_client.connectIMAP(host, port, use_ssl=False)
+    email_client.login("bench", "bench")
+    email_client.selectMailbox("INBOX")
+
+    email_client.setWorkflowMode(arguments.workflow, arguments.pages_per_call)
+    email_client.setLocalNormalization(arguments.local_normalization, not arguments.no_llm_fallback)
+    email_client.setPageStreaming(arguments.stream_pages)
+
+    if arguments.prefilter:
+        email_client.setPreFilter(prefilter.PreFilter())
+
+    if arguments.sink:
+        email_client.setResultSink(createSink(arguments.sink))
+
+    if arguments.job_store:
+        from jobstore import JobStore
+        email_client.setJobStore(JobStore(arguments.job_store))
+
+    if arguments.dedup:
+        from dedup import DedupIndex
+        email_client.setDedupIndex(DedupIndex(arguments.dedup))
+
+    start = perf_counter()
+
+    try:
+        if arguments.mode == "serial":
+            for mail_index in range(1, arguments.emails+1):
+                email_client.fetchAndParse(mail_index, output_folder, sleep_duration_after_finish=0)
+        elif arguments.mode == "batch":
+            email_client.processRange(1, arguments.emails, output_folder, arguments.fetch_workers, arguments.ocr_workers, arguments.gemini_workers, arguments.queue_size)
+        else:
+            email_client.syncNew(output_folder, os.path.join(output_folder, "sync_state.json"), ocr_workers=arguments.ocr_workers, gemini_workers=arguments.gemini_workers, queue_size=arguments.queue_size)
+    finally:
+        elapsed = perf_counter() - start
+
+        if email_client.result_sink is not None:
+            email_client.result_sink.close()
+
+        if email_client.dedup_index is not None:
+            email_client.dedup_index.close()
+
+        email_client.logoutAndClose()
+        client.setPageWorkers(0)
+        server.shutdown()
+
+        if arguments.metrics_log:
+            metrics.writeSummary(arguments.metrics_log)
+
+    report = {
+        "mode": arguments.mode,
+        "workflow": arguments.workflow,
+        "emails": arguments.emails,
+        "seconds": round(elapsed, 3),
+        "emails_per_minute": round(arguments.emails / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource is not None else None,
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1) if resource is not None else None,
+        "api_calls": model.getCallCount(),
+        "api_calls_by_kind": dict(model.calls),
+        "api_images": model.images,
+        "api_rejected": model.rejected,
+        "imap_commands": server.commands,
+        "stages": {}
+    }
+
+    summary = metrics.getSummary()
+    report["counters"] = summary["counters"]
+
+    if cache.getCache() is not None:
+        report["cache"] = cache.getCache().getStats()
+
+    for stage, stats in sorted(summary["spans"].items()):
+        report["stages"][stage] = {
+            "count": stats["count"],
+            "total": round(stats["total"], 3),
+            "p50": round(stats["p50"], 4),
+            "p90": round(stats["p90"], 4),
+            "p99": round(stats["p99"], 4)
+        }
+
+    if arguments.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"\n{report['emails']} emails in {report['seconds']}s - {report['emails_per_minute']} emails/min ({report['mode']}, {report['workflow']})")
+    print(f"Peak RSS: {report['peak_rss_mb']} MB, page pool: {report['peak_child_rss_mb']} MB")
+    print(f"API calls: {report['api_calls']} {report['api_calls_by_kind']}, images sent: {report['api_images']}, rejected by quota: {report['api_rejected']}")
+    print(f"IMAP commands: {report['imap_commands']}")
+    print(f"Counters: {report['counters']}")
+
+    if "cache" in report:
+        print(f"Cache: {report['cache']}")
+
+    print(f"\n{'stage':<16}{'count':>8}{'total s':>10}{'p50 s':>10}{'p90 s':>10}{'p99 s':>10}")
+
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<16}{stats['count']:>8}{stats['total']:>10}{stats['p50']:>10}{stats['p90']:>10}{stats['p99']:>10}")
+
+if __name__ == "__main__":
+    main()
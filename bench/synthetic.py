@@ -0,0 +1,139 @@
+import os
+import zlib
+import random
+import struct
+from email.message import EmailMessage
+
+VENDORS = ["Aero Parts Co", "Skyline Aviation Supply", "Jetstream Components", "Northwind Avionics", "Falcon Spares"]
+CONDITIONS = ["NE", "OH", "SV", "AR", "RP"]
+
+def makePdf(pages: list):
+    # a minimal pdf with one text page for every list of lines, no dependencies needed
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+
+    for lines in pages:
+        text = b"BT /F1 14 Tf 72 760 Td 18 TL"
+
+        for line in lines:
+            escaped = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            text += b" (" + escaped.encode('latin-1', errors='replace') + b") '"
+
+        text += b" ET"
+
+        objects.append(b"<< /Length " + str(len(text)).encode() + b" >>\nstream\n" + text + b"\nendstream")
+        content_id = len(objects)
+
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents " + str(content_id).encode() + b" 0 R >>")
+        page_ids.append(len(objects))
+
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(str(page_id).encode() + b" 0 R" for page_id in page_ids) + b"] /Count " + str(len(page_ids)).encode() + b" >>"
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += str(object_id).encode() + b" 0 obj\n" + body + b"\nendobj\n"
+
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 " + str(len(objects) + 1).encode() + b"\n0000000000 65535 f \n"
+
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode()
+
+    pdf += b"trailer\n<< /Size " + str(len(objects) + 1).encode() + b" /Root 1 0 R >>\nstartxref\n" + str(xref_offset).encode() + b"\n%%EOF\n"
+
+    return pdf
+
+def makePng(width: int = 800, height: int = 1000, seed: int = 0):
+    # a grayscale png with a few dark bars, enough to give the image pipeline real work
+    generator = random.Random(seed)
+    bars = [(generator.randrange(height), generator.randrange(4, 20)) for _ in range(20)]
+
+    rows = []
+
+    for y in range(height):
+        value = 0 if any(start <= y < start + size for start, size in bars) else 255
+        rows.append(b"\x00" + bytes([value]) * width)
+
+    def chunk(kind: bytes, data: bytes):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) + chunk(b"IEND", b"")
+
+def quotationPage(generator: random.Random, vendor: str, part_no: str):
+    return [
+        f"{vendor} - SALE QUOTATION",
+        f"Quotation No: Q{generator.randrange(10000, 99999)}",
+        "",
+        f"Part Number: {part_no}",
+        f"Description: {generator.choice(['ACTUATOR', 'VALVE ASSY', 'PUMP', 'STARTER GENERATOR', 'SENSOR'])}",
+        f"Condition: {generator.choice(CONDITIONS)}",
+        f"Qty: {generator.randrange(1, 10)} EA",
+        f"Unit Price: USD {generator.randrange(100, 90000)}.00",
+        f"Lead Time: {generator.randrange(1, 30)} days",
+        "Warranty: 6 months",
+        "Valid for 30 days"
+    ]
+
+def authorizationPage(generator: random.Random, part_no: str):
+    return [
+        "AUTHORIZED RELEASE CERTIFICATE",
+        "FAA FORM 8130-3, AIRWORTHINESS APPROVAL TAG",
+        f"Item: 1  Part Number: {part_no}",
+        f"Serial Number: SN{generator.randrange(100000, 999999)}",
+        "Block 12 Remarks: Other regulation specified in Block 12",
+        f"Date: {generator.randrange(1, 28):02d}/{generator.randrange(1, 12):02d}/2024"
+    ]
+
+def makeEmail(index: int, pages_per_pdf: int = 3, pdfs: int = 1, images: int = 1, parts: int = 1, seed: int = 0):
+    generator = random.Random(seed * 100003 + index)
+    vendor = generator.choice(VENDORS)
+    part_numbers = [f"{generator.randrange(100, 999)}-{generator.randrange(1000, 9999)}-{generator.randrange(1, 99):02d}" for _ in range(parts)]
+
+    message = EmailMessage()
+    message["Subject"] = f"RE: RFQ {part_numbers[0]}"
+    message["From"] = f"sales@{vendor.lower().replace(' ', '')}.com"
+    message["Return-Path"] = f"<sales@{vendor.lower().replace(' ', '')}.com>"
+    message["To"] = "purchasing@example.com"
+
+    body = ["Hello,", "", "Please find our quote below.", ""]
+
+    for part_no in part_numbers:
+        body.append(f"P/N: {part_no}  CC: {generator.choice(CONDITIONS)}  QTY: {generator.randrange(1, 10)}  Price: ${generator.randrange(100, 90000)}  Lead time: {generator.randrange(1, 30)} days")
+
+    body += ["", "Best regards,", vendor]
+    message.set_content("\n".join(body))
+
+    for pdf_index in range(pdfs):
+        pages = [quotationPage(generator, vendor, generator.choice(part_numbers)) for _ in range(pages_per_pdf - 1)]
+        pages.append(authorizationPage(generator, part_numbers[0]))
+
+        message.add_attachment(makePdf(pages), maintype="application", subtype="pdf", filename=f"quote-{index}-{pdf_index+1}.pdf")
+
+    for image_index in range(images):
+        message.add_attachment(makePng(seed=index * 31 + image_index), maintype="image", subtype="png", filename=f"scan-{index}-{image_index+1}.png")
+
+    return message.as_bytes()
+
+def makeMailbox(count: int, **options):
+    return [makeEmail(index, **options) for index in range(1, count+1)]
+
+def writeMailbox(folder: str, count: int, **options):
+    # saves the messages as .eml files, useful for looking at them by hand
+    os.makedirs(folder, exist_ok=True)
+
+    paths = []
+
+    for index, message in enumerate(makeMailbox(count, **options), start=1):
+        path = os.path.join(folder, f"email-{index}.eml")
+
+        with open(path, 'wb') as file:
+            file.write(message)
+
+        paths.append(path)
+
+    return paths
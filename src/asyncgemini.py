@@ -0,0 +1,125 @@
+import asyncio
+import random
+from google.api_core.exceptions import ResourceExhausted
+
+import cache
+import gemini
+import metrics
+
+# the buckets and the token estimate are shared with the thread client
+from gemini import TokenBucket, estimateTokens, maxOutputTokens
+
+class RateLimitScheduler:
+    # admits requests only while both the per-minute request and token quotas have room
+    def __init__(self, requests_per_minute: int = 15, tokens_per_minute: int = 1000000):
+        self.__requests = TokenBucket(requests_per_minute)
+        self.__tokens = TokenBucket(tokens_per_minute)
+        self.__lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int):
+        # the lock makes waiting requests go through in arrival order
+        async with self.__lock:
+            while True:
+                wait = max(self.__requests.waitTime(1), self.__tokens.waitTime(estimated_tokens))
+
+                if wait <= 0:
+                    self.__requests.consume(1)
+                    self.__tokens.consume(estimated_tokens)
+                    return
+
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        # returns the over-estimate to the bucket or charges the difference
+        self.__tokens.consume(used_tokens - estimated_tokens)
+
+    def penalize(self):
+        # the server says the quota is gone, stop admitting requests until the bucket refills
+        self.__requests.drain()
+
+class AsyncGeminiClient:
+    def __init__(self, model, generation_config = None, requests_per_minute: int = 15, tokens_per_minute: int = 1000000, max_in_flight: int = 16, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.model = model
+        self.generation_config = generation_config if generation_config is not None else gemini.defaultGenerationConfig()
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.total_requests = 0
+        self.total_retries = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+
+        self.__scheduler = RateLimitScheduler(requests_per_minute, tokens_per_minute)
+        self.__in_flight = asyncio.Semaphore(max_in_flight)
+
+    def __backoff(self, attempt: int):
+        # full jitter, spreads the retries of concurrent workers
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def generateContent(self, prompt: str, images = [], system_instructions: str = "", generation_config = None):
+        if generation_config is None:
+            generation_config = self.generation_config
+
+        content = gemini.buildContent(prompt, images, system_instructions)
+        estimated_tokens = estimateTokens(content, maxOutputTokens(generation_config))
+
+        result_cache = cache.getCache()
+
+        if result_cache is not None:
+            key = gemini.contentKey(self.model, generation_config, content)
+            result = result_cache.get(key)
+
+            if result is not None:
+                metrics.increment("gemini_cache_hits")
+                return result
+
+        async with self.__in_flight:
+            attempt = 0
+
+            while True:
+                with metrics.span("geminiQueue"):
+                    await self.__scheduler.acquire(estimated_tokens)
+
+                try:
+                    with metrics.span("geminiRequest"):
+                        response = await self.model.generate_content_async(content, generation_config=generation_config)
+                except ResourceExhausted:
+                    if attempt >= self.max_retries:
+                        print(f"Request limit reached, giving up after {attempt} retries.")
+                        raise
+
+                    self.__scheduler.penalize()
+                    delay = self.__backoff(attempt)
+
+                    attempt += 1
+                    self.total_retries += 1
+                    metrics.increment("gemini_retries")
+
+                    print(f"Request limit reached, retry {attempt}/{self.max_retries} in {delay:.1f} seconds...")
+
+                    with metrics.span("geminiBackoff"):
+                        await asyncio.sleep(delay)
+                    continue
+
+                break
+
+        self.total_requests += 1
+        metrics.increment("gemini_requests")
+        gemini.countUsage(response)
+
+        usage = getattr(response, "usage_metadata", None)
+
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_token_count
+            self.response_tokens += usage.candidates_token_count
+            self.__scheduler.settle(estimated_tokens, usage.total_token_count)
+
+        if result_cache is not None:
+            result_cache.put(key, response.text)
+
+        return response.text
+
+def connectToGemini(google_api_key: str, model_name: str = "gemini-1.5-flash", **limits):
+    return AsyncGeminiClient(gemini.createModel(google_api_key, model_name), **limits)
@@ -0,0 +1,198 @@
+import os
+import pickle
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+__cache = {}
+
+def hashParts(*parts):
+    # sha256 over every part, bytes are hashed as they are and everything else by its repr
+    digest = hashlib.sha256()
+
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            data = bytes(part)
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        elif isinstance(part, dict) and isinstance(part.get("data"), bytes):
+            # encoded image blob, hashed without building the repr of its bytes
+            data = str(part.get("mime_type")).encode() + part["data"]
+        elif hasattr(part, "tobytes") and hasattr(part, "mode") and hasattr(part, "size"):
+            # PIL image, the pixels are hashed so re-rendered copies share a key
+            data = part.mode.encode() + repr(part.size).encode() + part.tobytes()
+        else:
+            data = repr(part).encode('utf-8')
+
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+
+    return digest.hexdigest()
+
+class ResultCache:
+    # a shared cache is the view of a page pool process on the parent's cache: it reads and writes the same files,
+    # the parent keeps the index and evicts, see track()
+    def __init__(self, cache_folder: str = "cache", max_size_bytes: int = 2 * 1024 ** 3, shared: bool = False):
+        self.cache_folder = cache_folder
+        self.max_size_bytes = max_size_bytes
+        self.shared = shared
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = Lock()
+        self.__entries = OrderedDict() # key -> size, least recently used first
+        self.__size = 0
+        self.__touched = [] # (key, size) read or written by a shared cache and not yet reported, size is None for reads
+
+        os.makedirs(cache_folder, exist_ok=True)
+
+        if not shared:
+            self.__loadIndex()
+
+    def __path(self, key: str):
+        return os.path.join(self.cache_folder, key[:2], key)
+
+    def __loadIndex(self):
+        entries = []
+
+        for folder, _, files in os.walk(self.cache_folder):
+            for file_name in files:
+                if file_name.endswith(".tmp"):
+                    continue
+
+                stat = os.stat(os.path.join(folder, file_name))
+                entries.append((stat.st_mtime, file_name, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.__entries[key] = size
+            self.__size += size
+
+    def __evict(self):
+        while self.__size > self.max_size_bytes and len(self.__entries) > 0:
+            key, size = self.__entries.popitem(last=False)
+            self.__size -= size
+
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+
+    def get(self, key: str, default = None):
+        path = self.__path(key)
+
+        with self.__lock:
+            # a shared cache has no index, the file itself tells whether the entry exists
+            if not self.shared and key not in self.__entries:
+                self.misses += 1
+                return default
+
+            if not self.shared:
+                self.__entries.move_to_end(key)
+
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+
+            # the modification time keeps the LRU order across restarts
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            # a missing file was evicted by the parent, only a broken one is worth a message
+            if not isinstance(e, FileNotFoundError):
+                print(f"Cache entry {key} could not be read - Error:", e)
+
+            with self.__lock:
+                self.misses += 1
+
+                if key in self.__entries:
+                    self.__size -= self.__entries.pop(key)
+
+            return default
+
+        with self.__lock:
+            self.hits += 1
+
+            if self.shared:
+                self.__touched.append((key, None))
+
+        return value
+
+    def put(self, key: str, value):
+        path = self.__path(key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+
+        os.replace(temp_path, path)
+
+        if self.shared:
+            with self.__lock:
+                self.__touched.append((key, len(data)))
+            return
+
+        self.track(key, len(data))
+
+    def track(self, key: str, size: int = None):
+        # adds an entry written to the folder to the index, or marks a read one as recently used when size is None.
+        # the parent calls it for what the page pool did
+        with self.__lock:
+            if size is None:
+                if key in self.__entries:
+                    self.__entries.move_to_end(key)
+                return
+
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)
+
+            self.__entries[key] = size
+            self.__size += size
+
+            self.__evict()
+
+    def takeTouched(self):
+        # the (key, size) pairs a shared cache read or wrote since the last call
+        with self.__lock:
+            touched = self.__touched
+            self.__touched = []
+
+        return touched
+
+    def getStats(self):
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.__entries), "size_bytes": self.__size}
+
+def enableCache(cache_folder: str = "cache", max_size_bytes: int = 2 * 1024 ** 3):
+    __cache['default'] = ResultCache(cache_folder, max_size_bytes)
+    return __cache['default']
+
+def disableCache():
+    __cache.pop('default', None)
+
+def getCache():
+    # None when caching is disabled
+    return __cache.get('default')
+
+def getSettings():
+    # what a page pool process needs to use the same cache, None when caching is disabled
+    result_cache = getCache()
+
+    if result_cache is None:
+        return None
+
+    return {"cache_folder": result_cache.cache_folder, "max_size_bytes": result_cache.max_size_bytes}
+
+def configure(settings: dict):
+    # used by the page pool processes, works the same with spawn and with fork where the parent's cache is inherited
+    if settings is None:
+        disableCache()
+        return
+
+    current = getCache()
+
+    if current is None or not current.shared or current.cache_folder != settings["cache_folder"]:
+        __cache['default'] = ResultCache(settings["cache_folder"], settings["max_size_bytes"], shared=True)
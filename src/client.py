@@ -4,31 +4,94 @@ import os
 import json
 import csv
 import re
-import requests
 import pytesseract
 import pdf2image
 
+import io
+import tempfile
 import gemini
+import cache
+import imapsync
+import normalize
+import jsonextract
+import links
+import prefilter
+import metrics
+import imageprep
+import ocr
+import records
+import dedup
 
 from time import sleep
+from threading import local, Lock
+from concurrent.futures import ProcessPoolExecutor
+from pipeline import Stage, runPipeline
 from enum import Enum
-from pytesseract import Output
+from PIL import Image, UnidentifiedImageError
 from email.header import decode_header
 
+__page_pool = {}
+__raster_options = {"dpi": 200, "grayscale": False, "saved_max_side": None}
+# poppler/bin of the windows setup, None uses the poppler binaries on PATH
+__poppler = {"path": 'poppler/bin'}
+
+REQUIRED_KEYS = normalize.REQUIRED_KEYS
+
 class FormType(Enum):
     SALE_QUOTATION = 1
     AUTHORIZATION = 2
 
+def partSchema():
+    return {
+        "type": "object",
+        "properties": {key: {"type": "string", "nullable": True} for key in REQUIRED_KEYS}
+    }
+
+@metrics.timed("saveImageObject")
 def saveImageObject(image_object, save_path_folder: str = "outputs"):
-    if not os.path.isdir(save_path_folder):
-        os.makedirs(save_path_folder)
+    os.makedirs(save_path_folder, exist_ok=True)
         
-    file_path = os.path.join(save_path_folder, "email-" + str(image_object["email"]) + "-attachment-" + str(image_object["attachment"]) + "-page-" + str(image_object["page"]) + ".png")
+    file_path = os.path.join(save_path_folder, "email-" + str(image_object.email) + "-attachment-" + str(image_object.attachment) + "-page-" + str(image_object.page) + ".png")
     
-    image_object["image_data"].save(file_path, "PNG")
+    image_object.loadImage().save(file_path, "PNG")
     
     return file_path
 
+def releaseImageObject(image_object, save_path_folder: str = "outputs"):
+    # saves the page and keeps only a compact handle (path, text, orientation) in memory
+    saved_max_side = getRasterOptions()["saved_max_side"]
+    
+    if saved_max_side is not None:
+        image_object.image.thumbnail((saved_max_side, saved_max_side))
+    
+    image_object.release(saveImageObject(image_object, save_path_folder))
+    
+    return image_object
+
+def loadImageData(image_object):
+    return image_object.loadImage()
+
+def preparedImage(image_object, use: str):
+    # encoded once per use ("classify" or "extract") and kept with the page, later steps and retries reuse the bytes
+    prepared = image_object.prepared
+    
+    if use not in prepared:
+        with metrics.span("prepareImage"):
+            prepared[use] = imageprep.prepareForUpload(loadImageData(image_object), use)
+        
+        metrics.increment("upload_bytes", len(prepared[use]["data"]))
+    
+    return prepared[use]
+
+def setRasterOptions(dpi: int = 200, grayscale: bool = False, saved_max_side: int = None):
+    __raster_options["dpi"] = dpi
+    __raster_options["grayscale"] = grayscale
+    __raster_options["saved_max_side"] = saved_max_side
+
+def getRasterOptions():
+    return dict(__raster_options)
+
+@metrics.timed("saveAsCSV")
 def saveAsCSV(data: dict, save_name: str, save_path_folder: str = "outputs"):
     try:
         with open(os.path.normpath(os.path.join(save_path_folder, save_name)), 'w', newline='') as file:
@@ -38,9 +101,32 @@ def saveAsCSV(data: dict, save_name: str, save_path_folder: str = "outputs"):
     except Exception as e:
         print(f"Error saving data to CSV\n data: {data}\n error: {e}")
 
+def openImage(data: bytes, name: str):
+    # None for a corrupt or unsupported image (a HEIC file sent as image/jpeg), the rest of the email is still processed
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError) as e:
+        print(f"Image: {name} could not be opened, it is skipped - Error:", e)
+        return None
+    
+    return image
+
+@metrics.timed("pdfToImage")
 def pdfToImage(pdf_bytes: bytes, poppler_path: str = 'poppler/bin'):
+    result_cache = cache.getCache()
+    
+    options = getRasterOptions()
+    
+    if result_cache is not None:
+        key = cache.hashParts("pdf2image", options["dpi"], options["grayscale"], pdf_bytes)
+        pages = result_cache.get(key)
+        
+        if pages is not None:
+            return [Image.open(io.BytesIO(page)) for page in pages]
+    
     try:
-        images = pdf2image.convert_from_bytes(pdf_bytes, poppler_path=poppler_path)
+        images = pdf2image.convert_from_bytes(pdf_bytes, poppler_path=poppler_path, dpi=options["dpi"], grayscale=options["grayscale"])
     except pdf2image.exceptions.PDFPageCountError:
         return []
     
@@ -49,31 +135,268 @@ def pdfToImage(pdf_bytes: bytes, poppler_path: str = 'poppler/bin'):
     for img_data in enumerate(images):
         result.append(img_data[1])
     
+    metrics.increment("pages_rasterized", len(result))
+    
+    if result_cache is not None:
+        # pages are kept as fast png so the cache does not hold raw bitmaps
+        pages = []
+        
+        for image in result:
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG", compress_level=1)
+            pages.append(buffer.getvalue())
+        
+        result_cache.put(key, pages)
+    
     return result
 
+def iterPdfPages(pdf_bytes: bytes, poppler_path: str = 'poppler/bin', first_page: int = 1, last_page: int = None, options: dict = None):
+    # yields one page at a time so only a single bitmap is alive
+    if options is None:
+        options = getRasterOptions()
+    
+    # the pdf is written once, convert_from_bytes would write it again for every page
+    pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    
+    try:
+        with pdf_file:
+            pdf_file.write(pdf_bytes)
+        
+        if last_page is None:
+            try:
+                last_page = pdf2image.pdfinfo_from_path(pdf_file.name, poppler_path=poppler_path)["Pages"]
+            except (pdf2image.exceptions.PDFPageCountError, KeyError):
+                return
+        
+        for page in range(first_page, last_page+1):
+            with metrics.span("pdfToImage"):
+                images = pdf2image.convert_from_path(pdf_file.name, poppler_path=poppler_path, first_page=page, last_page=page, dpi=options["dpi"], grayscale=options["grayscale"])
+            
+            if len(images) > 0:
+                metrics.increment("pages_rasterized")
+                yield images[0]
+    finally:
+        os.remove(pdf_file.name)
+
+@metrics.timed("getOCD")
 def getOCD(image_object):
+    result_cache = cache.getCache()
+    
+    if result_cache is not None:
+        # the text depends on the engine, its language and data as much as on the pixels
+        settings = ocr.getSettings()
+        key = cache.hashParts("tesseract", ocr.getBackend().name, settings["language"], repr(settings["tessdata_path"]), repr(imageprep.getTarget("ocr")), image_object.image)
+        cached = result_cache.get(key)
+        
+        if cached is not None:
+            image_object.text, image_object.osd = cached
+            metrics.increment("ocr_cache_hits")
+            
+            if "orientation" in image_object.osd:
+                image_object = rotateImage(image_object)
+            
+            return image_object
+    
     try:
-        image_object["text"] = pytesseract.image_to_string(image_object["image_data"])
+        # tesseract reads a grayscale copy, the page itself stays as it is for saving and uploading
+        ocr_image = imageprep.prepareForOCR(image_object.image)
+        
+        # orientation is detected first so the text pass runs only once, on the upright page
+        engine = ocr.getBackend()
+        
+        try:
+            with metrics.span("tesseractOSD"):
+                image_object.osd = engine.osd(ocr_image)
+        except ocr.OCRError:
+            # pages with too little text for OSD are read as they are
+            image_object.osd = {}
+        
+        if image_object.osd.get("orientation", 0) != 0:
+            image_object = rotateImage(image_object)
+            ocr_image = imageprep.prepareForOCR(image_object.image)
+        
+        with metrics.span("tesseractOCR"):
+            image_object.text = engine.text(ocr_image)
+        
+        metrics.increment("pages_ocr")
+        metrics.increment("ocr_characters", len(image_object.text))
         
-        if image_object["text"] != '':
-            image_object["osd"] = pytesseract.image_to_osd(image_object["image_data"], output_type=Output.DICT, config='--psm 0')
+        if result_cache is not None:
+            result_cache.put(key, (image_object.text, image_object.osd))
             
-    except pytesseract.pytesseract.TesseractError:
-        print(f"Image: e{image_object['email']}-a{image_object['attachment']}-p{image_object['page']} could not be processed.")
+    except ocr.OCRError:
+        print(f"Image: {image_object.name()} could not be processed.")
     
     return image_object
 
+@metrics.timed("getOSD")
+def getOSD(image_object):
+    # orientation only, for pages whose text comes from the pdf text layer.
+    # the page is still saved and sent to the model, a scan lying on its side has to be turned upright
+    result_cache = cache.getCache()
+    
+    if result_cache is not None:
+        settings = ocr.getSettings()
+        key = cache.hashParts("osd", ocr.getBackend().name, repr(settings["tessdata_path"]), repr(imageprep.getTarget("ocr")), image_object.image)
+        cached = result_cache.get(key)
+        
+        if cached is not None:
+            image_object.osd = cached
+            metrics.increment("ocr_cache_hits")
+            
+            return rotateImage(image_object) if "orientation" in image_object.osd else image_object
+    
+    try:
+        with metrics.span("tesseractOSD"):
+            image_object.osd = ocr.getBackend().osd(imageprep.prepareForOCR(image_object.image))
+    except ocr.OCRError:
+        image_object.osd = {}
+    
+    if result_cache is not None:
+        result_cache.put(key, image_object.osd)
+    
+    if image_object.osd.get("orientation", 0) != 0:
+        image_object = rotateImage(image_object)
+    
+    return image_object
+
+def newImageObject(index, attachment_index, page_index, image_data):
+    return records.PageRecord(index, attachment_index, page_index+1, image_data)
+
+def parseImageData(index, attachment_index, page_index, image_data, text: str = None):
+    image_object = newImageObject(index, attachment_index, page_index, image_data)
+    
+    if text is not None:
+        # the pdf has a usable text layer, only the orientation is detected
+        image_object.text = text
+        image_object = getOSD(image_object)
+        metrics.increment("pages_text_layer")
+    else:
+        image_object = getOCD(image_object)
+    
+    # Check if image contains text
+    if image_object.text.strip() != "":
+        return image_object
+
+def pageText(text_layer: list, page_number: int):
+    # text layer of a 1 based page number, None when the page needs OCR
+    if text_layer is None or page_number > len(text_layer):
+        return None
+    
+    return text_layer[page_number-1]
+
+def ocrPageRange(pdf_bytes: bytes, index, attachment_index, first_page: int, last_page: int, poppler_path: str, tesseract_cmd: str, options: dict, save_path_folder: str = None, text_layer: list = None, targets: dict = None, ocr_settings: dict = None, cache_settings: dict = None):
+    # runs inside a page pool process, rasterizes and reads only the given pages.
+    # the metrics and the cache entries of the task are sent back with the pages, the parent merges them
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    __raster_options.update(options)
+    metrics.reset()
+    
+    if targets is not None:
+        imageprep.setTargets(targets)
+    
+    # the engine of the process stays loaded between tasks
+    if ocr_settings is not None:
+        ocr.configure(ocr_settings)
+    
+    cache.configure(cache_settings)
+    
+    result = []
+    
+    for di, image in enumerate(iterPdfPages(pdf_bytes, poppler_path, first_page, last_page, options)):
+        image_object = parseImageData(index, attachment_index, first_page+di, image, pageText(text_layer, first_page+di))
+        
+        if image_object != None:
+            if save_path_folder is not None:
+                image_object = releaseImageObject(image_object, save_path_folder)
+            
+            result.append(image_object)
+    
+    result_cache = cache.getCache()
+    
+    return result, metrics.getSnapshot(), result_cache.takeTouched() if result_cache is not None else []
+
+def setPageWorkers(workers: int):
+    # 0 turns the page pool off and pages are processed one after another
+    if __page_pool.get('pool') is not None:
+        __page_pool['pool'].shutdown()
+        __page_pool['pool'] = None
+    
+    if workers > 0:
+        __page_pool['pool'] = ProcessPoolExecutor(max_workers=workers)
+
+def getPagePool():
+    return __page_pool.get('pool')
+
+def parsePdf(pdf_bytes: bytes, index, attachment_index, poppler_path: str = 'poppler/bin', pages_per_task: int = 2, save_path_folder: str = None, text_layer: list = None):
+    # with a save folder pages are streamed: saved right after OCR and returned as handles,
+    # pages with an entry in text_layer are not OCRed
+    pool = getPagePool()
+    
+    if pool is None:
+        image_objects = []
+        
+        if save_path_folder is not None:
+            for di, image in enumerate(iterPdfPages(pdf_bytes, poppler_path)):
+                image_object = parseImageData(index, attachment_index, di+1, image, pageText(text_layer, di+1))
+                
+                if image_object != None:
+                    image_objects.append(releaseImageObject(image_object, save_path_folder))
+            
+            return image_objects
+        
+        images = pdfToImage(pdf_bytes, poppler_path)
+        
+        for di in range(len(images)):
+            image_object = parseImageData(index, attachment_index, di+1, images[di], pageText(text_layer, di+1))
+            
+            if image_object != None:
+                image_objects.append(image_object)
+        
+        return image_objects
+    
+    try:
+        page_count = pdf2image.pdfinfo_from_bytes(pdf_bytes, poppler_path=poppler_path)["Pages"]
+    except (pdf2image.exceptions.PDFPageCountError, KeyError):
+        return []
+    
+    # every task rasterizes and reads a small page range, page numbers match the sequential path
+    futures = [
+        pool.submit(ocrPageRange, pdf_bytes, index, attachment_index, first_page, min(first_page+pages_per_task-1, page_count), poppler_path, pytesseract.pytesseract.tesseract_cmd, getRasterOptions(), save_path_folder, text_layer, imageprep.getTargets(), ocr.getSettings(), cache.getSettings())
+        for first_page in range(1, page_count+1, pages_per_task)
+    ]
+    
+    image_objects = []
+    result_cache = cache.getCache()
+    
+    for future in futures:
+        pages, task_metrics, cache_entries = future.result()
+        
+        image_objects += pages
+        metrics.merge(task_metrics)
+        
+        # the index and the size limit of the cache are kept here
+        if result_cache is not None:
+            for key, size in cache_entries:
+                result_cache.track(key, size)
+    
+    return image_objects
+
+@metrics.timed("rotateImage")
 def rotateImage(image_object):
-    if "orientation" in image_object['osd']: 
-        if image_object['osd']['orientation'] != 0:
+    if "orientation" in image_object.osd: 
+        if image_object.osd['orientation'] != 0:
             # rotates image back to normal if the image is rotated in the pdf
-            image_object['image_data'] = image_object['image_data'].rotate(image_object['osd']['orientation'], expand=True)
+            image_object.image = image_object.image.rotate(image_object.osd['orientation'], expand=True)
     else:
-        print(f"Image: e{image_object['email']}-a{image_object['attachment']}-p{image_object['page']} could not be rotated.")
+        print(f"Image: {image_object.name()} could not be rotated.")
     
     return image_object
 
-def recursiveListUpdate(current_data: list, new_data: list = []):
+def recursiveListUpdate(current_data: list, new_data: list = None):
+    if new_data is None:
+        new_data = []
+    
     for data in current_data:
         if isinstance(data, list):
             recursiveListUpdate(data, new_data)
@@ -85,32 +408,33 @@ def recursiveListUpdate(current_data: list, new_data: list = []):
 def setTesseractPath(path):
     pytesseract.pytesseract.tesseract_cmd = path
 
-def step1(mail_body, system_instructions: str):
-    gemini.setSystemInstructions(system_instructions)
-    mail_info = gemini.generateContent(mail_body) # request count: 1
-    mail_info = mail_info.replace("`", "")
-    mail_info = mail_info.replace("json", "")
-
-    parts = mail_info.split("\n")
+def setPopplerPath(path):
+    __poppler["path"] = path
 
-    parts_data = []
+def getPopplerPath():
+    return __poppler["path"]
 
-    for part in parts:
-        if part.strip():  # Skip empty parts
-            try:
-                parts_data.append(json.loads(part))
-            except Exception as e:
-                print(f"Error parsing part-{parts.index(part)+1} - Error:", e)
+def step1Stream(mail_body, system_instructions: str):
+    # yields every part as soon as the model has finished writing it - request count: 1
+    chunks = gemini.generateContentStream(mail_body, system_instructions=system_instructions)
+    
+    for part in jsonextract.streamObjects(chunks):
+        yield part
 
-    return parts_data
+@metrics.timed("step1")
+def step1(mail_body, system_instructions: str):
+    return list(step1Stream(mail_body, system_instructions))
 
-def step2(attachments, system_instructions: str):
-    gemini.setSystemInstructions(system_instructions)
-    
+@metrics.timed("step2")
+def step2(attachments, system_instructions: str, page_classifier = None):
     attachmentsInfo = []
     
     for attachment in attachments:
-        attachment_type = gemini.generateContent("document: ", [attachment["image_data"]]) # request count: a
+        # pages the local classifier is sure about never reach the model
+        attachment_type = page_classifier(attachment.text) if page_classifier is not None else None
+        
+        if attachment_type is None:
+            attachment_type = gemini.generateContent("document: ", [preparedImage(attachment, "classify")], system_instructions=system_instructions) # request count: a
         
         if attachment_type.find("1") != -1:
             form_type = FormType.SALE_QUOTATION
@@ -119,63 +443,172 @@ def step2(attachments, system_instructions: str):
         else:
             continue
             
-        attachmentsInfo.append({"attachment": attachment, "type": form_type, "info": {}})
+        attachmentsInfo.append(records.DocumentRecord(attachment, form_type))
         
     return attachmentsInfo
 
+@metrics.timed("step3")
 def step3(attachmentInfo, sale_quotation_instructions: str, authorization_instructions: str):
-    if attachmentInfo["type"] == FormType.SALE_QUOTATION:
-        gemini.setSystemInstructions(sale_quotation_instructions)
-        info = gemini.generateContent("document: ", [attachmentInfo["attachment"]["image_data"]]) # request count: 1
-    elif attachmentInfo["type"] == FormType.AUTHORIZATION:
-        gemini.setSystemInstructions(authorization_instructions)
-        info =  gemini.generateContent("document: ", [attachmentInfo["attachment"]["image_data"]]) # request count: 1
+    if attachmentInfo.type == FormType.SALE_QUOTATION:
+        info = gemini.generateContent("document: ", [preparedImage(attachmentInfo.page, "extract")], system_instructions=sale_quotation_instructions) # request count: 1
+    elif attachmentInfo.type == FormType.AUTHORIZATION:
+        info =  gemini.generateContent("document: ", [preparedImage(attachmentInfo.page, "extract")], system_instructions=authorization_instructions) # request count: 1
     
-    # Remove '`' and 'json' from the result
-    info = info.replace("`", "")
-    info = info.replace("json", "")
+    attachmentInfo.info = jsonextract.extractFirstObject(info, {})
     
-    attachmentInfo["info"] = json.loads(info)
+    if len(attachmentInfo.info) == 0:
+        print(f"No json data found for {attachmentInfo.page.name()}. You may check output manually: {info}")
         
     return attachmentInfo
 
+@metrics.timed("step4")
 def step4(partInfo, attachmentsInfo, system_instructions: str):
-    gemini.setSystemInstructions(system_instructions)
-    
     prompt = "Json data to merge:" + json.dumps(partInfo) + ","
     
     for attachment in attachmentsInfo:
-        prompt += json.dumps(attachment["info"]) + ","
+        prompt += json.dumps(attachment.info) + ","
         
-    merged_info = gemini.generateContent(prompt) # request count: 1
+    merged_info = gemini.generateContent(prompt, system_instructions=system_instructions) # request count: 1
     
     return merged_info
 
+@metrics.timed("step5")
 def step5(merged_info, mail_index: int, part_index: int, system_instructions: str):
     # remove the unnecessary keys
     required_keys = "vendor_name, part_no, cond(CC or Cond), qty(QTY or Quantity), lead_time, price, description, serial_number, notes, warranty, dual, tagged_by, trace_to, tag_date, tag_type(FAA/EASA), stock_type(EA, OH, SV, RP)"
     
-    gemini.setSystemInstructions(system_instructions)
-    
     prompt = "Required keys: " + required_keys + ", Json data: " + json.dumps(merged_info)
     
-    normalized_info = gemini.generateContent(prompt) # request count: 1
+    normalized_info = gemini.generateContent(prompt, system_instructions=system_instructions) # request count: 1
     
-    # Remove '`' and 'json' from the result
-    normalized_info = normalized_info.replace("`", "")
-    normalized_info = normalized_info.replace("json", "")
+    result = jsonextract.extractFirstObject(normalized_info, {})
     
-    try:
-        normalized_info = json.loads(normalized_info)
-    except json.JSONDecodeError:
+    if len(result) == 0:
         print(f"Json data could not be parsed for e{mail_index}-p{part_index+1}. You may check output manually: {normalized_info}")
-        normalized_info = {}
-    finally:
-        return normalized_info
+    
+    return result
+
+@metrics.timed("step23")
+def step23(attachments, system_instructions: str, pages_per_call: int = 4, page_classifier = None):
+    # classification and extraction in one json call for several pages - request count: a / pages_per_call
+    response_schema = {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "document": {"type": "integer"},
+                "type": {"type": "string", "enum": ["Sale Quotation Form-1", "Authorization Form-2", "Other-3"]},
+                "info": partSchema()
+            },
+            "required": ["document", "type"]
+        }
+    }
+    
+    generation_config = gemini.jsonGenerationConfig(response_schema)
+    
+    attachmentsInfo = []
+    
+    if page_classifier is not None:
+        # obvious "Other-3" pages are left out of the batches
+        attachments = [attachment for attachment in attachments if page_classifier(attachment.text) != "3"]
+    
+    for first in range(0, len(attachments), max(1, pages_per_call)):
+        batch = attachments[first:first+pages_per_call]
+        
+        prompt = f"{len(batch)} documents are given in order, number them from 1 to {len(batch)}."
+        result = gemini.generateContent(prompt, [preparedImage(attachment, "extract") for attachment in batch], system_instructions=system_instructions, generation_config=generation_config)
+        
+        documents = jsonextract.extractObjects(result)
+        
+        if len(documents) == 0:
+            print(f"Json data could not be parsed for the documents {first+1}-{first+len(batch)}. You may check output manually: {result}")
+            continue
+        
+        for document in documents:
+            document_index = document.get("document", 0) - 1
+            
+            if document_index < 0 or document_index >= len(batch):
+                continue
+            
+            if document.get("type", "").find("1") != -1:
+                form_type = FormType.SALE_QUOTATION
+            elif document.get("type", "").find("2") != -1:
+                form_type = FormType.AUTHORIZATION
+            else:
+                continue
+            
+            info = {key: value for key, value in (document.get("info") or {}).items() if value is not None}
+            attachmentsInfo.append(records.DocumentRecord(batch[document_index], form_type, info))
+    
+    return attachmentsInfo
+
+@metrics.timed("step45")
+def step45(parts_data, attachmentsInfo, mail_index: int, system_instructions: str):
+    # merging and normalization of every part in one json call - request count: 1
+    response_schema = {"type": "array", "items": partSchema()}
+    
+    prompt = "Required keys: " + ", ".join(REQUIRED_KEYS) + ", Parts: " + json.dumps(parts_data) + ", Documents: " + json.dumps([attachment.info for attachment in attachmentsInfo])
+    
+    result = gemini.generateContent(prompt, system_instructions=system_instructions, generation_config=gemini.jsonGenerationConfig(response_schema))
+    
+    normalized_parts = jsonextract.extractObjects(result)
+    
+    if len(normalized_parts) == 0:
+        print(f"Json data could not be parsed for e{mail_index}. You may check output manually: {result}")
+        return [{} for _ in parts_data]
+    
+    normalized_parts = [{key: value for key, value in part.items() if value is not None} for part in normalized_parts]
+    
+    # keeps the one row per part contract of the per step workflow
+    return (normalized_parts + [{} for _ in parts_data])[:len(parts_data)]
+
+@metrics.timed("step45Local")
+def step45Local(part_info, attachmentsInfo, mail_index: int, part_index: int, system_instructions: str = None):
+    normalized_info, unresolved = normalize.mergePart(part_info, attachmentsInfo)
+    
+    missing_keys = [key for key in REQUIRED_KEYS if key not in normalized_info]
+    
+    if system_instructions is not None and len(unresolved) > 0 and len(missing_keys) > 0:
+        # only the values the engine could not place are sent to the model - request count: 1
+        response_schema = {"type": "object", "properties": {key: {"type": "string", "nullable": True} for key in missing_keys}}
+        
+        prompt = "Required keys: " + ", ".join(missing_keys) + ", Json data: " + json.dumps(unresolved)
+        result = gemini.generateContent(prompt, system_instructions=system_instructions, generation_config=gemini.jsonGenerationConfig(response_schema, 2048))
+        
+        resolved_info, _ = normalize.normalizeInfo(jsonextract.extractFirstObject(result, {}))
+        
+        if len(resolved_info) == 0:
+            print(f"Json data could not be parsed for e{mail_index}-p{part_index+1}. You may check output manually: {result}")
+        
+        for key, value in resolved_info.items():
+            if key in missing_keys:
+                normalized_info[key] = value
+    
+    return normalized_info
+
+def uidKey(uid: int):
+    # emails fetched by uid are kept apart from the ones fetched by sequence number in the job store and the outputs
+    return f"u{uid}"
 
 class EmailClient:
     def __init__(self):
         self.isLogged_in = False
+        self.stream_pages = False
+        self.workflow_mode = "per_step"
+        self.pages_per_call = 4
+        self.local_normalization = False
+        self.llm_fallback = True
+        self.result_sink = None
+        self.link_fetcher = links.LinkFetcher()
+        self.job_store = None
+        self.prefilter = None
+        self.dedup_index = None
+        self.connection_pool = None
+        
+        # extra IMAP connections opened by the batch fetch workers, one per thread
+        self.__worker_local = local()
+        self.__worker_imaps = []
+        self.__worker_lock = Lock()
     
     def __decodeH(self, header):
         header_part, encoding = decode_header(header)[0]
@@ -183,16 +616,12 @@ class EmailClient:
             header_part = header_part.decode(encoding, errors='replace') # if it's a bytes, decode to str
         return header_part
 
-    def __parse_image_data(self, index, attachment_index, page_index, image_data):
-        image_object = {"email": index, "attachment": attachment_index, "page": page_index+1, "image_data": image_data, "text": "", "osd": {}}
-        image_object = getOCD(image_object)
+    def __fetch_raw(self, index: int, message_parts: str = "(RFC822)", imap = None):
+        if imap is None:
+            imap = self.__imap
         
-        # Check if image contains text
-        if image_object["text"].strip() != "":
-            return rotateImage(image_object)
-
-    def __fetch_email(self, index: int, message_parts: str = "(RFC822)"):
-        status, msg = self.__imap.fetch(str(index), message_parts)
+        with metrics.span("fetch"):
+            status, msg = imap.fetch(str(index), message_parts)
         
         if status != "OK":
             print("An error occurred while fetching the email.")
@@ -200,188 +629,753 @@ class EmailClient:
         
         for response in msg:
             if isinstance(response, tuple):
-                # parse a bytes email into a message object
-                mail = email.message_from_bytes(response[1])
+                metrics.increment("bytes_fetched", len(response[1]))
+                return response[1]
+
+    def setWorkflowMode(self, mode: str, pages_per_call: int = 4):
+        # "per_step" makes 1 + 2a + 2p requests per email, "batched" makes 2 + a / pages_per_call
+        if mode not in ("per_step", "batched"):
+            raise ValueError(f"Unknown workflow mode: {mode}")
+        
+        self.workflow_mode = mode
+        self.pages_per_call = pages_per_call
+
+    def setLocalNormalization(self, enabled: bool, llm_fallback: bool = True):
+        # merges and normalizes the parts without the model, it is asked only about keys the engine does not know
+        self.local_normalization = enabled
+        self.llm_fallback = llm_fallback
+
+    def setResultSink(self, result_sink):
+        # rows go to one shared sink (sinks.createSink) instead of a csv file per part
+        self.result_sink = result_sink
+
+    def setPreFilter(self, pre_filter):
+        # a prefilter.PreFilter drops emails, attachments and pages before any expensive work
+        self.prefilter = pre_filter
+
+    def setJobStore(self, job_store):
+        # with a job store (jobstore.JobStore) every step is checkpointed and restarts resume where they stopped
+        self.job_store = job_store
+
+    def setDedupIndex(self, dedup_index):
+        # with a dedup index (dedup.DedupIndex) repeated pages and emails reuse their earlier results
+        # and rows that were already exported are not written again
+        self.dedup_index = dedup_index
+
+    def setLinkFetcher(self, link_fetcher):
+        self.link_fetcher = link_fetcher
+
+    def setPageStreaming(self, enabled: bool):
+        # streamed pages are saved while the email is parsed and only their handles stay in memory
+        self.stream_pages = enabled
+
+    def __acceptsAttachment(self, content_type: str, data: bytes):
+        return self.prefilter is None or self.prefilter.acceptsAttachment(content_type, len(data))
+
+    def __textLayer(self, pdf_bytes: bytes):
+        if self.prefilter is None:
+            return None
+        
+        return [text if self.prefilter.usableTextLayer(text) else None for text in prefilter.extractPdfText(pdf_bytes, getPopplerPath())]
+
+    def __parse_email(self, index: int, raw_email: bytes, save_path_folder: str = "outputs"):
+        page_folder = os.path.join(save_path_folder, "email-" + str(index)) if self.stream_pages else None
+        
+        # parse a bytes email into a message object
+        mail = email.message_from_bytes(raw_email)
+        
+        # decode the email subject and sender
+        subject = self.__decodeH(mail.get("Subject"))
+        sender_address = self.__decodeH(mail.get("Return-Path"))
+        
+        if self.prefilter is not None and not self.prefilter.acceptsHeaders(sender_address, subject):
+            print(f"Email-{index} does not pass the pre-filter. Skipping...")
+            self.prefilter.skipped_emails += 1
+            return None
+        
+        body = ""
+        
+        attachments = []
+        
+        attachment_index = 1
+            
+        # if the email message is multipart
+        if mail.is_multipart():
+            # iterate over email parts
+            
+            part_index = 0
+            
+            for part in mail.walk():
+                # skip the first part (the email itself)
+                if part_index == 0:
+                    part_index += 1
+                    continue
                 
-                # decode the email subject and sender
-                subject = self.__decodeH(mail.get("Subject"))
-                sender_address = self.__decodeH(mail.get("Return-Path"))
+                # extract content type of email
+                content_type = part.get_content_type()
+                content_disposition = str(part.get("Content-Disposition"))
                 
-                body = ""
+                # parse pdf attachments
+                if content_type == "application/pdf" and "attachment" in content_disposition:
+                    data = part.get_payload(decode=True)
+                    
+                    if data != None and self.__acceptsAttachment(content_type, data):
+                        attachments += parsePdf(data, index, attachment_index, getPopplerPath(), save_path_folder=page_folder, text_layer=self.__textLayer(data))
+                        
+                    attachment_index += 1
                 
-                attachments = []
+                # parse image attachments
+                elif (content_type == "image/jpeg" or content_type == "image/png") and "attachment" in content_disposition:
+                    data = part.get_payload(decode=True)
                     
-                # if the email message is multipart
-                if mail.is_multipart():
-                    # iterate over email parts
+                    image = None
                     
-                    part_index = 0
-                    attachment_index = 1
+                    if data != None and self.__acceptsAttachment(content_type, data):
+                        image = openImage(data, f"email-{index}-attachment-{attachment_index}")
                     
-                    for part in mail.walk():
-                        # skip the first part (the email itself)
-                        if part_index == 0:
-                            part_index += 1
-                            continue
-                        
-                        # extract content type of email
-                        content_type = part.get_content_type()
-                        content_disposition = str(part.get("Content-Disposition"))
-                        
-                        # parse pdf attachments
-                        if content_type == "application/pdf" and "attachment" in content_disposition:
-                            data = part.get_payload(decode=True)
-                            
-                            if data != None:
-                                temp_image_data = pdfToImage(data)
-                                
-                                for di in range(len(temp_image_data)):
-                                    image_object = self.__parse_image_data(index, attachment_index, di+1, temp_image_data[di])
-                                    
-                                    if image_object != None:
-                                        attachments.append(image_object)
-                                
-                            attachment_index += 1
+                    if image is not None:
+                        image_object = parseImageData(index, attachment_index, 0, image)
                         
-                        # parse image attachments
-                        elif (content_type == "image/jpeg" or content_type == "image/png") and "attachment" in content_disposition:
-                            data = part.get_payload(decode=True)
+                        if image_object != None:
+                            if page_folder is not None:
+                                image_object = releaseImageObject(image_object, page_folder)
                             
-                            if data != None:
-                                image_object = self.__parse_image_data(index, attachment_index, 0, data)
-                                
-                                if image_object != None:
-                                    attachments.append(image_object)
-                                
-                            attachment_index += 1
+                            attachments.append(image_object)
                         
-                        elif content_type == "text/plain":
-                            body = part.get_payload(decode=True).decode('utf-8', errors='replace')
-                    
-                        part_index += 1
-                        
-                else:
-                    # extract the email body for single part messages
-                    body = mail.get_payload(decode=True).decode('utf-8', errors='replace')
+                    attachment_index += 1
                 
-                subject_output = subject
-                sender_address_output = sender_address
-                body_output = body
-                attachments_output = recursiveListUpdate(attachments)
+                elif content_type == "text/plain":
+                    body = part.get_payload(decode=True).decode('utf-8', errors='replace')
+            
+                part_index += 1
                 
-                pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-                links = re.findall(pattern, body)
+        else:
+            # extract the email body for single part messages
+            body = mail.get_payload(decode=True).decode('utf-8', errors='replace')
+        
+        pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+        body_links = re.findall(pattern, body)
+        
+        # Download the files attached to the link, every link is fetched at the same time
+        for link, content_type, content in self.link_fetcher.fetchAll(body_links):
+            if content_type == "application/pdf":
+                attachments += parsePdf(content, index, attachment_index, getPopplerPath(), save_path_folder=page_folder, text_layer=self.__textLayer(content))
+            else:
+                image = openImage(content, link)
+                image_object = parseImageData(index, attachment_index, 0, image) if image is not None else None
                 
-                # Download the files attached to the link
-                for link in links:
-                    if link.endswith('>'):
-                        link = link[:-1]
-                    
-                    response = requests.get(link, stream=True)
+                if image_object != None:
+                    if page_folder is not None:
+                        image_object = releaseImageObject(image_object, page_folder)
                     
-                    if response.status_code == 200:
-                        if response.content != None:
-                            images = pdfToImage(response.content)
-                            
-                            if len(images) > 0:
-                                for di in range(len(images)):
-                                    image_object = self.__parse_image_data(index, attachment_index, di+1, images[di])
-                                    
-                                    if image_object != None:
-                                        attachments.append(image_object)
-                
-                print(f"Total {len(attachments)} attachments found.")
-                
-                # reset values
-                subject = ""
-                sender_address = ""
-                body = ""
-                attachments = []
-                
-                return {
-                    "subject": subject_output,
-                    "from": sender_address_output,
-                    "body": body_output,
-                    "attachments": attachments_output
-                }
+                    attachments.append(image_object)
+            
+            attachment_index += 1
+        
+        print(f"Total {len(attachments)} attachments found.")
+        
+        return records.MessageRecord(index, subject, sender_address, body, recursiveListUpdate(attachments))
 
-    def getTotalEmailCount(self):
-        status, messages = self.__imap.search(None, "ALL")
-        self.total_email_count = len(messages[0].split())
-        return self.total_email_count
+    def __pageClassifier(self):
+        return self.prefilter.classifyPageText if self.prefilter is not None else None
 
-    def fetchAndParse(self, mail_index, save_path_folder: str = "outputs", sleep_duration_after_finish: int = 10):
-        print("\nFetching email-" + str(mail_index) + "...") # log the fetching of the email
-        currentMail = self.__fetch_email(mail_index)
+    def __checkpoint(self, mail_index, stage: str, compute):
+        # returns the stored output of a finished stage, otherwise runs it and stores the output
+        if self.job_store is None:
+            return compute()
+        
+        stored = self.job_store.load(mail_index, stage)
+        
+        if stored is not None:
+            print(f"Email-{mail_index} {stage} restored from the job store.")
+            return stored[0]
+        
+        output = compute()
+        self.job_store.save(mail_index, stage, output)
+        
+        return output
+
+    def __parseCheckpointed(self, mail_index, raw_email: bytes, save_path_folder: str = "outputs"):
+        # raw_email is None when the parsed email is already in the job store
+        if raw_email is None:
+            return self.job_store.load(mail_index, "ocr")[0]
+        
+        with metrics.emailScope(mail_index, "parse"), metrics.span("parse"):
+            return self.__checkpoint(mail_index, "ocr", lambda: self.__parse_email(mail_index, raw_email, save_path_folder))
+
+    def __needsFetch(self, mail_index):
+        # False: the email is done, None: the parsed email is stored, True: it has to be fetched
+        if self.job_store is None:
+            return True
+        
+        if self.job_store.isDone(mail_index):
+            print(f"Email-{mail_index} is already processed. Skipping...")
+            return False
         
+        if self.job_store.load(mail_index, "ocr") is not None:
+            return None
+        
+        return True
+
+    def __runEmail(self, mail_index, currentMail, save_path_folder: str = "outputs"):
+        if currentMail is None:
+            # rejected by the pre-filter
+            metrics.increment("emails_filtered")
+            
+            if self.job_store is not None:
+                self.job_store.markDone(mail_index, 0)
+            
+            return 0
+        
+        try:
+            with metrics.emailScope(mail_index, "process"), metrics.span("process"):
+                saved_parts = self.__processEmail(mail_index, currentMail, save_path_folder)
+        except Exception as e:
+            metrics.increment("emails_failed")
+            
+            if self.job_store is not None:
+                # recorded with the last stage that finished, the next run starts right after it
+                stage = self.job_store.getStage(mail_index)
+                self.job_store.markFailed(mail_index, stage[0] if stage else "fetch", str(e))
+            raise
+        
+        if self.job_store is not None:
+            self.job_store.markDone(mail_index, saved_parts)
+        
+        metrics.increment("emails_processed")
+        metrics.increment("parts_saved", saved_parts)
+        
+        return saved_parts
+
+    def __processEmail(self, mail_index, currentMail, save_path_folder: str = "outputs"):
         email_save_folder = os.path.join(save_path_folder, "email-" + str(mail_index))
         
         # Create folder to save outputs
-        if not os.path.isdir(email_save_folder):
-            os.makedirs(email_save_folder)
+        os.makedirs(email_save_folder, exist_ok=True)
         
         ### Save Attachments ###
-        for attachment in currentMail["attachments"]:
-            saveImageObject(attachment, email_save_folder)
+        for attachment in currentMail.attachments:
+            if self.dedup_index is not None:
+                self.dedup_index.hashPage(attachment)
+            
+            # streamed pages are already on disk, the others are freed once saved and loaded back when a step needs them
+            if attachment.path is None:
+                attachment.release(saveImageObject(attachment, email_save_folder))
         
         # Starting AI Workflow
-        if currentMail["body"].strip() == "":
+        if currentMail.body.strip() == "":
             print("Email-" + str(mail_index) + " has no body. Skipping...")
-            return
+            return 0
         
         si_s1 = r'You are an expert of reading emails. Your job is extracting item/part information in json format. Completely ignore the rest of the email and do not add "´" characters. Example result: {"Vendor name": "1234", "Part No": "1234", "CC": "1234", "QTY": "1234", "Lead Time": "1234", "Unit Price (USD)": "1234", "description": "1234", "Serial number": "1234 ", "Trace To": "1234", "Tag type": "1234", "Tagged by": "1234", "Notes": "1234", "Warranty": "1234", "Dual": "1234"}. If there is a table of parts... give the result as a list of jsons separated by new lines. But there is a low chance of having a table.'
         si_s2_filtering = r'You are an expert of reading documents. Your job is giving type every document that we are going to give you. We have 3 types of documents: "Sale Quotation Form-1", "Authorization Form-2" and "Other-3". You need to detect the type of the document and return it. Do not add "´" characters to the result. Example result: {"Type": "Sale Quotation Form-1"}. Here is the tricky part: these documents can contain unnecessary information as well so you need to be aware of which information is related or not.'
         si_s3_sale = r'You have a wide range of information about sale quotation forms. Your job is extracting item/part information from the forms that we are going to give you. Do not add "´" characters to the result. Example result: {"Vendor name": "1234", "Part No": "1234", "CC": "1234", "QTY": "1234", "Lead Time": "1234", "Unit Price (USD)": "1234", "description": "1234", "Serial number": "1234 ", "Trace To": "1234", "Tag type": "1234", "Tagged by": "1234", "Notes": "1234", "Warranty": "1234", "Dual": "1234"}. DO NOT forget that these keywords are just examples so you need to extract every information that is related to the part/item. Here is the tricky part: these forms can contain unnecessary information as well so you need to be aware of which information is related or not.'
         si_s3_auth = r'You have a wide range of information about authorization forms. Your job is extracting necessary information about the form that we are going to give you. Do not add "´" characters to the result. Example result: {"Tagged by": "${company_name}", "Tag date": "1234", "Tag type(FAA/EASA)": "1234", "Dual": "1234"}. To detect whether the authorization form dual or single you need to check if "Other regulation specified in Block 12" is marked or not. If it is marked, the form is dual.'
         si_s4 = r'Your job is merging json files that are given to you. You need to merge them in a way that the result is a single json file. Do not add "´" characters to the result. Here is the tricky part: Some of the keys or values may be same in different files. You need to be aware of this and merge the same elements in the files. Example result: {"Vendor_name": "1234", "Part No": "1234", "CC": "1234", "QTY": "1234", "Lead Time": "1234", "Unit Price (USD)": "1234", "description": "1234", "Serial number": "1234 ", "Trace To": "1234", "Tag type": "1234", "Tagged by": "1234", "Notes": "1234", "Warranty": "1234", "Dual": "1234"}'
+        si_s23 = r'You are an expert of reading documents. Every document that we give you is one of 3 types: "Sale Quotation Form-1", "Authorization Form-2" or "Other-3". For every document give its number, its type and, unless it is "Other-3", the item/part information in it. For sale quotation forms extract the part information, for authorization forms extract who tagged it, the tag date, the tag type(FAA/EASA) and whether it is dual. An authorization form is dual if "Other regulation specified in Block 12" is marked. These documents can contain unnecessary information as well so you need to be aware of which information is related or not.'
+        si_s45 = r'Your job is merging the part information from an email with the information from its documents. Give one result for every part, in the same order as the parts. Some of the keys or values may be same in different sources, merge the same elements. Map every value to the required keys (CC or Cond is cond, QTY or Quantity is qty) and leave out the values that have no place in them.'
         si_s5 = r'Normalize the json data. Remove null values and unnecessary keys. Then give the result without adding "`" or "json".'
         
         # Step 1 - Extracting item/part information in json format - total request count: 1
         print("Step 1 - Extracting item/part information in json format...")
-        parts_data = step1(currentMail["body"], si_s1)
+        parts_data = self.__checkpoint(mail_index, "step1", lambda: step1(currentMail.body, si_s1))
         
         if len(parts_data) == 0:
             print("No part information could be extracted from the mail body. Skipping...")
-            return
+            return 0
         
         print(f"Total parts extracted from mail body: {len(parts_data)}")
+        
+        known_documents = []
+        new_pages = currentMail.attachments
+        
+        if self.dedup_index is not None:
+            page_keys = [dedup.pageKey(attachment) for attachment in currentMail.attachments]
+            reused_parts = self.dedup_index.findEmail(currentMail.body, parts_data, page_keys)
+            
+            if reused_parts is not None:
+                print("The email repeats an earlier email, its parts are reused.")
+                metrics.increment("emails_reused")
+                return self.__saveParts(mail_index, reused_parts, email_save_folder)
+            
+            known_documents, new_pages = self.__splitKnownPages(currentMail.attachments)
 
-        # Step 2 - Detecting the type of the attachments - total request count: a
-        print("Step 2 - Detecting the type of the attachments...")
-        attachmentsInfo = step2(currentMail["attachments"], si_s2_filtering)
+        if self.workflow_mode == "batched":
+            # Step 2/3 - Detecting the type of the attachments and extracting their information - total request count: a / pages_per_call
+            print("Step 2/3 - Detecting the type of the attachments and extracting their information...")
+            parsed_attachments = self.__checkpoint(mail_index, "step23", lambda: step23(new_pages, si_s23, self.pages_per_call, self.__pageClassifier()))
+        else:
+            # Step 2 - Detecting the type of the attachments - total request count: a
+            print("Step 2 - Detecting the type of the attachments...")
+            attachmentsInfo = self.__checkpoint(mail_index, "step2", lambda: step2(new_pages, si_s2_filtering, self.__pageClassifier()))
 
-        # Step 3 - Extracting item/part information from the attachments - total request count: a
-        print("Step 3 - Extracting item/part information from the attachments...")
+            # Step 3 - Extracting item/part information from the attachments - total request count: a
+            print("Step 3 - Extracting item/part information from the attachments...")
+            
+            parsed_attachments = []
+            
+            for attachment_index, aInfo in enumerate(attachmentsInfo):
+                parsed_attachments.append(self.__checkpoint(mail_index, f"step3-{attachment_index}", lambda: step3(aInfo, si_s3_sale, si_s3_auth)))
         
-        parsed_attachments = []
+        if self.dedup_index is not None:
+            parsed_attachments = self.__mergeKnownPages(currentMail.attachments, known_documents, parsed_attachments, new_pages)
         
-        for aInfo in attachmentsInfo:
-            parsed_attachments.append(step3(aInfo, si_s3_sale, si_s3_auth))
+        if self.local_normalization:
+            # Step 4/5 - Merging and normalizing locally - total request count: 0, 1 for every part with unknown keys
+            print("Step 4/5 - Merging and normalizing the parts locally...")
+            
+            fallback_instructions = si_s5 if self.llm_fallback else None
+            normalized_parts = [
+                self.__checkpoint(mail_index, f"step5-{part_index}", lambda: step45Local(part, parsed_attachments, mail_index, part_index, fallback_instructions))
+                for part_index, part in enumerate(parts_data)
+            ]
+        elif self.workflow_mode == "batched":
+            # Step 4/5 - Merging and normalizing every part - total request count: 1
+            print("Step 4/5 - Merging and normalizing the parts...")
+            normalized_parts = self.__checkpoint(mail_index, "step45", lambda: step45(parts_data, parsed_attachments, mail_index, si_s45))
+        else:
+            # Step 4 - Merging json files - total request count: 1
+            print("Step 4 - Merging json files...")
+            
+            normalized_parts = []
+            
+            for part_index, part in enumerate(parts_data):
+                merged_info = self.__checkpoint(mail_index, f"step4-{part_index}", lambda: step4(part, parsed_attachments, si_s4))
+                
+                # Step 5 - Normalize the json data - total request count: 1
+                print(f"Step 5 - Normalizing the part-{part_index+1} data...")
+                normalized_parts.append(self.__checkpoint(mail_index, f"step5-{part_index}", lambda: step5(merged_info, mail_index, part_index, si_s5)))
         
-        # Step 4 - Merging json files - total request count: 1
-        print("Step 4 - Merging json files...")
+        if self.dedup_index is not None and all(len(normalized_info) > 0 for normalized_info in normalized_parts):
+            self.dedup_index.addEmail(mail_index, currentMail.body, parts_data, page_keys, normalized_parts)
         
-        for part in parts_data:
-            part_index = parts_data.index(part)
-            merged_info = step4(part, parsed_attachments, si_s4)
+        return self.__saveParts(mail_index, normalized_parts, email_save_folder)
+
+    def __splitKnownPages(self, attachments):
+        # pages seen before get their earlier results, only the new ones go to the model
+        known_documents = []
+        new_pages = []
+        
+        for attachment in attachments:
+            found = self.dedup_index.findPage(attachment)
             
-            # Step 5 - Normalize the json data - total request count: 1
-            print(f"Step 5 - Normalizing the part-{part_index+1} data...")
-            normalized_info = step5(merged_info, mail_index, part_index, si_s5)
+            if found is None:
+                new_pages.append(attachment)
+            elif found[0] is not None:
+                known_documents.append(records.DocumentRecord(attachment, FormType(found[0]), found[1]))
+        
+        reused_pages = len(attachments) - len(new_pages)
+        
+        if reused_pages > 0:
+            print(f"{reused_pages} of {len(attachments)} pages repeat earlier pages, their results are reused.")
+            metrics.increment("pages_reused", reused_pages)
+        
+        return known_documents, new_pages
+
+    def __mergeKnownPages(self, attachments, known_documents, parsed_attachments, new_pages):
+        # the new pages are remembered and the documents are put back in page order. a restored step can
+        # cover pages that were remembered before a crash, every page is taken once
+        documents = {document.page.name(): document for document in known_documents + parsed_attachments}
+        
+        for page in new_pages:
+            document = documents.get(page.name())
             
+            if document is not None:
+                # a form the model could not read is asked again next time
+                if len(document.info) > 0:
+                    self.dedup_index.addPage(page, document.type.value, document.info)
+            elif self.workflow_mode != "batched":
+                # a batch that could not be parsed leaves its pages out as well, only step2 says "Other-3" for sure
+                self.dedup_index.addPage(page)
+        
+        return [documents[attachment.name()] for attachment in attachments if attachment.name() in documents]
+
+    def __saveParts(self, mail_index, normalized_parts, email_save_folder: str):
+        saved_parts = 0
+        written = []
+        
+        for part_index, normalized_info in enumerate(normalized_parts):
             if len(normalized_info) == 0:
                 print(f"Part-{part_index+1} data could not be normalized. Skipping...")
                 continue
             
+            # parts saved before a crash are not written twice
+            if self.job_store is not None and self.job_store.load(mail_index, f"saved-{part_index}") is not None:
+                saved_parts += 1
+                continue
+            
+            # exact repeats of exported rows are left out
+            if self.dedup_index is not None and not self.dedup_index.reserveRow(normalized_info):
+                print(f"Part-{part_index+1} data was already exported. Skipping...")
+                metrics.increment("rows_deduplicated")
+                continue
+            
+            written.append(part_index)
+            
             print(f"Saving part-{part_index+1} data...")
-            saveAsCSV(normalized_info, f"e{mail_index}-p{part_index+1}.csv", email_save_folder)
             
+            try:
+                if self.result_sink is not None:
+                    with metrics.span("sinkWrite"):
+                        self.result_sink.write(normalized_info, mail_index, part_index+1)
+                else:
+                    saveAsCSV(normalized_info, f"e{mail_index}-p{part_index+1}.csv", email_save_folder)
+            except BaseException:
+                self.__releaseRows(normalized_parts, written)
+                raise
+        
+        if self.result_sink is not None and len(written) > 0 and (self.job_store is not None or self.dedup_index is not None):
+            # the sink only buffers, the rows are on disk before the job store or the dedup index count them as saved.
+            # a crash before this point writes them again on the next run. without either the sink keeps its batches
+            try:
+                with metrics.span("sinkFlush"):
+                    self.result_sink.flush()
+            except BaseException:
+                self.__releaseRows(normalized_parts, written)
+                raise
+        
+        for part_index in written:
+            if self.dedup_index is not None:
+                self.dedup_index.commitRow(normalized_parts[part_index], mail_index, part_index+1)
+            
+            if self.job_store is not None:
+                self.job_store.save(mail_index, f"saved-{part_index}")
+        
+        saved_parts += len(written)
+        
         print("Email-" + str(mail_index) + " has been processed successfully.")
         
+        return saved_parts
+
+    def __releaseRows(self, normalized_parts, written: list):
+        # rows that did not reach the disk are not counted as exported
+        if self.dedup_index is not None:
+            for part_index in written:
+                self.dedup_index.releaseRow(normalized_parts[part_index])
+
+    def getTotalEmailCount(self):
+        status, messages = self.__imap.search(None, "ALL")
+        self.total_email_count = len(messages[0].split())
+        return self.total_email_count
+
+    def fetchAndParse(self, mail_index, save_path_folder: str = "outputs", sleep_duration_after_finish: int = 10):
+        needs_fetch = self.__needsFetch(mail_index)
+        
+        if needs_fetch is False:
+            return
+        
+        raw_email = None
+        
+        if needs_fetch:
+            print("\nFetching email-" + str(mail_index) + "...") # log the fetching of the email
+            raw_email = self.__fetch_raw(mail_index)
+            
+            if raw_email is None:
+                return
+        
+        currentMail = self.__parseCheckpointed(mail_index, raw_email, save_path_folder)
+        
+        self.__runEmail(mail_index, currentMail, save_path_folder)
+        self.__flushSink()
+        
         sleep(sleep_duration_after_finish)
+
+    def __flushSink(self):
+        if self.result_sink is not None:
+            self.result_sink.flush()
+        
+        metrics.flushEvents()
+
+    def __workerIMAP(self):
+        # every fetch worker keeps its own connection, imaplib connections are not thread safe
+        imap = getattr(self.__worker_local, "imap", None)
+        
+        if imap is None:
+            imap = self.__openConnection()
+            imap.login(self.__username, self.__password)
+            imap.select(self.__mailbox)
+            
+            self.__worker_local.imap = imap
+            
+            with self.__worker_lock:
+                self.__worker_imaps.append(imap)
+        
+        return imap
+
+    def __closeWorkerIMAPs(self):
+        with self.__worker_lock:
+            for imap in self.__worker_imaps:
+                try:
+                    imap.close()
+                    imap.logout()
+                except Exception as e:
+                    print("Error closing worker IMAP connection - Error:", e)
+            
+            self.__worker_imaps = []
+            self.__worker_local = local()
+
+    def processRange(self, start: int, end: int, save_path_folder: str = "outputs", fetch_workers: int = 2, ocr_workers: int = 4, gemini_workers: int = 4, queue_size: int = 8):
+        # processes emails start..end (inclusive) with a worker pool per stage,
+        # bounded queues between the stages replace the fixed sleep after every email
+        def fetch(mail_index):
+            needs_fetch = self.__needsFetch(mail_index)
+            
+            if needs_fetch is False:
+                return
+            
+            if needs_fetch is None:
+                return (mail_index, None)
+            
+            print("\nFetching email-" + str(mail_index) + "...")
+            
+            raw_email = self.__fetch_raw(mail_index, imap=self.__workerIMAP())
+            
+            if raw_email is not None:
+                return (mail_index, raw_email)
+
+        def parse(item):
+            return (item[0], self.__parseCheckpointed(item[0], item[1], save_path_folder))
+
+        def process(item):
+            return (item[0], self.__runEmail(item[0], item[1], save_path_folder))
+
+        stages = [
+            Stage("fetch", fetch, fetch_workers),
+            Stage("ocr", parse, ocr_workers),
+            Stage("gemini", process, gemini_workers)
+        ]
+        
+        try:
+            results = runPipeline(range(start, end+1), stages, queue_size)
+        finally:
+            self.__closeWorkerIMAPs()
+            self.__flushSink()
+        
+        processed = dict(results)
+        
+        print(f"Processed {len(processed)} of {end-start+1} emails, {sum(processed.values())} parts saved.")
+        
+        return processed
+
+    def processAll(self, save_path_folder: str = "outputs", fetch_workers: int = 2, ocr_workers: int = 4, gemini_workers: int = 4, queue_size: int = 8):
+        return self.processRange(1, self.getTotalEmailCount(), save_path_folder, fetch_workers, ocr_workers, gemini_workers, queue_size)
+        
+    def getUIDValidity(self):
+        if self.__uidvalidity is None:
+            status, response = self.__imap.status(self.__mailbox, "(UIDVALIDITY)")
+            self.__uidvalidity = imapsync.parseStatus(response).get("UIDVALIDITY", 0)
+        
+        return self.__uidvalidity
+
+    def searchNewUIDs(self, last_uid: int = 0):
+        status, response = self.__imap.uid("SEARCH", None, f"UID {last_uid+1}:*")
+        
+        if status != "OK":
+            print("An error occurred while searching for new emails.")
+            return []
+        
+        # "n:*" always matches the newest message even when its uid is lower than n
+        return sorted(uid for uid in map(int, response[0].split()) if uid > last_uid)
+
+    def fetchStructures(self, uids: list, imap = None):
+        # a single round trip for the envelope and structure of every uid
+        if imap is None:
+            imap = self.__imap
+        
+        with metrics.span("fetchStructures"):
+            status, data = imap.uid("FETCH", imapsync.toUIDSet(uids), "(UID BODYSTRUCTURE ENVELOPE)")
+        
+        if status != "OK":
+            print("An error occurred while fetching the email structures.")
+            return None
+        
+        return {message["uid"]: message["meta"] for message in imapsync.groupFetchResponse(data)}
+
+    def fetchBodies(self, uids: list, imap = None):
+        if imap is None:
+            imap = self.__imap
+        
+        with metrics.span("fetch"):
+            status, data = imap.uid("FETCH", imapsync.toUIDSet(uids), "(UID RFC822)")
+        
+        if status != "OK":
+            print("An error occurred while fetching the email bodies.")
+            return None
+        
+        bodies = {message["uid"]: max(message["literals"], key=len) for message in imapsync.groupFetchResponse(data) if message["literals"]}
+        metrics.increment("bytes_fetched", sum(len(body) for body in bodies.values()))
+        
+        return bodies
+
+    def setConnectionPool(self, pool):
+        # with an imappool.IMAPConnectionPool the uid fetches borrow a connection of the pool
+        self.connection_pool = pool
+
+    def __fetchUIDs(self, uids: list, message_filter = None):
+        # ({uid: raw email} of the uids that pass the filter, [rejected uids]), None when the fetch failed.
+        # the filter sees only the structures
+        if self.connection_pool is None:
+            return self.__fetchUIDsWith(self.__imap, uids, message_filter)
+        
+        with self.connection_pool.acquire() as imap:
+            return self.__fetchUIDsWith(imap, uids, message_filter)
+
+    def __fetchUIDsWith(self, imap, uids: list, message_filter = None):
+        rejected = []
+        
+        if message_filter is not None and len(uids) > 0:
+            structures = self.fetchStructures(uids, imap)
+            
+            if structures is None:
+                return None
+            
+            rejected = [uid for uid in uids if uid in structures and not message_filter(uid, structures[uid])]
+            uids = [uid for uid in uids if uid in structures and uid not in rejected]
+        
+        if len(uids) == 0:
+            return ({}, rejected)
+        
+        bodies = self.fetchBodies(uids, imap)
+        
+        if bodies is None:
+            return None
+        
+        return (bodies, rejected)
+
+    def processUIDs(self, uids: list, save_path_folder: str = "outputs", message_filter = None, ocr_workers: int = 4, gemini_workers: int = 4, queue_size: int = 8, on_processed = None, fetch_size: int = 10):
+        # processes the given uids of the selected mailbox and returns {uid: saved parts} of the emails that finished,
+        # rejected ones with 0. a failed email is left out. on_processed(uid, saved_parts) is called for every finished one
+        def finish(uid, saved_parts):
+            if on_processed is not None:
+                on_processed(uid, saved_parts)
+            
+            return saved_parts
+
+        def parse(item):
+            return (item[0], self.__parseCheckpointed(uidKey(item[0]), item[1], save_path_folder))
+
+        def process(item):
+            return (item[0], finish(item[0], self.__runEmail(uidKey(item[0]), item[1], save_path_folder)))
+        
+        if message_filter is None and self.prefilter is not None:
+            message_filter = self.prefilter.acceptsStructure
+        
+        processed = {}
+        selected = []
+        
+        # emails finished by an earlier run are left out, stored ones skip the download
+        fetch_states = {uid: self.__needsFetch(uidKey(uid)) for uid in uids}
+        wanted = [uid for uid in uids if fetch_states[uid] is True]
+        
+        for uid in uids:
+            if fetch_states[uid] is False:
+                processed[uid] = finish(uid, self.job_store.load(uidKey(uid), "done")[0])
+        
+        def items():
+            # bodies are fetched fetch_size at a time while the pipeline drains, so only a few raw emails are held at once
+            for uid in uids:
+                if fetch_states[uid] is None:
+                    yield (uid, None)
+            
+            for group in imapsync.chunkList(wanted, fetch_size):
+                fetched = self.__fetchUIDs(group, message_filter)
+                
+                if fetched is None:
+                    print(f"{len(group)} emails could not be fetched, they are tried again next time.")
+                    continue
+                
+                bodies, rejected = fetched
+                selected.extend(bodies)
+                
+                # rejected emails count as done, so do the ones deleted since they were listed
+                for uid in group:
+                    if uid not in bodies:
+                        processed[uid] = finish(uid, self.__runEmail(uidKey(uid), None, save_path_folder))
+                
+                yield from sorted(bodies.items())
+        
+        stages = [
+            Stage("ocr", parse, ocr_workers),
+            Stage("gemini", process, gemini_workers)
+        ]
+        
+        # the pipeline returns after the feeder, the items generator, is done with processed
+        processed.update(runPipeline(items(), stages, queue_size))
+        
+        if message_filter is not None and len(wanted) > 0:
+            print(f"{len(selected)} of {len(wanted)} emails selected for processing.")
+        
+        self.__flushSink()
+        
+        return processed
+
+    def syncNew(self, save_path_folder: str = "outputs", state_path: str = None, chunk_size: int = 100, message_filter = None, ocr_workers: int = 4, gemini_workers: int = 4, queue_size: int = 8, max_attempts: int = 3):
+        # processes only the mail that arrived since the last run, emails are identified by uid.
+        # message_filter(uid, structure) can reject messages before their bodies are downloaded.
+        # an email that fails max_attempts runs is recorded as failed and the sync moves past it
+        if state_path is None:
+            state_path = os.path.join(save_path_folder, "sync_state.json")
+        
+        state = imapsync.loadSyncState(state_path)
+        mailbox_state = imapsync.getMailboxState(state, self.__mailbox, self.getUIDValidity())
+        
+        # emails above the high-water mark that finished already, and the failed runs of the ones that did not
+        finished = set(mailbox_state.setdefault("finished", []))
+        attempts = mailbox_state.setdefault("attempts", {})
+        failed = mailbox_state.setdefault("failed", [])
+        
+        uids = self.searchNewUIDs(mailbox_state["last_uid"])
+        listed = set(uids)
+        pending = [uid for uid in uids if uid not in finished]
+        
+        print(f"Total {len(pending)} new emails found in {self.__mailbox}.")
+        
+        processed = {}
+        
+        for chunk in imapsync.chunkList(pending, chunk_size):
+            processed.update(self.processUIDs(chunk, save_path_folder, message_filter, ocr_workers, gemini_workers, queue_size))
+            
+            for uid in chunk:
+                if uid in processed:
+                    finished.add(uid)
+                    attempts.pop(str(uid), None)
+                    continue
+                
+                attempts[str(uid)] = attempts.get(str(uid), 0) + 1
+                
+                if attempts[str(uid)] >= max_attempts:
+                    print(f"Email uid {uid} failed {attempts[str(uid)]} times, it is recorded as failed and skipped.")
+                    attempts.pop(str(uid))
+                    failed.append(uid)
+                    finished.add(uid)
+                else:
+                    print(f"Email uid {uid} did not finish, it is tried again next time ({attempts[str(uid)]}/{max_attempts}).")
+            
+            # the high-water mark moves up to the first email that did not finish, the ones after it are remembered
+            for uid in uids:
+                if uid not in finished:
+                    break
+                
+                mailbox_state["last_uid"] = uid
+            
+            finished = {uid for uid in finished if uid > mailbox_state["last_uid"]}
+            mailbox_state["finished"] = sorted(finished)
+            
+            # emails deleted from the mailbox are not tried again
+            for key in [key for key in attempts if int(key) not in listed]:
+                attempts.pop(key)
+            
+            imapsync.saveSyncState(state, state_path)
+        
+        return processed
         
     def selectMailbox(self, mailbox: str):
         self.__imap.select(mailbox)
+        self.__mailbox = mailbox
+        
+        # UIDVALIDITY is sent with the SELECT response
+        status, response = self.__imap.response("UIDVALIDITY")
+        self.__uidvalidity = int(response[0]) if response and response[0] else None
         
         print("Selecting mailbox " + mailbox + "...")
         
@@ -389,6 +1383,10 @@ class EmailClient:
         self.__imap.login(username, password)
         self.isLogged_in = True
         
+        # kept so the batch workers can open their own connections
+        self.__username = username
+        self.__password = password
+        
         print("Logging in to email client...")
         
     def setCurrentEmail(self, num: int):
@@ -396,8 +1394,20 @@ class EmailClient:
         
         print("Setting current email index to " + str(num) + "...")
         
-    def connectIMAP(self, imap_server: str, imap_ssl_port: int = 993):
-        self.__imap = imaplib.IMAP4_SSL(imap_server, imap_ssl_port)
+    def __openConnection(self):
+        # plain connections are only meant for local servers like the benchmark mailbox
+        if self.__use_ssl:
+            return imaplib.IMAP4_SSL(self.__imap_server, self.__imap_ssl_port)
+        
+        return imaplib.IMAP4(self.__imap_server, self.__imap_ssl_port)
+
+    def connectIMAP(self, imap_server: str, imap_ssl_port: int = 993, use_ssl: bool = True):
+        self.__imap_server = imap_server
+        self.__imap_ssl_port = imap_ssl_port
+        self.__use_ssl = use_ssl
+        self.__imap = self.__openConnection()
+        self.__mailbox = "INBOX"
+        self.__uidvalidity = None
         
         print("Connecting to IMAP server " + imap_server + "...")
 
@@ -0,0 +1,459 @@
+import os
+import json
+import socket
+import imaplib
+import sqlite3
+import argparse
+from time import time
+from threading import Thread, Event, Lock
+
+import client
+import gemini
+import imapsync
+import prefilter
+from sinks import createSink
+from dedup import DedupIndex
+from imappool import IMAPConnectionPool
+from jobstore import JobStore
+
+# options of the workers' email clients, an account can set its own in the accounts file
+CLIENT_OPTIONS = ["workflow", "pages_per_call", "local_normalization", "sink", "prefilter", "dedup"]
+
+# the files of an account folder can be shared by workers on several hosts
+SHARED_JOURNAL_MODE = "DELETE"
+
+def loadAccounts(path: str):
+    # a json list of {"name", "imap_server", "username", ...}, "password_env" names the variable holding the password
+    with open(path, 'r') as file:
+        accounts = json.load(file)
+
+    result = {}
+
+    for account in accounts:
+        account = dict(account)
+
+        if "password" not in account and "password_env" in account:
+            account["password"] = os.getenv(account["password_env"], "")
+
+        # an account can bring its own Gemini key, the worker's key is used otherwise
+        if "google_api_key" not in account and "google_api_key_env" in account:
+            account["google_api_key"] = os.getenv(account["google_api_key_env"])
+
+        account.setdefault("imap_port", 993)
+        account.setdefault("use_ssl", True)
+        account.setdefault("mailbox", "INBOX")
+        account.setdefault("max_connections", 4)
+
+        result[account["name"]] = account
+
+    return result
+
+def createPool(account: dict):
+    return IMAPConnectionPool(account["imap_server"], account["username"], account["password"], account["mailbox"], account["imap_port"], account["use_ssl"], account["max_connections"])
+
+class LeaseStore:
+    # shards of (account, uids) handed out to workers under time limited leases.
+    # sqlite locks the file for every claim, so workers in several processes can share it, on other hosts
+    # through a network filesystem with working locks. WAL only works on one host, the store keeps a rollback journal
+    def __init__(self, path: str = "outputs/leases.db", max_attempts: int = 3):
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.max_attempts = max_attempts
+
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=DELETE")
+
+        with self.__lock:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS accounts (account TEXT PRIMARY KEY, uidvalidity INTEGER, last_uid INTEGER)")
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY AUTOINCREMENT, account TEXT, uids TEXT, status TEXT, worker TEXT, "
+                "lease_expires REAL, attempts INTEGER DEFAULT 0, error TEXT, updated REAL)"
+            )
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS emails (account TEXT, uid INTEGER, status TEXT, worker TEXT, saved_parts INTEGER, updated REAL, PRIMARY KEY (account, uid))")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS shards_status ON shards (status, lease_expires)")
+
+    def __transaction(self, statements):
+        # BEGIN IMMEDIATE takes the write lock up front, two workers can never claim the same shard
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+
+            try:
+                result = statements(self.__connection)
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                raise
+
+            self.__connection.execute("COMMIT")
+
+        return result
+
+    def getAccountState(self, account: str):
+        with self.__lock:
+            row = self.__connection.execute("SELECT uidvalidity, last_uid FROM accounts WHERE account = ?", (account,)).fetchone()
+
+        return {"uidvalidity": row[0], "last_uid": row[1]} if row else None
+
+    def addShards(self, account: str, uidvalidity: int, uids: list, shard_size: int = 50):
+        # a changed UIDVALIDITY makes the old uids meaningless, the account starts over
+        def statements(connection):
+            row = connection.execute("SELECT uidvalidity, last_uid FROM accounts WHERE account = ?", (account,)).fetchone()
+
+            if row is not None and row[0] != uidvalidity:
+                connection.execute("DELETE FROM shards WHERE account = ?", (account,))
+                connection.execute("DELETE FROM emails WHERE account = ?", (account,))
+                row = None
+
+            last_uid = row[1] if row is not None else 0
+            new_uids = sorted(uid for uid in uids if uid > last_uid)
+
+            for chunk in imapsync.chunkList(new_uids, shard_size):
+                connection.execute("INSERT INTO shards (account, uids, status, updated) VALUES (?, ?, 'pending', ?)", (account, imapsync.toUIDSet(chunk), time()))
+
+            connection.execute(
+                "INSERT INTO accounts (account, uidvalidity, last_uid) VALUES (?, ?, ?) ON CONFLICT(account) DO UPDATE SET uidvalidity=excluded.uidvalidity, last_uid=excluded.last_uid",
+                (account, uidvalidity, max(new_uids[-1] if new_uids else 0, last_uid))
+            )
+
+            return len(new_uids)
+
+        return self.__transaction(statements)
+
+    def claim(self, worker: str, lease_seconds: float = 300, accounts: list = None):
+        # the oldest pending shard or one whose lease ran out, None when there is no work
+        def statements(connection):
+            now = time()
+
+            # shards that ran out of attempts while leased are given up
+            connection.execute("UPDATE shards SET status = 'failed', error = 'lease expired', updated = ? WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+
+            query = "SELECT id, account, uids, attempts FROM shards WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?"
+            parameters = [now, self.max_attempts]
+
+            if accounts:
+                query += " AND account IN (" + ",".join("?" for _ in accounts) + ")"
+                parameters += list(accounts)
+
+            row = connection.execute(query + " ORDER BY id LIMIT 1", parameters).fetchone()
+
+            if row is None:
+                return None
+
+            connection.execute("UPDATE shards SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?", (worker, now + lease_seconds, now, row[0]))
+
+            uids = imapsync.fromUIDSet(row[2])
+            done = {uid for (uid,) in connection.execute("SELECT uid FROM emails WHERE account = ? AND status = 'done' AND uid BETWEEN ? AND ?", (row[1], uids[0], uids[-1]))}
+
+            # emails acknowledged under an earlier lease are not handed out again
+            return {"id": row[0], "account": row[1], "uids": [uid for uid in uids if uid not in done], "attempt": row[3] + 1}
+
+        return self.__transaction(statements)
+
+    def heartbeat(self, shard: dict, worker: str, lease_seconds: float = 300):
+        # extends the lease, False when it expired and another worker took the shard
+        def statements(connection):
+            cursor = connection.execute("UPDATE shards SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'", (time() + lease_seconds, time(), shard["id"], worker))
+            return cursor.rowcount == 1
+
+        return self.__transaction(statements)
+
+    def ack(self, shard: dict, worker: str, uid: int, saved_parts: int = 0):
+        def statements(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO emails (account, uid, status, worker, saved_parts, updated) VALUES (?, ?, 'done', ?, ?, ?)",
+                (shard["account"], uid, worker, saved_parts, time())
+            )
+
+        self.__transaction(statements)
+
+    def complete(self, shard: dict, worker: str):
+        def statements(connection):
+            cursor = connection.execute("UPDATE shards SET status = 'done', lease_expires = NULL, updated = ? WHERE id = ? AND worker = ?", (time(), shard["id"], worker))
+            return cursor.rowcount == 1
+
+        return self.__transaction(statements)
+
+    def fail(self, shard: dict, worker: str, error: str):
+        # back to pending for another worker, failed for good after max_attempts
+        def statements(connection):
+            connection.execute(
+                "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND worker = ?",
+                (self.max_attempts, error, time(), shard["id"], worker)
+            )
+
+        self.__transaction(statements)
+
+    def getProgress(self):
+        # {account: {status: shard count}}
+        with self.__lock:
+            rows = self.__connection.execute("SELECT account, status, COUNT(*) FROM shards GROUP BY account, status").fetchall()
+
+        progress = {}
+
+        for account, status, count in rows:
+            progress.setdefault(account, {})[status] = count
+
+        return progress
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+class Coordinator:
+    # finds the new mail of every account and splits it into shards
+    def __init__(self, store: LeaseStore, accounts: dict, shard_size: int = 50):
+        self.store = store
+        self.accounts = accounts
+        self.shard_size = shard_size
+
+    def discoverAccount(self, account: dict):
+        pool = createPool(dict(account, max_connections=1))
+
+        try:
+            with pool.acquire() as imap:
+                status, response = imap.status(account["mailbox"], "(UIDVALIDITY)")
+                uidvalidity = imapsync.parseStatus(response).get("UIDVALIDITY", 0)
+
+                state = self.store.getAccountState(account["name"])
+                last_uid = state["last_uid"] if state is not None and state["uidvalidity"] == uidvalidity else 0
+
+                status, response = imap.uid("SEARCH", None, f"UID {last_uid+1}:*")
+                uids = [uid for uid in map(int, response[0].split()) if uid > last_uid] if status == "OK" else []
+        finally:
+            pool.close()
+
+        added = self.store.addShards(account["name"], uidvalidity, uids, self.shard_size)
+
+        print(f"{account['name']}: {added} new emails queued.")
+
+        return added
+
+    def discover(self):
+        added = 0
+
+        for account in self.accounts.values():
+            try:
+                added += self.discoverAccount(account)
+            except (imaplib.IMAP4.error, OSError) as e:
+                print(f"{account['name']}: new emails could not be listed - Error:", e)
+
+        return added
+
+class Worker:
+    # claims shards, processes their emails and acknowledges every finished one
+    def __init__(self, store: LeaseStore, accounts: dict, worker_id: str = None, save_path_folder: str = "outputs", lease_seconds: float = 300, heartbeat_seconds: float = 60, ocr_workers: int = 4, gemini_workers: int = 4, queue_size: int = 8, google_api_key: str = None, client_options: dict = None):
+        self.store = store
+        self.accounts = accounts
+        self.google_api_key = google_api_key
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.save_path_folder = save_path_folder
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+
+        self.ocr_workers = ocr_workers
+        self.gemini_workers = gemini_workers
+        self.queue_size = queue_size
+        self.client_options = client_options or {}
+
+        self.__clients = {}
+        self.__stop = Event()
+        self.__gemini_key = None
+
+    def configureClient(self, email_client, account: dict):
+        # called once for every new client with the worker's options, overridden by the ones of the account
+        options = dict(self.client_options, **{key: account[key] for key in CLIENT_OPTIONS if key in account})
+        folder = os.path.join(self.save_path_folder, account["name"])
+
+        email_client.setWorkflowMode(options.get("workflow", "per_step"), options.get("pages_per_call", 4))
+        email_client.setLocalNormalization(options.get("local_normalization", False))
+
+        if options.get("sink"):
+            email_client.setResultSink(createSink(self.__sinkPath(folder, options["sink"])))
+
+        # true for the default filter or the keyword arguments of prefilter.PreFilter
+        if options.get("prefilter"):
+            email_client.setPreFilter(prefilter.PreFilter(**options["prefilter"]) if isinstance(options["prefilter"], dict) else prefilter.PreFilter())
+
+        if options.get("dedup"):
+            email_client.setDedupIndex(DedupIndex(os.path.join(folder, "dedup.db"), SHARED_JOURNAL_MODE))
+
+    def __sinkPath(self, folder: str, name: str):
+        # csv, ndjson and sqlite files take rows from every worker, a parquet file has one writer
+        if os.path.splitext(name)[1].lower() == ".parquet":
+            name = f"{os.path.splitext(name)[0]}-{self.worker_id}.parquet"
+
+        return os.path.join(folder, name)
+
+    def __client(self, account_name: str):
+        # one client per account, its emails are fetched through the account's connection pool
+        email_client = self.__clients.get(account_name)
+
+        if email_client is None:
+            account = self.accounts[account_name]
+            folder = os.path.join(self.save_path_folder, account_name)
+
+            email_client = client.EmailClient()
+            email_client.setConnectionPool(createPool(account))
+            email_client.setJobStore(JobStore(os.path.join(folder, "jobs.db"), SHARED_JOURNAL_MODE))
+            self.configureClient(email_client, account)
+
+            self.__clients[account_name] = email_client
+
+        return email_client
+
+    def __checkGeminiKey(self, account: dict):
+        if not (account.get("google_api_key") or self.google_api_key or gemini.hasClient()):
+            raise ValueError(f"No Gemini API key for {account['name']}, set GOOGLE_API_KEY or google_api_key_env.")
+
+    def __connectGemini(self, key: str):
+        # the gemini module holds one client, shards are processed one at a time so it is switched per account.
+        # without any key the client set through gemini.setClient is used
+        if key is not None and key != self.__gemini_key:
+            print(gemini.connectToGemini(key))
+            self.__gemini_key = key
+
+    def __heartbeat(self, shard: dict, finished: Event, lost: Event):
+        while not finished.wait(self.heartbeat_seconds):
+            if not self.store.heartbeat(shard, self.worker_id, self.lease_seconds):
+                print(f"Lease of shard {shard['id']} was lost, another worker owns it now.")
+                lost.set()
+                return
+
+    def processShard(self, shard: dict):
+        email_client = self.__client(shard["account"])
+        folder = os.path.join(self.save_path_folder, shard["account"])
+
+        account = self.accounts[shard["account"]]
+
+        self.__checkGeminiKey(account)
+        self.__connectGemini(account.get("google_api_key") or self.google_api_key)
+
+        finished = Event()
+        lost = Event()
+
+        heartbeat = Thread(target=self.__heartbeat, args=(shard, finished, lost), daemon=True)
+        heartbeat.start()
+
+        def acknowledge(uid, saved_parts):
+            # a worker that lost the lease keeps going, the job store keeps the work from being done twice
+            self.store.ack(shard, self.worker_id, uid, saved_parts)
+
+        try:
+            processed = email_client.processUIDs(shard["uids"], folder, None, self.ocr_workers, self.gemini_workers, self.queue_size, acknowledge)
+        except Exception as e:
+            self.store.fail(shard, self.worker_id, str(e))
+            raise
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        if lost.is_set():
+            return processed
+
+        # the pipeline reports failed emails only by leaving them out, the shard goes back with the ones not acknowledged
+        unfinished = [uid for uid in shard["uids"] if uid not in processed]
+
+        if len(unfinished) > 0:
+            self.store.fail(shard, self.worker_id, f"{len(unfinished)} of {len(shard['uids'])} emails did not finish, first uid {unfinished[0]}")
+            print(f"Shard {shard['id']}: {len(unfinished)} emails did not finish, the shard is retried until it runs out of attempts.")
+        else:
+            self.store.complete(shard, self.worker_id)
+
+        return processed
+
+    def run(self, poll_seconds: float = 30, exit_when_idle: bool = True):
+        print(f"Worker {self.worker_id} started.")
+
+        # a missing key fails here, not for every email of the first shard
+        for account in self.accounts.values():
+            self.__checkGeminiKey(account)
+
+        self.__connectGemini(self.google_api_key)
+
+        while not self.__stop.is_set():
+            shard = self.store.claim(self.worker_id, self.lease_seconds, list(self.accounts.keys()))
+
+            if shard is None:
+                if exit_when_idle:
+                    break
+
+                self.__stop.wait(poll_seconds)
+                continue
+
+            print(f"Worker {self.worker_id} claimed shard {shard['id']} of {shard['account']} with {len(shard['uids'])} emails.")
+
+            try:
+                self.processShard(shard)
+            except Exception as e:
+                print(f"Shard {shard['id']} failed - Error:", e)
+
+        self.close()
+
+    def stop(self):
+        self.__stop.set()
+
+    def close(self):
+        for email_client in self.__clients.values():
+            email_client.connection_pool.close()
+            email_client.job_store.close()
+
+            if email_client.result_sink is not None:
+                email_client.result_sink.close()
+
+            if email_client.dedup_index is not None:
+                email_client.dedup_index.close()
+
+        self.__clients = {}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shards the mail of several accounts over workers on one or many hosts.")
+    parser.add_argument("command", choices=["discover", "work", "progress"])
+    parser.add_argument("accounts", help="json file with the accounts")
+    parser.add_argument("--store", default="outputs/leases.db")
+    parser.add_argument("--output", default="outputs")
+    parser.add_argument("--shard-size", type=int, default=50)
+    parser.add_argument("--lease-seconds", type=float, default=300)
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--keep-polling", action="store_true", help="wait for new shards instead of exiting when there is no work")
+    parser.add_argument("--tesseract-path", default=os.getenv("TESSERACT_PATH"), help="the tesseract executable, ./tesseract/tesseract.exe when it exists")
+    parser.add_argument("--workflow", choices=["per_step", "batched"], default="per_step")
+    parser.add_argument("--pages-per-call", type=int, default=4)
+    parser.add_argument("--local-normalization", action="store_true")
+    parser.add_argument("--sink", default=None, help="result file in every account folder, the extension picks the sink (.csv, .ndjson, .db, .parquet); one csv per part without it")
+    parser.add_argument("--prefilter", action="store_true", help="skips emails and pages with the default pre-filter")
+    parser.add_argument("--dedup", action="store_true", help="keeps a dedup index in every account folder")
+    arguments = parser.parse_args()
+
+    store = LeaseStore(arguments.store)
+    accounts = loadAccounts(arguments.accounts)
+
+    if arguments.command == "discover":
+        Coordinator(store, accounts, arguments.shard_size).discover()
+    elif arguments.command == "work":
+        tesseract_path = arguments.tesseract_path
+
+        if tesseract_path is None and os.path.exists("./tesseract/tesseract.exe"):
+            tesseract_path = "./tesseract/tesseract.exe"
+
+        if tesseract_path is not None:
+            client.setTesseractPath(tesseract_path)
+
+        client_options = {
+            "workflow": arguments.workflow,
+            "pages_per_call": arguments.pages_per_call,
+            "local_normalization": arguments.local_normalization,
+            "sink": arguments.sink,
+            "prefilter": arguments.prefilter,
+            "dedup": arguments.dedup
+        }
+
+        worker = Worker(store, accounts, arguments.worker_id, arguments.output, arguments.lease_seconds, arguments.lease_seconds / 5, google_api_key=os.getenv("GOOGLE_API_KEY"), client_options=client_options)
+        worker.run(exit_when_idle=not arguments.keep_polling)
+    else:
+        print(json.dumps(store.getProgress(), indent=2))
+
+    store.close()
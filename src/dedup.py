@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import random
+import struct
+import sqlite3
+import hashlib
+from time import time
+from threading import Lock
+
+# minhash over word 3-grams, 64 permutations split into 16 lsh bands of 4 rows
+SHINGLE_SIZE = 3
+PERMUTATIONS = 64
+BANDS = 16
+MERSENNE_PRIME = (1 << 61) - 1
+
+# pages are only taken as duplicates when every number on them is the same, a quote for the
+# same part on the same template with a different price must never reuse the old extraction
+PAGE_TEXT_SIMILARITY = 0.9
+PAGE_HASH_DISTANCE = 10
+EMAIL_BODY_SIMILARITY = 0.9
+MAX_CANDIDATES = 50
+
+__generator = random.Random(20240601)
+__permutations = [(__generator.randrange(1, MERSENNE_PRIME), __generator.randrange(0, MERSENNE_PRIME)) for _ in range(PERMUTATIONS)]
+__word_pattern = re.compile(r'[a-z0-9]+')
+__number_pattern = re.compile(r'\d+(?:[.,]\d+)*')
+
+def hash64(data: bytes):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+def toSigned(value: int):
+    # sqlite integers are signed 64 bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def normalizeText(text: str):
+    return " ".join(__word_pattern.findall((text or "").lower()))
+
+def textKey(text: str):
+    return hashlib.sha256(normalizeText(text).encode('utf-8')).hexdigest()
+
+def numbersKey(text: str):
+    # every number on the page in order, ocr noise in the words does not change it
+    return hashlib.sha256(" ".join(__number_pattern.findall(text or "")).encode('utf-8')).hexdigest()
+
+def pageKey(page):
+    # what an email-level match compares its pages by
+    return numbersKey(page.text)
+
+def shingles(text: str):
+    words = normalizeText(text).split()
+
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+
+    return {" ".join(words[i:i+SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minHash(text: str):
+    # None for texts without words, they can not be compared
+    hashes = [hash64(shingle.encode('utf-8')) for shingle in shingles(text)]
+
+    if len(hashes) == 0:
+        return None
+
+    return [min((a * h + b) % MERSENNE_PRIME for h in hashes) & 0xffffffff for a, b in __permutations]
+
+def similarity(signature: list, other: list):
+    # estimated jaccard similarity of the two shingle sets
+    if signature is None or other is None:
+        return 0.0
+
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+def bandKeys(signature: list):
+    rows = PERMUTATIONS // BANDS
+    return [toSigned(hash64(struct.pack(f"<{rows}I", *signature[band*rows:(band+1)*rows]))) for band in range(BANDS)]
+
+def packSignature(signature: list):
+    return struct.pack(f"<{PERMUTATIONS}I", *signature) if signature is not None else None
+
+def unpackSignature(data: bytes):
+    return list(struct.unpack(f"<{PERMUTATIONS}I", data)) if data is not None else None
+
+def imageHash(image):
+    # 64 bit difference hash, survives re-rendering, rescaling and recompression of the same page
+    small = image.convert("L").resize((9, 8), reducing_gap=2.0)
+    pixels = list(small.getdata())
+
+    value = 0
+
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (1 if pixels[row*9 + column] > pixels[row*9 + column + 1] else 0)
+
+    return value
+
+def hashChunks(value: int):
+    # 4 chunks of 16 bits, two hashes within 3 bits share at least one chunk
+    return [(value >> (16 * i)) & 0xffff for i in range(4)]
+
+def hammingDistance(value: int, other: int):
+    return bin(value ^ other).count("1")
+
+def rowKey(values: dict):
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class DedupIndex:
+    # remembers pages, emails and exported rows so repeated quotes are not processed again.
+    # lookups only touch indexed candidates, the tables can hold millions of pages
+    def __init__(self, path: str = "outputs/dedup.db", journal_mode: str = "WAL"):
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+
+        self.reused_pages = 0
+        self.reused_emails = 0
+        self.skipped_rows = 0
+
+        self.__lock = Lock()
+        self.__pending = set() # row keys reserved by a write that is not finished
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # WAL needs every process on one host, stores shared over a network filesystem use "DELETE"
+        self.__connection.execute(f"PRAGMA journal_mode={journal_mode}")
+
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS pages (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT, name TEXT, image_hash INTEGER, text_key TEXT, numbers_key TEXT, signature BLOB, form_type INTEGER, info TEXT, created REAL)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS page_hash_chunks (chunk INTEGER, value INTEGER, page_id INTEGER)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS page_bands (band INTEGER, key INTEGER, page_id INTEGER)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS emails (email TEXT PRIMARY KEY, signature BLOB, parts_key TEXT, pages TEXT, normalized TEXT, created REAL)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS email_bands (band INTEGER, key INTEGER, email TEXT)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS rows (row_key TEXT PRIMARY KEY, email TEXT, part INTEGER, created REAL)")
+
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS pages_text_key ON pages (text_key)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS page_hash_chunks_value ON page_hash_chunks (chunk, value)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS page_bands_key ON page_bands (band, key)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS email_bands_key ON email_bands (band, key)")
+
+    def __query(self, sql: str, parameters = ()):
+        with self.__lock:
+            return self.__connection.execute(sql, parameters).fetchall()
+
+    def hashPage(self, page):
+        # the image hash is taken while the bitmap is still in memory
+        if page.image_hash is None and page.hasImage():
+            page.image_hash = imageHash(page.loadImage())
+
+        return page.image_hash
+
+    def __pageCandidates(self, image_hash, text_key: str, signature: list):
+        # the stored pages sharing the text, an image hash chunk or a text band, fetched in one query.
+        # every lookup is limited so a common page can not pull in thousands of rows
+        lookups = ["SELECT id FROM (SELECT id FROM pages WHERE text_key = ? LIMIT ?)"]
+        parameters = [text_key, MAX_CANDIDATES]
+
+        if image_hash is not None:
+            for chunk, value in enumerate(hashChunks(image_hash)):
+                lookups.append("SELECT page_id FROM (SELECT page_id FROM page_hash_chunks WHERE chunk = ? AND value = ? LIMIT ?)")
+                parameters += [chunk, value, MAX_CANDIDATES]
+
+        if signature is not None:
+            for band, key in enumerate(bandKeys(signature)):
+                lookups.append("SELECT page_id FROM (SELECT page_id FROM page_bands WHERE band = ? AND key = ? LIMIT ?)")
+                parameters += [band, key, MAX_CANDIDATES]
+
+        rows = self.__query("SELECT image_hash, text_key, numbers_key, signature, form_type, info FROM pages WHERE id IN (" + " UNION ".join(lookups) + ") ORDER BY id", parameters)
+
+        # exact text matches are looked at first
+        return sorted(rows, key=lambda row: row[1] != text_key)
+
+    def findPage(self, page):
+        # (form_type, info) of an earlier page with the same content, form_type is None for "Other-3" pages.
+        # None when the page was not seen before
+        image_hash = self.hashPage(page)
+        text_key = textKey(page.text)
+        numbers_key = numbersKey(page.text)
+        signature = minHash(page.text)
+
+        for other_hash, other_text_key, other_numbers_key, other_signature, form_type, info in self.__pageCandidates(image_hash, text_key, signature):
+
+            if other_numbers_key != numbers_key:
+                continue
+
+            same_text = other_text_key == text_key or similarity(signature, unpackSignature(other_signature)) >= PAGE_TEXT_SIMILARITY
+            if image_hash is not None and other_hash is not None:
+                same_image = hammingDistance(image_hash, other_hash & 0xffffffffffffffff) <= PAGE_HASH_DISTANCE
+            else:
+                # pages without words are only matched by their image
+                same_image = signature is not None
+
+            if same_text and same_image:
+                self.reused_pages += 1
+                return (form_type, json.loads(info) if info else {})
+
+        return None
+
+    def addPage(self, page, form_type: int = None, info: dict = None):
+        image_hash = self.hashPage(page)
+        signature = minHash(page.text)
+
+        with self.__lock, self.__connection:
+            cursor = self.__connection.execute(
+                "INSERT INTO pages (email, name, image_hash, text_key, numbers_key, signature, form_type, info, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(page.email), page.name(), toSigned(image_hash) if image_hash is not None else None, textKey(page.text), numbersKey(page.text), packSignature(signature), form_type, json.dumps(info) if info else None, time())
+            )
+            page_id = cursor.lastrowid
+
+            if image_hash is not None:
+                self.__connection.executemany("INSERT INTO page_hash_chunks (chunk, value, page_id) VALUES (?, ?, ?)", [(chunk, value, page_id) for chunk, value in enumerate(hashChunks(image_hash))])
+
+            if signature is not None:
+                self.__connection.executemany("INSERT INTO page_bands (band, key, page_id) VALUES (?, ?, ?)", [(band, key, page_id) for band, key in enumerate(bandKeys(signature))])
+
+    def findEmail(self, body: str, parts: list, page_keys: list):
+        # the normalized parts of an earlier email with nearly the same body, the same parts and the same pages
+        signature = minHash(body)
+
+        if signature is None:
+            return None
+
+        parts_key = rowKey(parts)
+        pages = json.dumps(sorted(page_keys))
+
+        lookups = []
+        parameters = [parts_key, pages]
+
+        for band, key in enumerate(bandKeys(signature)):
+            lookups.append("SELECT email FROM (SELECT email FROM email_bands WHERE band = ? AND key = ? LIMIT ?)")
+            parameters += [band, key, MAX_CANDIDATES]
+
+        # only candidates with the same parts and pages are read
+        rows = self.__query("SELECT signature, normalized FROM emails WHERE parts_key = ? AND pages = ? AND email IN (" + " UNION ".join(lookups) + ")", parameters)
+
+        for other_signature, normalized in rows:
+            if similarity(signature, unpackSignature(other_signature)) >= EMAIL_BODY_SIMILARITY:
+                self.reused_emails += 1
+                return json.loads(normalized)
+
+        return None
+
+    def addEmail(self, mail_index, body: str, parts: list, page_keys: list, normalized_parts: list):
+        signature = minHash(body)
+
+        if signature is None:
+            return
+
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO emails (email, signature, parts_key, pages, normalized, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (str(mail_index), packSignature(signature), rowKey(parts), json.dumps(sorted(page_keys)), json.dumps(normalized_parts), time())
+            )
+            self.__connection.execute("DELETE FROM email_bands WHERE email = ?", (str(mail_index),))
+            self.__connection.executemany("INSERT INTO email_bands (band, key, email) VALUES (?, ?, ?)", [(band, key, str(mail_index)) for band, key in enumerate(bandKeys(signature))])
+
+    def reserveRow(self, values: dict):
+        # True for a new row, False for an exact duplicate of an exported row or of one being written.
+        # the reservation lives in memory until commitRow records the row as exported or releaseRow drops it,
+        # a crash in between leaves nothing behind and the row is written again
+        key = rowKey(values)
+
+        with self.__lock:
+            if key in self.__pending or self.__connection.execute("SELECT 1 FROM rows WHERE row_key = ?", (key,)).fetchone() is not None:
+                self.skipped_rows += 1
+                return False
+
+            self.__pending.add(key)
+
+        return True
+
+    def commitRow(self, values: dict, mail_index, part_index: int):
+        # called once the row is on disk
+        key = rowKey(values)
+
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR IGNORE INTO rows (row_key, email, part, created) VALUES (?, ?, ?, ?)", (key, str(mail_index), part_index, time()))
+            self.__pending.discard(key)
+
+    def releaseRow(self, values: dict):
+        with self.__lock:
+            self.__pending.discard(rowKey(values))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
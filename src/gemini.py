@@ -1,75 +1,359 @@
-from time import sleep
+import random
+from time import sleep, monotonic
+from threading import Lock
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from google.api_core.exceptions import ResourceExhausted
 
-__ai_model = {}
+import cache
+import metrics
 
-def connectToGemini(google_api_key: str, model_name: str = "gemini-1.5-flash"):
+__client = {}
+
+# rough token cost of the inputs, the real usage is settled after every response
+CHARACTERS_PER_TOKEN = 4
+TOKENS_PER_IMAGE = 258
+
+def createModel(google_api_key: str, model_name: str = "gemini-1.5-flash"):
     genai.configure(api_key=google_api_key)
-    
+
     safety_settings = {
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
     }
-    
-    __ai_model['model'] = genai.GenerativeModel(model_name=model_name, safety_settings=safety_settings)
-    __ai_model['generation_config'] = genai.GenerationConfig(
+
+    return genai.GenerativeModel(model_name=model_name, safety_settings=safety_settings)
+
+def defaultGenerationConfig():
+    return genai.GenerationConfig(
         max_output_tokens=2048,
         temperature=0.5,
         top_p=0.9,
         top_k=40
     )
-    
-    __ai_model['total_requests'] = 0
-    __ai_model['current_requests'] = 0
-    __ai_model['system_instructions'] = ""
-    
+
+def jsonGenerationConfig(response_schema: dict = None, max_output_tokens: int = 8192):
+    # constrains the reply to json, and to the given schema when there is one
+    return genai.GenerationConfig(
+        max_output_tokens=max_output_tokens,
+        temperature=0.5,
+        top_p=0.9,
+        top_k=40,
+        response_mime_type="application/json",
+        response_schema=response_schema
+    )
+
+def buildContent(prompt: str, images = [], system_instructions: str = ""):
+    content = [
+        "System Instructions: " + system_instructions,
+        "Prompt: " + prompt + " "
+    ]
+
+    for image in images:
+        content.append(image)
+
+    return content
+
+def countUsage(response):
+    # prompt and reply tokens of a response, streamed replies carry them on the last chunk
+    usage = getattr(response, "usage_metadata", None)
+
+    if usage is not None:
+        metrics.increment("prompt_tokens", getattr(usage, "prompt_token_count", 0) or 0)
+        metrics.increment("response_tokens", getattr(usage, "candidates_token_count", 0) or 0)
+
+def contentKey(model, generation_config, content: list):
+    # same prompt, instructions, images and model config give the same key
+    return cache.hashParts("gemini", getattr(model, "model_name", ""), repr(generation_config), *content)
+
+def estimateTokens(content: list, max_output_tokens: int = 2048):
+    tokens = max_output_tokens
+
+    for item in content:
+        if isinstance(item, str):
+            tokens += len(item) // CHARACTERS_PER_TOKEN + 1
+        else:
+            tokens += TOKENS_PER_IMAGE
+
+    return tokens
+
+def maxOutputTokens(generation_config):
+    if isinstance(generation_config, dict):
+        return generation_config.get("max_output_tokens", 2048)
+
+    return getattr(generation_config, "max_output_tokens", None) or 2048
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.__rate = per_minute / 60.0
+        self.__updated = monotonic()
+
+    def __refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+    def waitTime(self, amount: float):
+        self.__refill()
+
+        # a request larger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+
+        if self.tokens >= amount:
+            return 0.0
+
+        return (amount - self.tokens) / self.__rate
+
+    def consume(self, amount: float):
+        self.__refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self):
+        self.__refill()
+        self.tokens = min(self.tokens, 0.0)
+
+class RateLimiter:
+    # the thread version of asyncgemini.RateLimitScheduler, admits requests while both per-minute quotas have room
+    def __init__(self, requests_per_minute: int = 15, tokens_per_minute: int = 1000000):
+        self.__requests = TokenBucket(requests_per_minute)
+        self.__tokens = TokenBucket(tokens_per_minute)
+        self.__lock = Lock()
+        self.__admission = Lock()
+
+    def waitTime(self, estimated_tokens: int):
+        with self.__lock:
+            return max(self.__requests.waitTime(1), self.__tokens.waitTime(estimated_tokens))
+
+    def acquire(self, estimated_tokens: int):
+        # waiting workers go through the admission lock one by one, the buckets are only locked to look at them,
+        # so finished requests can settle and penalize while a worker sleeps
+        with self.__admission:
+            while True:
+                with self.__lock:
+                    wait = max(self.__requests.waitTime(1), self.__tokens.waitTime(estimated_tokens))
+
+                    if wait <= 0:
+                        self.__requests.consume(1)
+                        self.__tokens.consume(estimated_tokens)
+                        return
+
+                sleep(wait)
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        # returns the over-estimate to the bucket or charges the difference
+        with self.__lock:
+            self.__tokens.consume(used_tokens - estimated_tokens)
+
+    def penalize(self):
+        # the server says the quota is gone, stop admitting requests until the bucket refills
+        with self.__lock:
+            self.__requests.drain()
+
+class GeminiClient:
+    # holds the model and its counters, one instance can be shared by several worker threads.
+    # requests wait for the rate limiter, a quota error is retried with a jittered backoff up to max_retries times
+    def __init__(self, model, generation_config = None, requests_per_minute: int = 15, tokens_per_minute: int = 1000000, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.model = model
+        self.generation_config = generation_config if generation_config is not None else defaultGenerationConfig()
+        self.system_instructions = ""
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+        self.total_requests = 0
+        self.current_requests = 0
+        self.total_retries = 0
+
+        self.__counter_lock = Lock()
+
+    def resetCurrentRequestCount(self):
+        with self.__counter_lock:
+            self.current_requests = 0
+
+    def __backoff(self, attempt: int, max_delay: float):
+        # full jitter, spreads the retries of concurrent workers
+        return random.uniform(0, min(max_delay, self.base_delay * (2 ** attempt)))
+
+    def __wait(self, attempt: int, max_delay: float):
+        self.rate_limiter.penalize()
+        delay = self.__backoff(attempt, max_delay)
+
+        with self.__counter_lock:
+            self.total_retries += 1
+
+        metrics.increment("gemini_retries")
+
+        print(f"Request limit reached, retry {attempt+1}/{self.max_retries} in {delay:.1f} seconds...")
+
+        with metrics.span("geminiBackoff"):
+            sleep(delay)
+
+        self.resetCurrentRequestCount()
+
+    def __finish(self, response, estimated_tokens: int):
+        with self.__counter_lock:
+            self.current_requests += 1
+            self.total_requests += 1
+
+        metrics.increment("gemini_requests")
+        countUsage(response)
+
+        usage = getattr(response, "usage_metadata", None)
+
+        if usage is not None and getattr(usage, "total_token_count", None) is not None:
+            self.rate_limiter.settle(estimated_tokens, usage.total_token_count)
+
+    def generateContent(self, prompt: str, images = [], delayDurationWhenExhausted: float = None, system_instructions: str = None, generation_config = None):
+        # passing the instructions directly is safe when several workers share the client.
+        # delayDurationWhenExhausted caps a single backoff wait, max_delay is used without it
+        if system_instructions is None:
+            system_instructions = self.system_instructions
+        
+        if generation_config is None:
+            generation_config = self.generation_config
+
+        max_delay = delayDurationWhenExhausted if delayDurationWhenExhausted is not None else self.max_delay
+
+        content = buildContent(prompt, images, system_instructions)
+        estimated_tokens = estimateTokens(content, maxOutputTokens(generation_config))
+
+        result_cache = cache.getCache()
+
+        if result_cache is not None:
+            key = contentKey(self.model, generation_config, content)
+            result = result_cache.get(key)
+
+            if result is not None:
+                metrics.increment("gemini_cache_hits")
+                return result
+
+        attempt = 0
+
+        while True:
+            with metrics.span("geminiQueue"):
+                self.rate_limiter.acquire(estimated_tokens)
+
+            try:
+                with metrics.span("geminiRequest"):
+                    response = self.model.generate_content(content, generation_config=generation_config)
+                    result = response.text
+
+            except ResourceExhausted:
+                if attempt >= self.max_retries:
+                    print(f"Request limit reached, giving up after {attempt} retries.")
+                    raise
+
+                self.__wait(attempt, max_delay)
+                attempt += 1
+                continue
+
+            break
+
+        self.__finish(response, estimated_tokens)
+
+        if result_cache is not None:
+            result_cache.put(key, result)
+
+        return result
+
+    def generateContentStream(self, prompt: str, images = [], delayDurationWhenExhausted: float = None, system_instructions: str = None, generation_config = None):
+        # yields the reply text chunk by chunk while it is generated
+        if system_instructions is None:
+            system_instructions = self.system_instructions
+
+        if generation_config is None:
+            generation_config = self.generation_config
+
+        max_delay = delayDurationWhenExhausted if delayDurationWhenExhausted is not None else self.max_delay
+
+        content = buildContent(prompt, images, system_instructions)
+        estimated_tokens = estimateTokens(content, maxOutputTokens(generation_config))
+
+        result_cache = cache.getCache()
+
+        if result_cache is not None:
+            key = contentKey(self.model, generation_config, content)
+            result = result_cache.get(key)
+
+            if result is not None:
+                metrics.increment("gemini_cache_hits")
+                yield result
+                return
+
+        chunks = []
+        attempt = 0
+
+        while True:
+            with metrics.span("geminiQueue"):
+                self.rate_limiter.acquire(estimated_tokens)
+
+            try:
+                # the span ends with the last chunk, the time the caller spends between chunks is included
+                with metrics.span("geminiRequest"):
+                    chunk = None
+
+                    for chunk in self.model.generate_content(content, generation_config=generation_config, stream=True):
+                        chunks.append(chunk.text)
+                        yield chunk.text
+
+            except ResourceExhausted:
+                # a reply that already started can not be taken back
+                if len(chunks) > 0:
+                    raise
+
+                if attempt >= self.max_retries:
+                    print(f"Request limit reached, giving up after {attempt} retries.")
+                    raise
+
+                self.__wait(attempt, max_delay)
+                attempt += 1
+                continue
+
+            break
+
+        self.__finish(chunk, estimated_tokens)
+
+        if result_cache is not None:
+            result_cache.put(key, "".join(chunks))
+
+def connectToGemini(google_api_key: str, model_name: str = "gemini-1.5-flash", **limits):
+    # limits are the GeminiClient quotas and retry settings, e.g. requests_per_minute=1000 for a paid key
+    __client['default'] = GeminiClient(createModel(google_api_key, model_name), **limits)
+
     return f"{model_name} connected successfully..."
 
+def getClient():
+    return __client['default']
+
+def hasClient():
+    return 'default' in __client
+
+def setClient(client: GeminiClient):
+    __client['default'] = client
+
 def setSystemInstructions(system_instructions: str):
-    __ai_model['system_instructions'] = system_instructions
+    __client['default'].system_instructions = system_instructions
 
 def setGenerationConfig(generation_config: dict):
-    __ai_model['generation_config'] = generation_config
+    __client['default'].generation_config = generation_config
 
 def resetCurrentRequestCount():
-    __ai_model['current_requests'] = 0
+    __client['default'].resetCurrentRequestCount()
 
-def generateContent(prompt: str, images = [], delayDurationWhenExhausted: int = 60):
-    content = [
-        "System Instructions: " + __ai_model['system_instructions'],
-        "Prompt: " + prompt + " "
-    ]
-        
-    for image in images:
-        content.append(image)
-    
-    while True:
-        try:
-            result = __ai_model['model'].generate_content(content, generation_config=__ai_model['generation_config']).text
-            
-            __ai_model['current_requests'] += 1
-            __ai_model['total_requests'] += 1
-            
-        except ResourceExhausted:
-            print(f"Request limit reached, counted requests: {__ai_model['current_requests']}...")
-            print(f"waiting for {delayDurationWhenExhausted} seconds...")
-            
-            sleep(delayDurationWhenExhausted)
-            resetCurrentRequestCount()
-            
-            print("Resuming request...")
-            continue
-            
-        break
-    
-    return result
+def generateContent(prompt: str, images = [], delayDurationWhenExhausted: float = None, system_instructions: str = None, generation_config = None):
+    return __client['default'].generateContent(prompt, images, delayDurationWhenExhausted, system_instructions, generation_config)
+
+def generateContentStream(prompt: str, images = [], delayDurationWhenExhausted: float = None, system_instructions: str = None, generation_config = None):
+    return __client['default'].generateContentStream(prompt, images, delayDurationWhenExhausted, system_instructions, generation_config)
 
 def getCurrentRequestCount():
-    return __ai_model['current_requests']
+    return __client['default'].current_requests
 
 def getTotalRequestCount():
-    return __ai_model['total_requests']
\ No newline at end of file
+    return __client['default'].total_requests
\ No newline at end of file
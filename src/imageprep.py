@@ -0,0 +1,72 @@
+import io
+from PIL import Image
+
+# how a page is prepared for every use: the classification only needs a thumbnail,
+# the extraction a readable page and tesseract a grayscale one. threshold binarizes (0-255)
+DEFAULT_TARGETS = {
+    "classify": {"max_side": 768, "grayscale": True, "format": "JPEG", "quality": 60},
+    "extract": {"max_side": 1600, "grayscale": False, "format": "JPEG", "quality": 85},
+    "ocr": {"max_side": None, "grayscale": True, "threshold": None}
+}
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+__targets = {use: dict(target) for use, target in DEFAULT_TARGETS.items()}
+
+def setTarget(use: str, **options):
+    if use not in __targets:
+        raise ValueError(f"Unknown image use: {use}")
+
+    __targets[use].update(options)
+
+def getTarget(use: str):
+    return dict(__targets[use])
+
+def getTargets():
+    return {use: dict(target) for use, target in __targets.items()}
+
+def setTargets(targets: dict):
+    # used by the page pool processes to take over the targets of the parent
+    for use, target in targets.items():
+        __targets[use] = dict(target)
+
+def prepareImage(image, target: dict):
+    # a resized and converted copy, the original page is left as it is
+    prepared = image
+
+    max_side = target.get("max_side")
+
+    if max_side is not None and max(prepared.size) > max_side:
+        prepared = prepared.copy()
+        prepared.thumbnail((max_side, max_side), Image.BILINEAR, reducing_gap=2.0)
+
+    if target.get("grayscale") and prepared.mode != "L":
+        prepared = prepared.convert("L")
+    elif not target.get("grayscale") and prepared.mode not in ("RGB", "L"):
+        # jpeg has no alpha or palette
+        prepared = prepared.convert("RGB")
+
+    threshold = target.get("threshold")
+
+    if threshold is not None:
+        prepared = (prepared if prepared.mode == "L" else prepared.convert("L")).point(lambda value: 255 if value > threshold else 0)
+
+    return prepared
+
+def encodeImage(image, target: dict):
+    # {"mime_type", "data"} blob, the form the gemini api takes inline images in
+    image_format = target.get("format", "JPEG")
+
+    options = {"quality": target.get("quality", 85), "optimize": False} if image_format in ("JPEG", "WEBP") else {"compress_level": 1}
+
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+
+    return {"mime_type": MIME_TYPES[image_format], "data": buffer.getvalue()}
+
+def prepareForUpload(image, use: str):
+    target = __targets[use]
+    return encodeImage(prepareImage(image, target), target)
+
+def prepareForOCR(image):
+    return prepareImage(image, __targets["ocr"])
@@ -0,0 +1,125 @@
+import imaplib
+from time import monotonic
+from threading import Lock, Condition
+from contextlib import contextmanager
+
+class IMAPConnectionPool:
+    # logged in connections to one account, shared by the workers that process its mail.
+    # imaplib connections are not thread safe, a connection belongs to one worker while it is acquired
+    def __init__(self, imap_server: str, username: str, password: str, mailbox: str = "INBOX", imap_port: int = 993, use_ssl: bool = True, max_connections: int = 4, idle_check_seconds: float = 60.0):
+        self.imap_server = imap_server
+        self.imap_port = imap_port
+        self.use_ssl = use_ssl
+        self.mailbox = mailbox
+        self.max_connections = max_connections
+        self.idle_check_seconds = idle_check_seconds
+
+        self.__username = username
+        self.__password = password
+
+        self.__idle = [] # (connection, released at)
+        self.__opened = 0
+        self.__closed = False
+        self.__condition = Condition(Lock())
+
+    def __open(self):
+        if self.use_ssl:
+            connection = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+        else:
+            connection = imaplib.IMAP4(self.imap_server, self.imap_port)
+
+        connection.login(self.__username, self.__password)
+        connection.select(self.mailbox)
+
+        return connection
+
+    def __discard(self, connection):
+        try:
+            connection.logout()
+        except Exception:
+            pass
+
+        with self.__condition:
+            self.__opened -= 1
+            self.__condition.notify()
+
+    def __take(self):
+        # an idle connection, or None when a new one may be opened
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise RuntimeError("The connection pool is closed.")
+
+                if len(self.__idle) > 0:
+                    return self.__idle.pop()
+
+                if self.__opened < self.max_connections:
+                    self.__opened += 1
+                    return None
+
+                self.__condition.wait()
+
+    def __isAlive(self, connection, released_at: float):
+        # servers drop idle connections, the ones that sat for a while are checked first
+        if monotonic() - released_at < self.idle_check_seconds:
+            return True
+
+        try:
+            return connection.noop()[0] == "OK"
+        except Exception:
+            return False
+
+    def getConnection(self):
+        while True:
+            taken = self.__take()
+
+            if taken is None:
+                try:
+                    return self.__open()
+                except Exception:
+                    with self.__condition:
+                        self.__opened -= 1
+                        self.__condition.notify()
+                    raise
+
+            connection, released_at = taken
+
+            if self.__isAlive(connection, released_at):
+                return connection
+
+            self.__discard(connection)
+
+    def releaseConnection(self, connection, broken: bool = False):
+        if broken or self.__closed:
+            self.__discard(connection)
+            return
+
+        with self.__condition:
+            self.__idle.append((connection, monotonic()))
+            self.__condition.notify()
+
+    @contextmanager
+    def acquire(self):
+        connection = self.getConnection()
+
+        try:
+            yield connection
+        except (imaplib.IMAP4.abort, OSError):
+            # the connection is unusable after a protocol or socket error
+            self.releaseConnection(connection, broken=True)
+            raise
+        except BaseException:
+            self.releaseConnection(connection)
+            raise
+        else:
+            self.releaseConnection(connection)
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            idle = self.__idle
+            self.__idle = []
+            self.__condition.notify_all()
+
+        for connection, _ in idle:
+            self.__discard(connection)
@@ -0,0 +1,115 @@
+import os
+import json
+import re
+
+__uid_pattern = re.compile(rb'UID (\d+)')
+__message_start_pattern = re.compile(rb'^\d+ \(')
+__status_pattern = re.compile(rb'(UIDVALIDITY|UIDNEXT) (\d+)')
+
+def loadSyncState(state_path: str):
+    if not os.path.isfile(state_path):
+        return {}
+
+    try:
+        with open(state_path, 'r') as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Sync state could not be loaded from {state_path}, starting from scratch - Error:", e)
+        return {}
+
+def saveSyncState(state: dict, state_path: str):
+    folder = os.path.dirname(state_path)
+
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    # write to a temporary file first so a crash never leaves a half written state
+    temp_path = state_path + ".tmp"
+
+    with open(temp_path, 'w') as file:
+        json.dump(state, file)
+
+    os.replace(temp_path, state_path)
+
+def getMailboxState(state: dict, mailbox: str, uidvalidity: int):
+    mailbox_state = state.get(mailbox)
+
+    # a changed UIDVALIDITY means the old UIDs are meaningless, sync again from the start
+    if mailbox_state is None or mailbox_state.get("uidvalidity") != uidvalidity:
+        mailbox_state = {"uidvalidity": uidvalidity, "last_uid": 0}
+        state[mailbox] = mailbox_state
+
+    return mailbox_state
+
+def parseStatus(status_response: list):
+    values = {}
+
+    for line in status_response:
+        if isinstance(line, bytes):
+            for key, value in __status_pattern.findall(line):
+                values[key.decode()] = int(value)
+
+    return values
+
+def toUIDSet(uids: list):
+    # compresses sorted uids into an IMAP sequence set like "1:4,7,9:10"
+    ranges = []
+
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ",".join(str(first) if first == last else f"{first}:{last}" for first, last in ranges)
+
+def fromUIDSet(uid_set: str):
+    # the reverse of toUIDSet, "*" is not supported
+    uids = []
+
+    for item in uid_set.split(","):
+        if ":" in item:
+            first, last = item.split(":")
+            uids += range(int(first), int(last)+1)
+        elif item:
+            uids.append(int(item))
+
+    return uids
+
+def chunkList(items: list, chunk_size: int):
+    for i in range(0, len(items), max(1, chunk_size)):
+        yield items[i:i+chunk_size]
+
+def groupFetchResponse(data: list):
+    # imaplib returns one FETCH response as a mix of bytes and (header, literal) tuples,
+    # this groups them back into messages: [{"uid": int, "meta": bytes, "literals": [bytes]}]
+    messages = []
+
+    for item in data:
+        if item is None:
+            continue
+
+        if isinstance(item, tuple):
+            header, literal = item
+        else:
+            header, literal = item, None
+
+        if __message_start_pattern.match(header) or not messages:
+            messages.append({"uid": None, "meta": b"", "literals": [], "headers": b""})
+
+        message = messages[-1]
+        message["meta"] += header
+        message["headers"] += header
+
+        if literal is not None:
+            message["literals"].append(literal)
+            message["meta"] += literal
+
+    for message in messages:
+        # literals are skipped so a body containing "UID 5" can not be mistaken for the uid
+        match = __uid_pattern.search(message.pop("headers"))
+
+        if match:
+            message["uid"] = int(match.group(1))
+
+    return [message for message in messages if message["uid"] is not None]
@@ -0,0 +1,82 @@
+import os
+import pickle
+import sqlite3
+from time import time
+from threading import Lock
+
+class JobStore:
+    # records how far every email got through the pipeline and the outputs of the finished steps
+    def __init__(self, path: str = "outputs/jobs.db", journal_mode: str = "WAL"):
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # WAL needs every process on one host, stores shared over a network filesystem use "DELETE"
+        self.__connection.execute(f"PRAGMA journal_mode={journal_mode}")
+
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS jobs (email TEXT PRIMARY KEY, stage TEXT, status TEXT, error TEXT, updated REAL)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS outputs (email TEXT, stage TEXT, data BLOB, PRIMARY KEY (email, stage))")
+
+    def __setStage(self, email, stage: str, status: str, error: str = None):
+        self.__connection.execute(
+            "INSERT INTO jobs (email, stage, status, error, updated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(email) DO UPDATE SET stage=excluded.stage, status=excluded.status, error=excluded.error, updated=excluded.updated",
+            (str(email), stage, status, error, time())
+        )
+
+    def save(self, email, stage: str, output = None):
+        data = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO outputs (email, stage, data) VALUES (?, ?, ?)", (str(email), stage, data))
+            self.__setStage(email, stage, "running")
+
+    def load(self, email, stage: str):
+        # (output,) when the stage is finished, None when it still has to run
+        with self.__lock:
+            row = self.__connection.execute("SELECT data FROM outputs WHERE email = ? AND stage = ?", (str(email), stage)).fetchone()
+
+        if row is None:
+            return None
+
+        return (pickle.loads(row[0]),)
+
+    def markDone(self, email, saved_parts: int = 0):
+        # the intermediate outputs are not needed any more once the email is done
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM outputs WHERE email = ?", (str(email),))
+            self.__connection.execute("INSERT OR REPLACE INTO outputs (email, stage, data) VALUES (?, ?, ?)", (str(email), "done", pickle.dumps(saved_parts)))
+            self.__setStage(email, "done", "done")
+
+    def markFailed(self, email, stage: str, error: str):
+        with self.__lock, self.__connection:
+            self.__setStage(email, stage, "failed", error)
+
+    def getStage(self, email):
+        with self.__lock:
+            row = self.__connection.execute("SELECT stage, status FROM jobs WHERE email = ?", (str(email),)).fetchone()
+
+        return row
+
+    def isDone(self, email):
+        row = self.getStage(email)
+        return row is not None and row[1] == "done"
+
+    def reset(self, email):
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM outputs WHERE email = ?", (str(email),))
+            self.__connection.execute("DELETE FROM jobs WHERE email = ?", (str(email),))
+
+    def getFailed(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT email, stage, error FROM jobs WHERE status = 'failed'").fetchall()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
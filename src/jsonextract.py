@@ -0,0 +1,131 @@
+import re
+import json
+
+__trailing_comma_pattern = re.compile(r',\s*([}\]])')
+
+def parseJson(text: str):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    # models like to leave a comma after the last element
+    return json.loads(__trailing_comma_pattern.sub(r'\1', text))
+
+class JsonStreamExtractor:
+    # pulls json objects and arrays out of fenced or chatty text, the text can arrive in chunks
+    def __init__(self):
+        self.__reset()
+
+    def __reset(self):
+        self.__parts = [] # text of the unfinished value from the previous chunks
+        self.__stack = []
+        self.__in_string = False
+        self.__escape = False
+
+    def feed(self, chunk: str):
+        # returns the values that were completed by this chunk
+        values = []
+        segments = [chunk]
+
+        while len(segments) > 0:
+            text = segments.pop()
+            start = 0 if len(self.__stack) > 0 else None
+
+            for position, character in enumerate(text):
+                if len(self.__stack) == 0:
+                    # everything outside of a json value is skipped
+                    if character in "{[":
+                        self.__stack.append(character)
+                        start = position
+                    continue
+
+                if self.__in_string:
+                    if self.__escape:
+                        self.__escape = False
+                    elif character == "\\":
+                        self.__escape = True
+                    elif character == '"':
+                        self.__in_string = False
+                    continue
+
+                if character == '"':
+                    self.__in_string = True
+                elif character in "{[":
+                    self.__stack.append(character)
+                elif character in "}]":
+                    opening = self.__stack.pop()
+                    matches = (opening == "{") == (character == "}")
+
+                    if matches and len(self.__stack) > 0:
+                        continue
+
+                    candidate = "".join(self.__parts) + text[start:position+1]
+                    self.__reset()
+
+                    if matches:
+                        try:
+                            values.append(parseJson(candidate))
+                            start = None
+                            continue
+                        except json.JSONDecodeError:
+                            pass
+
+                    # brackets that do not match or a value that does not parse were not json,
+                    # like "[here it is:" before the real objects. the text after the opening bracket is searched again
+                    segments.append(text[position+1:])
+                    segments.append(candidate[1:])
+                    break
+            else:
+                if len(self.__stack) > 0:
+                    self.__parts.append(text[start:])
+
+        return values
+
+    def finish(self):
+        # the text ended, an opening bracket that never closed was not json either
+        values = []
+
+        while len(self.__stack) > 0:
+            unfinished = "".join(self.__parts)
+            self.__reset()
+            values += self.feed(unfinished[1:])
+
+        return values
+
+def extractJson(text: str):
+    # every top level json value in the text, in order
+    extractor = JsonStreamExtractor()
+
+    return extractor.feed(text) + extractor.finish()
+
+def flattenObjects(values: list):
+    objects = []
+
+    for value in values:
+        if isinstance(value, dict):
+            objects.append(value)
+        elif isinstance(value, list):
+            objects += flattenObjects(value)
+
+    return objects
+
+def extractObjects(text: str):
+    # json objects in the text, arrays of objects are flattened
+    return flattenObjects(extractJson(text))
+
+def extractFirstObject(text: str, default = None):
+    objects = extractObjects(text)
+
+    return objects[0] if len(objects) > 0 else default
+
+def streamObjects(chunks):
+    # yields every object as soon as it is complete, chunks is any iterable of text
+    extractor = JsonStreamExtractor()
+
+    for chunk in chunks:
+        for obj in flattenObjects(extractor.feed(chunk)):
+            yield obj
+
+    for obj in flattenObjects(extractor.finish()):
+        yield obj
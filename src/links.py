@@ -0,0 +1,176 @@
+import requests
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter
+
+import cache
+import metrics
+
+DOCUMENT_TYPES = ("application/pdf", "image/jpeg", "image/png")
+
+def sniffContentType(data: bytes, content_type: str):
+    # servers often send documents as application/octet-stream
+    if data.startswith(b"%PDF"):
+        return "application/pdf"
+
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+
+    return content_type
+
+def cleanLink(link: str):
+    return link[:-1] if link.endswith('>') else link
+
+class LinkFetcher:
+    # downloads linked documents concurrently, one fetcher is shared by all the workers of a batch
+    def __init__(self, max_workers: int = 8, connections_per_host: int = 4, timeout: tuple = (5, 30), max_bytes: int = 50 * 1024 ** 2, allowed_types: tuple = DOCUMENT_TYPES, recent_bytes: int = 32 * 1024 ** 2):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.allowed_types = allowed_types
+
+        # urllib3 keeps a pool of connections for every host the session talks to
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=connections_per_host)
+        self.__session.mount("http://", adapter)
+        self.__session.mount("https://", adapter)
+
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__lock = Lock()
+        self.__in_flight = {}
+        # url -> finished download, so a link shared by several emails of a batch is downloaded once.
+        # held up to recent_bytes of content, older documents come from the disk cache when it is on
+        self.__recent = OrderedDict()
+        self.__recent_size = 0
+        self.recent_bytes = recent_bytes
+
+    def __contentType(self, headers):
+        return headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+    def __isWanted(self, headers):
+        content_type = self.__contentType(headers)
+
+        if content_type and content_type not in self.allowed_types and content_type != "application/octet-stream":
+            return False
+
+        content_length = headers.get("Content-Length")
+
+        return content_length is None or not content_length.isdigit() or int(content_length) <= self.max_bytes
+
+    @metrics.timed("linkDownload")
+    def __download(self, url: str):
+        result_cache = cache.getCache()
+        key = cache.hashParts("link", url)
+        cached = result_cache.get(key) if result_cache is not None else None
+
+        try:
+            # the type and size are checked before anything is downloaded
+            head = self.__session.head(url, timeout=self.timeout, allow_redirects=True)
+
+            if head.status_code < 400 and not self.__isWanted(head.headers):
+                print(f"Link skipped, not a document or too large: {url}")
+                return None
+
+            headers = {}
+
+            if cached is not None:
+                if cached["etag"]:
+                    headers["If-None-Match"] = cached["etag"]
+                if cached["last_modified"]:
+                    headers["If-Modified-Since"] = cached["last_modified"]
+
+            with self.__session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    metrics.increment("link_revalidated")
+                    return (cached["content_type"], cached["content"])
+
+                if response.status_code != 200 or not self.__isWanted(response.headers):
+                    return None
+
+                content = bytearray()
+
+                for block in response.iter_content(chunk_size=64 * 1024):
+                    content += block
+
+                    if len(content) > self.max_bytes:
+                        print(f"Link skipped, larger than {self.max_bytes} bytes: {url}")
+                        return None
+
+                content = bytes(content)
+                metrics.increment("bytes_downloaded", len(content))
+                content_type = sniffContentType(content, self.__contentType(response.headers))
+
+                if content_type not in self.allowed_types:
+                    return None
+
+                if result_cache is not None and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+                    result_cache.put(key, {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"), "content_type": content_type, "content": content})
+
+                return (content_type, content)
+
+        except requests.RequestException as e:
+            print(f"Link could not be downloaded: {url} - Error:", e)
+            return None
+
+    def __remember(self, url: str, future: Future):
+        result = future.result() if not future.cancelled() and future.exception() is None else None
+
+        with self.__lock:
+            self.__in_flight.pop(url, None)
+
+            # failed downloads are tried again by the next email that links them
+            if result is None or len(result[1]) > self.recent_bytes:
+                return
+
+            if url in self.__recent:
+                self.__recent_size -= len(self.__recent.pop(url).result()[1])
+
+            self.__recent[url] = future
+            self.__recent_size += len(result[1])
+
+            while self.__recent_size > self.recent_bytes:
+                _, oldest = self.__recent.popitem(last=False)
+                self.__recent_size -= len(oldest.result()[1])
+
+    def submit(self, url: str):
+        url = cleanLink(url)
+
+        with self.__lock:
+            # the same url is only downloaded once, whoever asks for it while it runs shares the result
+            if url in self.__recent:
+                return self.__recent[url]
+
+            if url in self.__in_flight:
+                return self.__in_flight[url]
+
+            future = self.__executor.submit(self.__download, url)
+            self.__in_flight[url] = future
+
+        # outside of the lock, the callback runs right away when the download is already done
+        future.add_done_callback(lambda done, url=url: self.__remember(url, done))
+
+        return future
+
+    def fetchAll(self, urls: list):
+        # returns [(url, content_type, content)] in the order of the urls, failed downloads are left out
+        futures = OrderedDict()
+
+        for url in urls:
+            futures.setdefault(cleanLink(url), self.submit(url))
+
+        results = []
+
+        for url, future in futures.items():
+            result = future.result()
+
+            if result is not None:
+                results.append((url, result[0], result[1]))
+
+        return results
+
+    def close(self):
+        self.__executor.shutdown()
+        self.__session.close()
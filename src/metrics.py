@@ -0,0 +1,271 @@
+import os
+import json
+import cProfile
+import functools
+from time import time, perf_counter
+from threading import Lock, Thread, local
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# span histogram bucket limits in seconds, the last one catches everything slower
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+QUANTILES = (0.5, 0.9, 0.99)
+RECENT_SPANS = 1024
+
+__state = {"counters": {}, "spans": {}, "events": None, "profile_folder": None}
+__lock = Lock()
+__profile_lock = Lock()
+__context = local()
+
+def __newSpan():
+    return {"count": 0, "total": 0.0, "buckets": [0] * len(BUCKETS), "recent": deque(maxlen=RECENT_SPANS)}
+
+def __addSpan(name: str, seconds: float):
+    span = __state["spans"].get(name)
+
+    if span is None:
+        span = __state["spans"][name] = __newSpan()
+
+    span["count"] += 1
+    span["total"] += seconds
+    span["recent"].append(seconds)
+
+    for i, limit in enumerate(BUCKETS):
+        if seconds <= limit:
+            span["buckets"][i] += 1
+            break
+
+def increment(name: str, amount: float = 1):
+    with __lock:
+        __state["counters"][name] = __state["counters"].get(name, 0) + amount
+
+def observe(name: str, seconds: float):
+    with __lock:
+        __addSpan(name, seconds)
+        events = __state["events"]
+
+    if events is not None:
+        events.append({"time": round(time(), 3), "span": name, "seconds": round(seconds, 6), "email": getattr(__context, "email", None)})
+
+@contextmanager
+def span(name: str):
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start)
+
+def timed(name: str = None):
+    # decorator form of span, the function name is used when no name is given
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def percentile(values: list, q: float):
+    if len(values) == 0:
+        return 0.0
+
+    values = sorted(values)
+    rank = (len(values) - 1) * q
+
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def getSnapshot():
+    # {"counters": {name: value}, "spans": {name: {count, total, buckets, recent}}}, safe to pickle and merge
+    with __lock:
+        return {
+            "counters": dict(__state["counters"]),
+            "spans": {name: {"count": s["count"], "total": s["total"], "buckets": list(s["buckets"]), "recent": list(s["recent"])} for name, s in __state["spans"].items()}
+        }
+
+def merge(snapshot: dict):
+    # adds the numbers of another process, the page pool workers send theirs back with their pages
+    with __lock:
+        for name, value in snapshot["counters"].items():
+            __state["counters"][name] = __state["counters"].get(name, 0) + value
+
+        for name, other in snapshot["spans"].items():
+            span = __state["spans"].get(name)
+
+            if span is None:
+                span = __state["spans"][name] = __newSpan()
+
+            span["count"] += other["count"]
+            span["total"] += other["total"]
+            span["recent"].extend(other["recent"])
+
+            for i, count in enumerate(other["buckets"]):
+                span["buckets"][i] += count
+
+def reset():
+    with __lock:
+        __state["counters"] = {}
+        __state["spans"] = {}
+
+def getSummary():
+    # per span count, total and quantiles of the recent durations, for printing and json export
+    snapshot = getSnapshot()
+
+    return {
+        "counters": snapshot["counters"],
+        "spans": {
+            name: dict({"count": s["count"], "total": round(s["total"], 6)}, **{f"p{int(q*100)}": round(percentile(s["recent"], q), 6) for q in QUANTILES})
+            for name, s in snapshot["spans"].items()
+        }
+    }
+
+def __metricName(name: str):
+    return "mailparser_" + "".join(character if character.isalnum() else "_" for character in name)
+
+def toPrometheus():
+    snapshot = getSnapshot()
+    lines = []
+
+    for name, value in sorted(snapshot["counters"].items()):
+        metric = __metricName(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+
+    lines.append("# TYPE mailparser_span_seconds histogram")
+
+    for name, s in sorted(snapshot["spans"].items()):
+        cumulative = 0
+
+        for limit, count in zip(BUCKETS, s["buckets"]):
+            cumulative += count
+            le = "+Inf" if limit == float("inf") else repr(limit)
+            lines.append(f'mailparser_span_seconds_bucket{{span="{name}",le="{le}"}} {cumulative}')
+
+        lines.append(f'mailparser_span_seconds_sum{{span="{name}"}} {s["total"]}')
+        lines.append(f'mailparser_span_seconds_count{{span="{name}"}} {s["count"]}')
+
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = toPrometheus().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startHttpServer(port: int = 9108, host: str = "0.0.0.0"):
+    # serves /metrics in the prometheus text format from a daemon thread
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"Metrics are served on http://{host}:{port}/metrics")
+
+    return server
+
+class EventLog:
+    # every finished span as one json line, buffered and appended in blocks
+    def __init__(self, path: str, flush_events: int = 200):
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.flush_events = flush_events
+
+        self.__events = []
+        self.__lock = Lock()
+
+    def append(self, event: dict):
+        with self.__lock:
+            self.__events.append(event)
+
+            if len(self.__events) >= self.flush_events:
+                self.__flushLocked()
+
+    def flush(self):
+        with self.__lock:
+            self.__flushLocked()
+
+    def __flushLocked(self):
+        if len(self.__events) > 0:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write("".join(json.dumps(event) + "\n" for event in self.__events))
+
+            self.__events = []
+
+def enableEventLog(path: str = "outputs/metrics.jsonl"):
+    __state["events"] = EventLog(path)
+
+def disableEventLog():
+    events = __state["events"]
+    __state["events"] = None
+
+    if events is not None:
+        events.flush()
+
+def writeSummary(path: str = "outputs/metrics.jsonl"):
+    # appends the current totals as one json line, cheap enough to call after every batch
+    flushEvents()
+
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(dict({"time": round(time(), 3), "summary": True}, **getSummary())) + "\n")
+
+def flushEvents():
+    if __state["events"] is not None:
+        __state["events"].flush()
+
+def enableProfiling(folder: str = "outputs/profiles"):
+    # every email is run under cProfile and saved as <folder>/email-<n>-<phase>.prof
+    os.makedirs(folder, exist_ok=True)
+    __state["profile_folder"] = folder
+
+def disableProfiling():
+    __state["profile_folder"] = None
+
+@contextmanager
+def emailScope(mail_index, phase: str = "process"):
+    # tags the spans of this thread with the email and profiles it when profiling is on
+    previous = getattr(__context, "email", None)
+    __context.email = mail_index
+
+    folder = __state["profile_folder"]
+
+    # only one profiler can run at a time, emails of other workers run unprofiled meanwhile
+    profiler = None
+
+    if folder is not None and __profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None
+            __profile_lock.release()
+
+    try:
+        yield
+    finally:
+        __context.email = previous
+
+        if profiler is not None:
+            profiler.disable()
+            __profile_lock.release()
+
+            profiler.dump_stats(os.path.join(folder, f"email-{mail_index}-{phase}.prof"))
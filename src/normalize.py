@@ -0,0 +1,225 @@
+import re
+import json
+from datetime import datetime
+
+REQUIRED_KEYS = ["vendor_name", "part_no", "cond", "qty", "lead_time", "price", "description", "serial_number", "notes", "warranty", "dual", "tagged_by", "trace_to", "tag_date", "tag_type", "stock_type"]
+
+# normalized key -> the names vendors and the model use for it
+KEY_ALIASES = {
+    "vendor_name": ["vendor name", "vendor", "supplier", "supplier name", "company", "company name"],
+    "part_no": ["part no", "part number", "part #", "p/n", "pn", "part", "item no", "item number"],
+    "cond": ["cc", "cond", "condition", "condition code"],
+    "qty": ["qty", "quantity", "qty available", "quantity available"],
+    "lead_time": ["lead time", "delivery", "delivery time", "availability"],
+    "price": ["unit price (usd)", "unit price", "price", "price (usd)", "unit cost", "cost"],
+    "description": ["description", "desc", "part description", "item description"],
+    "serial_number": ["serial number", "serial no", "serial", "s/n", "sn"],
+    "notes": ["notes", "note", "remarks", "comments"],
+    "warranty": ["warranty"],
+    "dual": ["dual", "dual release"],
+    "tagged_by": ["tagged by", "tag by", "certified by"],
+    "trace_to": ["trace to", "traceability", "trace"],
+    "tag_date": ["tag date", "date tagged", "certification date"],
+    "tag_type": ["tag type", "tag type(faa/easa)", "tag type (faa/easa)", "certificate type"],
+    "stock_type": ["stock type", "uom", "unit of measure", "unit"]
+}
+
+# values the models use for "nothing"
+NULL_VALUES = {"", "null", "none", "n/a", "na", "-", "--", "unknown", "not specified", "not available"}
+
+# fields where a document beats the email body, authorization forms are the source of the tag data
+DOCUMENT_FIRST_KEYS = {"tagged_by", "tag_date", "tag_type", "dual"}
+
+DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%d.%m.%Y", "%m/%d/%Y", "%d/%m/%Y", "%d-%b-%Y", "%d %b %Y", "%d %B %Y", "%b %d, %Y", "%B %d, %Y", "%b %d %Y", "%B %d %Y", "%d-%m-%Y", "%Y%m%d"]
+
+__alias_lookup = {}
+
+# "12/03/2024" has no sign of its order, it is read month first unless setDayFirst(True)
+__date_settings = {"day_first": False}
+
+def canonicalKey(key: str):
+    return re.sub(r'[^a-z0-9]', '', str(key).lower())
+
+def __buildAliasLookup():
+    __alias_lookup.clear()
+
+    for normalized_key, aliases in KEY_ALIASES.items():
+        __alias_lookup[canonicalKey(normalized_key)] = normalized_key
+
+        for alias in aliases:
+            __alias_lookup[canonicalKey(alias)] = normalized_key
+
+def addKeyAliases(normalized_key: str, aliases: list):
+    KEY_ALIASES.setdefault(normalized_key, [])
+    KEY_ALIASES[normalized_key] += aliases
+    __buildAliasLookup()
+
+def loadKeyAliases(path: str):
+    # json file in the same shape as KEY_ALIASES, entries are added to the defaults
+    with open(path, 'r') as file:
+        for normalized_key, aliases in json.load(file).items():
+            addKeyAliases(normalized_key, aliases)
+
+def resolveKey(key: str):
+    canonical = canonicalKey(key)
+
+    if canonical in __alias_lookup:
+        return __alias_lookup[canonical]
+
+    # "Unit Price (USD)" style keys, try again without the parenthesis
+    without_unit = canonicalKey(re.sub(r'\(.*?\)', '', str(key)))
+
+    return __alias_lookup.get(without_unit)
+
+def isNull(value):
+    return value is None or (isinstance(value, str) and value.strip().lower() in NULL_VALUES) or value == [] or value == {}
+
+def normalizePrice(value):
+    # None when the number can be read more than one way, the value is left to the model then
+    match = re.search(r'\d(?:[\d.,]|\s(?=\d{3}(?!\d)))*', str(value))
+
+    if match is None:
+        return None
+
+    number = match.group(0).rstrip(".,")
+
+    if re.search(r'\s', number):
+        # "1 250.00" is a thousands space or two numbers
+        return None
+
+    if re.fullmatch(r'\d{1,3}(?:,\d{3})+\.\d+|\d{1,3}(?:,\d{3}){2,}', number):
+        # "1,234.50" and "1,234,567"
+        number = number.replace(",", "")
+    elif re.fullmatch(r'\d{1,3}(?:\.\d{3})+,\d+|\d{1,3}(?:\.\d{3}){2,}', number):
+        # "1.234,50" and "1.234.567"
+        number = number.replace(".", "").replace(",", ".")
+    elif re.fullmatch(r'[1-9]\d{0,2}[.,]\d{3}', number):
+        # "1.250" and "1,250" are a thousand or a decimal depending on the vendor
+        return None
+    elif re.fullmatch(r'\d+,\d+', number):
+        # "12,50"
+        number = number.replace(",", ".")
+    elif not re.fullmatch(r'\d+(?:\.\d+)?', number):
+        return None
+
+    try:
+        return f"{float(number):.2f}"
+    except ValueError:
+        return None
+
+def normalizeQty(value):
+    match = re.search(r'\d+(?:\.\d+)?', str(value).replace(",", ""))
+
+    if match is None:
+        return None
+
+    number = float(match.group(0))
+
+    return str(int(number)) if number.is_integer() else str(number)
+
+def setDayFirst(day_first: bool):
+    __date_settings["day_first"] = day_first
+
+def __dateFormats():
+    if not __date_settings["day_first"]:
+        return DATE_FORMATS
+
+    return [{"%m/%d/%Y": "%d/%m/%Y", "%d/%m/%Y": "%m/%d/%Y"}.get(date_format, date_format) for date_format in DATE_FORMATS]
+
+def normalizeDate(value):
+    text = re.sub(r'\s*,\s*', ', ', re.sub(r'\s+', ' ', str(value).strip()))
+
+    for date_format in __dateFormats():
+        try:
+            return datetime.strptime(text, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+
+    # the value is kept as it is when it is not a date we know
+    return str(value).strip()
+
+def normalizeYesNo(value):
+    text = str(value).strip().lower()
+
+    if text in ("yes", "y", "true", "dual", "x", "marked", "1"):
+        return "Yes"
+
+    if text in ("no", "n", "false", "single", "0", "not marked"):
+        return "No"
+
+    return str(value).strip()
+
+def normalizeUpper(value):
+    return str(value).strip().upper()
+
+VALUE_NORMALIZERS = {
+    "price": normalizePrice,
+    "qty": normalizeQty,
+    "tag_date": normalizeDate,
+    "dual": normalizeYesNo,
+    "cond": normalizeUpper,
+    "tag_type": normalizeUpper,
+    "stock_type": normalizeUpper
+}
+
+def normalizeValue(normalized_key: str, value):
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+
+    normalizer = VALUE_NORMALIZERS.get(normalized_key)
+
+    if normalizer is None:
+        return str(value).strip()
+
+    return normalizer(value)
+
+def normalizeInfo(info: dict):
+    # maps the keys of one json object onto the required keys,
+    # returns the normalized values and the values that have no known key
+    normalized = {}
+    unresolved = {}
+
+    for key, value in info.items():
+        if isNull(value):
+            continue
+
+        normalized_key = resolveKey(key)
+
+        if normalized_key is None:
+            unresolved[key] = value
+            continue
+
+        normalized_value = normalizeValue(normalized_key, value)
+
+        if isNull(normalized_value):
+            # a value the engine could not read, like an ambiguous price, is left to the model
+            unresolved.setdefault(key, value)
+        elif normalized_key not in normalized:
+            normalized[normalized_key] = normalized_value
+
+    return normalized, unresolved
+
+def __samePart(part_no_a: str, part_no_b: str):
+    return canonicalKey(part_no_a) == canonicalKey(part_no_b)
+
+def mergePart(part_info: dict, attachmentsInfo: list):
+    # merges the part from the email body with the document information that belongs to it
+    merged, unresolved = normalizeInfo(part_info)
+
+    for attachment in attachmentsInfo:
+        document, document_unresolved = normalizeInfo(attachment.info)
+
+        # a quotation for a different part number does not belong to this part
+        if "part_no" in merged and "part_no" in document and not __samePart(merged["part_no"], document["part_no"]):
+            continue
+
+        for key, value in document.items():
+            if key not in merged or key in DOCUMENT_FIRST_KEYS:
+                merged[key] = value
+
+        for key, value in document_unresolved.items():
+            unresolved.setdefault(key, value)
+
+    return merged, unresolved
+
+__buildAliasLookup()
@@ -0,0 +1,129 @@
+import pytesseract
+from threading import local
+from pytesseract import Output
+
+class OCRError(Exception):
+    pass
+
+class PytesseractBackend:
+    # runs the tesseract executable for every call, the language data is loaded every time
+    name = "pytesseract"
+
+    def __init__(self, language: str = "eng", tessdata_path: str = None):
+        self.language = language
+        self.config = f'--tessdata-dir "{tessdata_path}"' if tessdata_path else ""
+
+    def osd(self, image):
+        try:
+            return pytesseract.image_to_osd(image, output_type=Output.DICT, config=(self.config + " --psm 0").strip())
+        except pytesseract.pytesseract.TesseractError as e:
+            raise OCRError(str(e))
+
+    def text(self, image):
+        try:
+            return pytesseract.image_to_string(image, lang=self.language, config=self.config)
+        except pytesseract.pytesseract.TesseractError as e:
+            raise OCRError(str(e))
+
+class TesserocrBackend:
+    # keeps the tesseract engines loaded, every thread (and page pool process) gets its own pair
+    name = "tesserocr"
+
+    def __init__(self, language: str = "eng", tessdata_path: str = None):
+        import tesserocr
+
+        self.language = language
+        self.tessdata_path = tessdata_path
+
+        self.__tesserocr = tesserocr
+        self.__engines = local()
+
+    def __engine(self, kind: str):
+        engine = getattr(self.__engines, kind, None)
+
+        if engine is None:
+            tesserocr = self.__tesserocr
+            psm = tesserocr.PSM.OSD_ONLY if kind == "osd" else tesserocr.PSM.AUTO
+            options = {"path": self.tessdata_path} if self.tessdata_path else {}
+
+            try:
+                engine = tesserocr.PyTessBaseAPI(lang="osd" if kind == "osd" else self.language, psm=psm, **options)
+            except RuntimeError as e:
+                raise OCRError(str(e))
+
+            setattr(self.__engines, kind, engine)
+
+        return engine
+
+    def osd(self, image):
+        engine = self.__engine("osd")
+        engine.SetImage(image)
+
+        result = engine.DetectOrientationScript()
+
+        if not result:
+            raise OCRError("orientation could not be detected")
+
+        # the same keys pytesseract gives, rotateImage reads "orientation"
+        return {
+            "orientation": result["orient_deg"],
+            "rotate": (360 - result["orient_deg"]) % 360,
+            "orientation_conf": result["orient_conf"],
+            "script": result["script_name"],
+            "script_conf": result["script_conf"]
+        }
+
+    def text(self, image):
+        engine = self.__engine("text")
+        engine.SetImage(image)
+
+        try:
+            return engine.GetUTF8Text()
+        except RuntimeError as e:
+            raise OCRError(str(e))
+        finally:
+            engine.Clear()
+
+ENGINES = {
+    "pytesseract": PytesseractBackend,
+    "tesserocr": TesserocrBackend
+}
+
+__backend = {"settings": {"engine": "auto", "language": "eng", "tessdata_path": None}, "backend": None}
+
+def registerBackend(name: str, factory):
+    # factory(language, tessdata_path) returns an object with osd(image) and text(image)
+    ENGINES[name] = factory
+
+def createBackend(engine: str = "auto", language: str = "eng", tessdata_path: str = None):
+    if engine != "auto":
+        return ENGINES[engine](language, tessdata_path)
+
+    # the resident engine when the binding is installed, the executable otherwise
+    try:
+        return TesserocrBackend(language, tessdata_path)
+    except ImportError:
+        return PytesseractBackend(language, tessdata_path)
+
+def setBackend(engine: str = "auto", language: str = "eng", tessdata_path: str = None):
+    if engine != "auto" and engine not in ENGINES:
+        raise ValueError(f"Unknown OCR engine: {engine}")
+
+    __backend["settings"] = {"engine": engine, "language": language, "tessdata_path": tessdata_path}
+    __backend["backend"] = None
+
+def getSettings():
+    return dict(__backend["settings"])
+
+def configure(settings: dict):
+    # used by the page pool processes, the loaded engines are kept while the settings stay the same
+    if settings != __backend["settings"]:
+        __backend["settings"] = dict(settings)
+        __backend["backend"] = None
+
+def getBackend():
+    if __backend["backend"] is None:
+        __backend["backend"] = createBackend(**__backend["settings"])
+        print(f"OCR engine: {__backend['backend'].name}")
+
+    return __backend["backend"]
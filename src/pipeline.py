@@ -0,0 +1,81 @@
+import queue
+import threading
+
+# marks the end of the input for a stage worker
+__STOP = object()
+
+class Stage:
+    def __init__(self, name: str, func, workers: int = 1):
+        self.name = name
+        self.func = func # called with one item, returning None drops the item
+        self.workers = max(1, workers)
+
+def __worker(stage: Stage, input_queue: queue.Queue, output_queue: queue.Queue):
+    while True:
+        item = input_queue.get()
+
+        if item is __STOP:
+            break
+
+        try:
+            result = stage.func(item)
+        except Exception as e:
+            print(f"Stage '{stage.name}' failed for item {item if not isinstance(item, tuple) else item[0]} - Error:", e)
+            continue
+
+        if result is not None:
+            # blocks while the next stage is busy, this is what keeps memory flat
+            output_queue.put(result)
+
+def __runStage(stage: Stage, input_queue: queue.Queue, output_queue: queue.Queue, next_workers: int):
+    threads = [threading.Thread(target=__worker, args=(stage, input_queue, output_queue), daemon=True) for _ in range(stage.workers)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    # every worker of the next stage needs its own stop signal
+    for _ in range(next_workers):
+        output_queue.put(__STOP)
+
+def runPipeline(items, stages: list, queue_size: int = 8):
+    # connects the stages with bounded queues and returns the outputs of the last stage
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+
+    supervisors = []
+
+    for stage_index, stage in enumerate(stages):
+        next_workers = stages[stage_index + 1].workers if stage_index + 1 < len(stages) else 1
+
+        supervisor = threading.Thread(target=__runStage, args=(stage, queues[stage_index], queues[stage_index + 1], next_workers), daemon=True)
+        supervisor.start()
+        supervisors.append(supervisor)
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+
+        for _ in range(stages[0].workers):
+            queues[0].put(__STOP)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    results = []
+
+    while True:
+        result = queues[-1].get()
+
+        if result is __STOP:
+            break
+
+        results.append(result)
+
+    feeder.join()
+
+    for supervisor in supervisors:
+        supervisor.join()
+
+    return results
@@ -0,0 +1,223 @@
+import os
+import re
+import subprocess
+import tempfile
+
+# lowercase keywords that mark a page type, "Other-3" pages match none of them
+SALE_QUOTATION_KEYWORDS = ["quotation", "quote", "unit price", "lead time", "part number", "p/n", "qty", "quantity", "condition", "total price", "valid for"]
+AUTHORIZATION_KEYWORDS = ["authorized release certificate", "authorised release certificate", "easa form 1", "form 8130-3", "8130-3", "airworthiness approval tag", "block 12", "certificate of conformity", "approval ref"]
+
+def tokenizeIMAP(data: bytes):
+    # turns an IMAP response into nested lists of str/None, literals are expected inline after "{n}"
+    position = 0
+    stack = [[]]
+
+    while position < len(data):
+        character = data[position:position+1]
+
+        if character in (b" ", b"\r", b"\n"):
+            position += 1
+        elif character == b"(":
+            stack.append([])
+            position += 1
+        elif character == b")":
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+            position += 1
+        elif character == b'"':
+            end = position + 1
+            value = bytearray()
+
+            while end < len(data) and data[end:end+1] != b'"':
+                if data[end:end+1] == b"\\":
+                    end += 1
+                value += data[end:end+1]
+                end += 1
+
+            stack[-1].append(value.decode('utf-8', errors='replace'))
+            position = end + 1
+        elif character == b"{":
+            end = data.index(b"}", position)
+            length = int(data[position+1:end])
+            start = end + 1
+
+            if data[start:start+2] == b"\r\n":
+                start += 2
+
+            stack[-1].append(data[start:start+length].decode('utf-8', errors='replace'))
+            position = start + length
+        else:
+            match = re.match(rb'[^\s()"]+', data[position:])
+            atom = match.group(0).decode('utf-8', errors='replace')
+            stack[-1].append(None if atom.upper() == "NIL" else atom)
+            position += len(match.group(0))
+
+    while len(stack) > 1:
+        finished = stack.pop()
+        stack[-1].append(finished)
+
+    return stack[0]
+
+def findItem(tokens: list, name: str):
+    # the value after a FETCH item name like ENVELOPE or BODYSTRUCTURE, searched in every nested list
+    for i, token in enumerate(tokens):
+        if isinstance(token, str) and token.upper() == name and i + 1 < len(tokens):
+            return tokens[i+1]
+
+        if isinstance(token, list):
+            found = findItem(token, name)
+
+            if found is not None:
+                return found
+
+    return None
+
+def parseEnvelope(envelope: list):
+    # (date subject from sender reply-to to cc bcc in-reply-to message-id)
+    if not isinstance(envelope, list) or len(envelope) < 3:
+        return "", ""
+
+    subject = envelope[1] or ""
+    sender = ""
+
+    if isinstance(envelope[2], list) and len(envelope[2]) > 0 and isinstance(envelope[2][0], list):
+        address = envelope[2][0]
+
+        if len(address) >= 4 and address[2] and address[3]:
+            sender = f"{address[2]}@{address[3]}"
+
+    return sender, subject
+
+def parseBodyStructure(structure):
+    # [(content_type, size)] for every leaf part
+    if not isinstance(structure, list) or len(structure) == 0:
+        return []
+
+    if isinstance(structure[0], list):
+        parts = []
+
+        for item in structure:
+            if isinstance(item, list):
+                parts += parseBodyStructure(item)
+
+        return parts
+
+    if len(structure) >= 7 and isinstance(structure[0], str) and isinstance(structure[1], str):
+        size = int(structure[6]) if isinstance(structure[6], str) and structure[6].isdigit() else 0
+        return [(f"{structure[0]}/{structure[1]}".lower(), size)]
+
+    return []
+
+def extractPdfText(pdf_bytes: bytes, poppler_path: str = 'poppler/bin'):
+    # text layer of every page, empty strings for scanned pages
+    executable = os.path.join(poppler_path, "pdftotext") if poppler_path else "pdftotext"
+
+    pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+
+    try:
+        with pdf_file:
+            pdf_file.write(pdf_bytes)
+
+        result = subprocess.run([executable, "-layout", "-enc", "UTF-8", pdf_file.name, "-"], capture_output=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("PDF text layer could not be read - Error:", e)
+        return []
+    finally:
+        os.remove(pdf_file.name)
+
+    if result.returncode != 0:
+        return []
+
+    pages = result.stdout.decode('utf-8', errors='replace').split("\f")
+
+    # pdftotext ends the last page with a form feed as well
+    if len(pages) > 0 and pages[-1].strip() == "":
+        pages = pages[:-1]
+
+    return pages
+
+class PreFilter:
+    def __init__(self, allowed_senders: list = None, blocked_senders: list = None, subject_keywords: list = None, allowed_attachment_types: tuple = ("application/pdf", "image/jpeg", "image/png"), max_attachment_bytes: int = 25 * 1024 ** 2, min_text_layer_characters: int = 100, min_classify_characters: int = 200):
+        # senders are regex patterns matched against the address, subject keywords are lowercase
+        self.allowed_senders = [re.compile(pattern, re.IGNORECASE) for pattern in (allowed_senders or [])]
+        self.blocked_senders = [re.compile(pattern, re.IGNORECASE) for pattern in (blocked_senders or [])]
+        self.subject_keywords = [keyword.lower() for keyword in (subject_keywords or [])]
+        self.allowed_attachment_types = allowed_attachment_types
+        self.max_attachment_bytes = max_attachment_bytes
+
+        self.min_text_layer_characters = min_text_layer_characters
+        self.min_classify_characters = min_classify_characters
+
+        self.sale_quotation_keywords = list(SALE_QUOTATION_KEYWORDS)
+        self.authorization_keywords = list(AUTHORIZATION_KEYWORDS)
+
+        self.skipped_emails = 0
+        self.skipped_attachments = 0
+        self.skipped_pages = 0
+
+    def acceptsHeaders(self, sender: str, subject: str):
+        sender = sender or ""
+        subject = (subject or "").lower()
+
+        if any(pattern.search(sender) for pattern in self.blocked_senders):
+            return False
+
+        if len(self.allowed_senders) > 0 and not any(pattern.search(sender) for pattern in self.allowed_senders):
+            return False
+
+        if len(self.subject_keywords) > 0 and not any(keyword in subject for keyword in self.subject_keywords):
+            return False
+
+        return True
+
+    def acceptsAttachment(self, content_type: str, size: int):
+        if content_type not in self.allowed_attachment_types or size > self.max_attachment_bytes:
+            self.skipped_attachments += 1
+            return False
+
+        return True
+
+    def acceptsStructure(self, uid: int, structure: bytes):
+        # works on UID FETCH (BODYSTRUCTURE ENVELOPE) so rejected emails are never downloaded
+        tokens = tokenizeIMAP(structure)
+
+        sender, subject = parseEnvelope(findItem(tokens, "ENVELOPE"))
+
+        if not self.acceptsHeaders(sender, subject):
+            self.skipped_emails += 1
+            return False
+
+        parts = parseBodyStructure(findItem(tokens, "BODYSTRUCTURE"))
+
+        # an email needs a text body, the part extraction starts from it
+        if not any(content_type == "text/plain" for content_type, _ in parts):
+            self.skipped_emails += 1
+            return False
+
+        # the body alone is worth processing, so attachment types and sizes do not reject an email.
+        # emails are fetched whole, acceptsAttachment applies them after the download
+        return True
+
+    def usableTextLayer(self, text: str):
+        return text is not None and len(text.strip()) >= self.min_text_layer_characters
+
+    def classifyPageText(self, text: str):
+        # "1" sale quotation, "2" authorization, "3" other, None when the model has to decide
+        text = (text or "").lower()
+
+        sale_hits = sum(1 for keyword in self.sale_quotation_keywords if keyword in text)
+        authorization_hits = sum(1 for keyword in self.authorization_keywords if keyword in text)
+
+        if authorization_hits >= 2 and sale_hits == 0:
+            return "2"
+
+        if sale_hits >= 3 and authorization_hits == 0:
+            return "1"
+
+        # only long pages without a single keyword are sure to be something else
+        if sale_hits == 0 and authorization_hits == 0 and len(text.strip()) >= self.min_classify_characters:
+            self.skipped_pages += 1
+            return "3"
+
+        return None
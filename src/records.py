@@ -0,0 +1,112 @@
+import io
+from PIL import Image
+
+class PageRecord:
+    # one page of an attachment. the bitmap is held by reference: a PIL image while the page is worked on,
+    # after that the saved file (path) or the encoded png (encoded) it is loaded back from when needed
+    __slots__ = ("email", "attachment", "page", "image", "path", "encoded", "text", "osd", "prepared", "image_hash")
+
+    def __init__(self, email, attachment: int, page: int, image = None, path: str = None, text: str = "", osd: dict = None):
+        self.email = email
+        self.attachment = attachment
+        self.page = page
+        self.image = image
+        self.path = path
+        self.encoded = None
+        self.text = text
+        self.osd = osd if osd is not None else {}
+        self.prepared = {} # use -> encoded upload blob, see client.preparedImage
+        self.image_hash = None # perceptual hash, see dedup.imageHash
+
+    def name(self):
+        return f"e{self.email}-a{self.attachment}-p{self.page}"
+
+    def hasImage(self):
+        return self.image is not None or self.encoded is not None or self.path is not None
+
+    def loadImage(self):
+        # the in-memory image, otherwise a fresh copy from the encoded bytes or the saved file
+        if self.image is not None:
+            return self.image
+
+        source = io.BytesIO(self.encoded) if self.encoded is not None else self.path
+
+        with Image.open(source) as image:
+            image.load()
+            return image.copy()
+
+    def release(self, path: str = None):
+        # keeps only the reference, the bitmap is freed. once the page is saved the file is the only copy
+        if path is not None:
+            self.path = path
+            self.encoded = None
+
+        self.image = None
+
+    def __getstate__(self):
+        # the bitmap never crosses a process or cache boundary, a saved page travels as its path
+        # and an unsaved one as a fast png. upload blobs are encoded again where they are needed,
+        # so checkpoints do not store them with every step
+        encoded = self.encoded if self.path is None else None
+
+        if encoded is None and self.path is None and self.image is not None:
+            buffer = io.BytesIO()
+            self.image.save(buffer, "PNG", compress_level=1)
+            encoded = buffer.getvalue()
+
+        return (self.email, self.attachment, self.page, self.path, encoded, self.text, self.osd, self.image_hash)
+
+    def __setstate__(self, state):
+        # checkpoints written before the upload blobs were left out still have them after osd
+        if len(state) == 9:
+            state = state[:7] + state[8:]
+
+        self.email, self.attachment, self.page, self.path, self.encoded, self.text, self.osd, self.image_hash = state
+        self.image = None
+        self.prepared = {}
+
+class DocumentRecord:
+    # a page the model recognized as a form, with the information it extracted
+    __slots__ = ("page", "type", "info")
+
+    def __init__(self, page: PageRecord, form_type, info: dict = None):
+        self.page = page
+        self.type = form_type
+        self.info = info if info is not None else {}
+
+    def __getstate__(self):
+        return (self.page, self.type, self.info)
+
+    def __setstate__(self, state):
+        self.page, self.type, self.info = state
+
+class MessageRecord:
+    __slots__ = ("index", "subject", "sender", "body", "attachments")
+
+    def __init__(self, index, subject: str = "", sender: str = "", body: str = "", attachments: list = None):
+        self.index = index
+        self.subject = subject
+        self.sender = sender
+        self.body = body
+        self.attachments = attachments if attachments is not None else []
+
+    def __getstate__(self):
+        return (self.index, self.subject, self.sender, self.body, self.attachments)
+
+    def __setstate__(self, state):
+        self.index, self.subject, self.sender, self.body, self.attachments = state
+
+class PartRow:
+    # one normalized part waiting in a sink buffer, turned into a full row only when it is written
+    __slots__ = ("email", "part", "values")
+
+    def __init__(self, email, part: int, values: dict):
+        self.email = email
+        self.part = part
+        self.values = values
+
+    def __getstate__(self):
+        return (self.email, self.part, self.values)
+
+    def __setstate__(self, state):
+        self.email, self.part, self.values = state
@@ -0,0 +1,211 @@
+import os
+import csv
+import io
+import json
+import sqlite3
+from time import monotonic
+from threading import Lock, get_ident
+
+import normalize
+from records import PartRow
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+# every sink writes the same columns, values outside of the required keys go to "extra" as json
+COLUMNS = ["email", "part"] + normalize.REQUIRED_KEYS + ["extra"]
+
+def toRow(data: dict, mail_index, part_index: int):
+    row = {column: None for column in COLUMNS}
+    row["email"] = str(mail_index)
+    row["part"] = part_index
+
+    extra = {}
+
+    for key, value in data.items():
+        # "Part Number" and "part_no" land in the same column, the first one wins and the rest go to extra
+        column = key if key in normalize.REQUIRED_KEYS else normalize.resolveKey(key)
+
+        if column is not None and row[column] is None:
+            row[column] = value if value is None or isinstance(value, str) else json.dumps(value)
+        else:
+            extra[key] = value
+
+    if len(extra) > 0:
+        row["extra"] = json.dumps(extra)
+
+    return row
+
+class ResultSink:
+    # buffers rows and writes them in batches, one sink can be shared by all workers
+    def __init__(self, flush_rows: int = 100, flush_interval: float = 5.0):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self.__rows = []
+        self.__lock = Lock()
+        self.__last_flush = monotonic()
+
+    def write(self, data: dict, mail_index, part_index: int):
+        with self.__lock:
+            # the full row is built when the buffer is written, the buffer only holds compact records
+            self.__rows.append(PartRow(mail_index, part_index, data))
+
+            if len(self.__rows) >= self.flush_rows or monotonic() - self.__last_flush >= self.flush_interval:
+                self.__flushLocked()
+
+    def flush(self):
+        with self.__lock:
+            self.__flushLocked()
+
+    def __flushLocked(self):
+        if len(self.__rows) > 0:
+            self._writeRows([toRow(row.values, row.email, row.part) for row in self.__rows])
+            self.__rows = []
+
+        self.__last_flush = monotonic()
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def _writeRows(self, rows: list):
+        # every sink writes the rows of a flush in one go
+        raise NotImplementedError(f"{type(self).__name__} does not implement _writeRows")
+
+    def _close(self):
+        pass
+
+def appendBlock(path: str, data: bytes):
+    # a single O_APPEND write per flush keeps blocks of different processes from interleaving
+    file_descriptor = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    try:
+        os.write(file_descriptor, data)
+    finally:
+        os.close(file_descriptor)
+
+def createWithBlock(path: str, data: bytes):
+    # the file only shows up with its first block in it, so another process can not append rows before the header.
+    # returns False when the file was already there
+    temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+
+    try:
+        os.link(temp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(temp_path)
+
+class CSVSink(ResultSink):
+    def __init__(self, path: str, flush_rows: int = 100, flush_interval: float = 5.0):
+        super().__init__(flush_rows, flush_interval)
+        self.path = path
+
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        createWithBlock(path, self.__encode([dict(zip(COLUMNS, COLUMNS))]))
+
+    def __encode(self, rows: list):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+        writer.writerows(rows)
+
+        return buffer.getvalue().encode('utf-8')
+
+    def _writeRows(self, rows: list):
+        appendBlock(self.path, self.__encode(rows))
+
+class NDJSONSink(ResultSink):
+    def __init__(self, path: str, flush_rows: int = 100, flush_interval: float = 5.0):
+        super().__init__(flush_rows, flush_interval)
+        self.path = path
+
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def _writeRows(self, rows: list):
+        appendBlock(self.path, "".join(json.dumps(row) + "\n" for row in rows).encode('utf-8'))
+
+class SQLiteSink(ResultSink):
+    def __init__(self, path: str, table: str = "parts", flush_rows: int = 100, flush_interval: float = 5.0):
+        super().__init__(flush_rows, flush_interval)
+        self.table = table
+
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        # the timeout lets several worker processes take turns on the same file
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+
+        columns = ", ".join(f'"{column}" {"INTEGER" if column == "part" else "TEXT"}' for column in COLUMNS)
+
+        with self.__connection:
+            self.__connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})')
+            self.__connection.execute(f'CREATE INDEX IF NOT EXISTS "{table}_part_no" ON "{table}" (part_no)')
+            self.__connection.execute(f'CREATE INDEX IF NOT EXISTS "{table}_vendor_name" ON "{table}" (vendor_name)')
+
+        self.__insert = f'INSERT INTO "{table}" ({", ".join(COLUMNS)}) VALUES ({", ".join("?" for _ in COLUMNS)})'
+
+    def _writeRows(self, rows: list):
+        with self.__connection:
+            self.__connection.executemany(self.__insert, [[row[column] for column in COLUMNS] for row in rows])
+
+    def _close(self):
+        self.__connection.close()
+
+class ParquetSink(ResultSink):
+    # every flush becomes a row group, the file is complete after close()
+    def __init__(self, path: str, flush_rows: int = 1000, flush_interval: float = 30.0):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for parquet output, install it with 'pip install pyarrow'")
+
+        super().__init__(flush_rows, flush_interval)
+
+        folder = os.path.dirname(path)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.__schema = pyarrow.schema([(column, pyarrow.int64() if column == "part" else pyarrow.string()) for column in COLUMNS])
+        self.__writer = parquet.ParquetWriter(path, self.__schema)
+
+    def _writeRows(self, rows: list):
+        self.__writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.__schema))
+
+    def _close(self):
+        self.__writer.close()
+
+def createSink(path: str, **options):
+    # picks the sink from the file extension
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".csv":
+        return CSVSink(path, **options)
+
+    if extension in (".ndjson", ".jsonl"):
+        return NDJSONSink(path, **options)
+
+    if extension in (".db", ".sqlite", ".sqlite3"):
+        return SQLiteSink(path, **options)
+
+    if extension == ".parquet":
+        return ParquetSink(path, **options)
+
+    raise ValueError(f"Unknown output format: {extension}")
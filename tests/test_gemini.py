@@ -0,0 +1,105 @@
+import os
+import sys
+import unittest
+from time import sleep, monotonic
+from threading import Thread
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src"), os.path.join(os.path.dirname(__file__), "..", "bench")]
+
+try:
+    import gemini
+    from fakegemini import FakeModel
+    from google.api_core.exceptions import ResourceExhausted
+except ImportError:
+    gemini = None
+
+@unittest.skipIf(gemini is None, "google-generativeai is not installed")
+class ThrottlingTest(unittest.TestCase):
+    def createClient(self, model, **limits):
+        # a plain dict config keeps the test away from the real generation config
+        return gemini.GeminiClient(model, {"max_output_tokens": 64}, **limits)
+
+    def testRateLimiterKeepsRequestsUnderTheQuota(self):
+        model = FakeModel(latency=0, jitter=0, requests_per_minute=6)
+        client = self.createClient(model, requests_per_minute=6, max_retries=0)
+
+        for _ in range(6):
+            client.generateContent("prompt", system_instructions="Normalize the json data")
+
+        self.assertEqual(model.rejected, 0)
+        self.assertEqual(client.total_requests, 6)
+
+        # the seventh request has to wait for the bucket instead of hitting the quota
+        self.assertGreater(client.rate_limiter.waitTime(100), 0)
+
+    def testQuotaErrorsAreRetriedWithBackoff(self):
+        model = FakeModel(latency=0, jitter=0, requests_per_minute=2)
+        client = self.createClient(model, requests_per_minute=1000, max_retries=3, base_delay=0.01, max_delay=0.02)
+
+        client.generateContent("prompt")
+        client.generateContent("prompt")
+
+        with self.assertRaises(ResourceExhausted):
+            client.generateContent("prompt")
+
+        # the first try and every retry reached the model
+        self.assertEqual(model.rejected, 4)
+        self.assertEqual(client.total_retries, 3)
+
+    def testStreamGivesUpAfterMaxRetries(self):
+        model = FakeModel(latency=0, jitter=0, requests_per_minute=1)
+        client = self.createClient(model, requests_per_minute=1000, max_retries=2, base_delay=0.01, max_delay=0.02)
+
+        self.assertTrue(len("".join(client.generateContentStream("prompt"))) > 0)
+
+        with self.assertRaises(ResourceExhausted):
+            "".join(client.generateContentStream("prompt"))
+
+        self.assertEqual(model.rejected, 3)
+
+    def testSharedClientNeverStallsWorkers(self):
+        model = FakeModel(latency=0, jitter=0, requests_per_minute=3)
+        client = self.createClient(model, requests_per_minute=1000, max_retries=1, base_delay=0.01, max_delay=0.02)
+
+        results = []
+
+        def work():
+            try:
+                results.append(client.generateContent("prompt"))
+            except ResourceExhausted:
+                results.append(None)
+
+        threads = [Thread(target=work) for _ in range(6)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join(timeout=10)
+
+        # every worker finished, with a reply or with the quota error after its retries
+        self.assertEqual(len(results), 6)
+        self.assertEqual(sum(1 for result in results if result is not None), 3)
+
+    def testWaitingRequestsDoNotHoldUpFinishedOnes(self):
+        model = FakeModel(latency=0.2, jitter=0)
+        client = self.createClient(model, requests_per_minute=6, max_retries=0)
+
+        finished = []
+        started = monotonic()
+
+        def work():
+            client.generateContent("prompt")
+            finished.append(monotonic() - started)
+
+        # two of the eight requests wait in the bucket for 10 and 20 seconds, the test does not wait for them
+        for _ in range(8):
+            Thread(target=work, daemon=True).start()
+
+        sleep(1.5)
+
+        self.assertEqual(len(finished), 6)
+        self.assertLess(max(finished), 1.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src")]
+
+import jsonextract
+
+class ExtractJsonTest(unittest.TestCase):
+    def testFencedValue(self):
+        text = 'Here is the data:\n```json\n{"part_no": "ABC-1", "qty": "2"}\n```\nLet me know if you need more.'
+
+        self.assertEqual(jsonextract.extractJson(text), [{"part_no": "ABC-1", "qty": "2"}])
+
+    def testPrettyPrintedValues(self):
+        text = '[\n  {\n    "part_no": "ABC-1",\n    "notes": "see {attached} [quote]"\n  },\n  {\n    "part_no": "ABC-2",\n  }\n]'
+
+        self.assertEqual(jsonextract.extractObjects(text), [{"part_no": "ABC-1", "notes": "see {attached} [quote]"}, {"part_no": "ABC-2"}])
+
+    def testNDJSON(self):
+        text = '{"part_no": "ABC-1"}\n{"part_no": "ABC-2"}\n{"part_no": "ABC-3"}\n'
+
+        self.assertEqual([obj["part_no"] for obj in jsonextract.extractObjects(text)], ["ABC-1", "ABC-2", "ABC-3"])
+
+    def testEscapedQuotes(self):
+        self.assertEqual(jsonextract.extractFirstObject('{"description": "6\\" HOSE }"}'), {"description": '6" HOSE }'})
+
+    def testBracketThatNeverCloses(self):
+        text = 'Sure [here is it:\n{"a": 1}\n{"b": 2}'
+
+        self.assertEqual(jsonextract.extractObjects(text), [{"a": 1}, {"b": 2}])
+
+    def testBracketsThatAreNotJson(self):
+        text = 'Parts [see below] and {not json}: {"a": [1, 2]} (done]'
+
+        self.assertEqual(jsonextract.extractJson(text), [{"a": [1, 2]}])
+
+    def testNothingToExtract(self):
+        self.assertEqual(jsonextract.extractJson("No parts were found."), [])
+        self.assertEqual(jsonextract.extractFirstObject("{", {}), {})
+
+class StreamObjectsTest(unittest.TestCase):
+    def testChunkedInput(self):
+        text = 'Result:\n```json\n[{"part_no": "ABC-1", "price": "1,250.00"}, {"part_no": "ABC-2"}]\n```'
+
+        for size in (1, 3, 7, len(text)):
+            chunks = [text[i:i+size] for i in range(0, len(text), size)]
+
+            self.assertEqual(list(jsonextract.streamObjects(chunks)), [{"part_no": "ABC-1", "price": "1,250.00"}, {"part_no": "ABC-2"}], size)
+
+    def testObjectsArriveBeforeTheEnd(self):
+        received = []
+
+        def chunks():
+            yield '{"part_no": "ABC-1"}\n'
+            received.append("second chunk")
+            yield '{"part_no": "ABC-2"}'
+
+        objects = jsonextract.streamObjects(chunks())
+
+        self.assertEqual(next(objects), {"part_no": "ABC-1"})
+        self.assertEqual(received, [])
+        self.assertEqual(list(objects), [{"part_no": "ABC-2"}])
+
+    def testUnclosedBracketAcrossChunks(self):
+        chunks = ["Sure [here", " is it:\n{\"a\"", ": 1}\n{\"b\": 2}"]
+
+        self.assertEqual(list(jsonextract.streamObjects(chunks)), [{"a": 1}, {"b": 2}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src")]
+
+try:
+    import links
+    import cache
+except ImportError:
+    links = None
+
+PDF = b"%PDF-1.4\n" + b"0" * 2048
+
+class DocumentHandler(BaseHTTPRequestHandler):
+    # every path is one case, the server counts the requests it gets per method and path
+    def log_message(self, *arguments):
+        pass
+
+    def count(self):
+        key = (self.command, self.path)
+        self.server.requests[key] = self.server.requests.get(key, 0) + 1
+        return self.server.requests[key]
+
+    def reply(self, status: int, headers: dict, body: bytes = b""):
+        self.send_response(status)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.count()
+        self.route()
+
+    def do_GET(self):
+        self.count()
+        self.route()
+
+    def route(self):
+        if self.path == "/doc.pdf":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.reply(304, {"ETag": '"v1"'})
+            else:
+                self.reply(200, {"Content-Type": "application/pdf", "Content-Length": str(len(PDF)), "ETag": '"v1"'}, PDF)
+        elif self.path == "/page.html":
+            self.reply(200, {"Content-Type": "text/html", "Content-Length": "5"}, b"<p/>")
+        elif self.path == "/big.pdf":
+            self.reply(200, {"Content-Type": "application/pdf", "Content-Length": str(10 * 1024 ** 2)}, b"")
+        elif self.path == "/stream.pdf":
+            # no length, the body ends when the connection closes
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            if self.command == "GET":
+                for _ in range(64):
+                    self.wfile.write(b"%PDF" + b"1" * 4096)
+        elif self.path == "/slow.pdf":
+            if self.command == "GET":
+                time.sleep(1.5)
+
+            self.reply(200, {"Content-Type": "application/pdf", "Content-Length": str(len(PDF))}, PDF)
+        elif self.path == "/flaky.pdf":
+            if self.command == "GET" and self.server.requests[("GET", self.path)] == 1:
+                self.reply(500, {"Content-Length": "0"})
+            else:
+                self.reply(200, {"Content-Type": "application/pdf", "Content-Length": str(len(PDF))}, PDF)
+        else:
+            self.reply(404, {"Content-Length": "0"})
+
+@unittest.skipIf(links is None, "requests is not installed")
+class LinkFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DocumentHandler)
+        self.server.requests = {}
+        self.server.daemon_threads = True
+
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.fetcher = links.LinkFetcher(max_workers=4, timeout=(1, 0.5), max_bytes=64 * 1024)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        cache.disableCache()
+
+    def testDownloadsAndDedupes(self):
+        results = self.fetcher.fetchAll([self.base + "/doc.pdf", self.base + "/doc.pdf>"])
+
+        self.assertEqual(results, [(self.base + "/doc.pdf", "application/pdf", PDF)])
+        self.assertEqual(self.server.requests[("GET", "/doc.pdf")], 1)
+
+    def testHeadRejectsOtherTypes(self):
+        self.assertEqual(self.fetcher.fetchAll([self.base + "/page.html"]), [])
+        self.assertNotIn(("GET", "/page.html"), self.server.requests)
+
+    def testHeadRejectsLargeDocuments(self):
+        self.assertEqual(self.fetcher.fetchAll([self.base + "/big.pdf"]), [])
+        self.assertNotIn(("GET", "/big.pdf"), self.server.requests)
+
+    def testDownloadStopsAtMaxBytes(self):
+        self.assertIsNone(self.fetcher.submit(self.base + "/stream.pdf").result(timeout=10))
+
+    def testSlowHostTimesOut(self):
+        started = time.monotonic()
+
+        self.assertIsNone(self.fetcher.submit(self.base + "/slow.pdf").result(timeout=10))
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def testFailedDownloadsAreRetried(self):
+        self.assertIsNone(self.fetcher.submit(self.base + "/flaky.pdf").result(timeout=10))
+
+        # the callback that would remember the result runs right after the future is done
+        time.sleep(0.05)
+
+        self.assertEqual(self.fetcher.submit(self.base + "/flaky.pdf").result(timeout=10), ("application/pdf", PDF))
+
+    def testRecentResultsAreBoundedByBytes(self):
+        fetcher = links.LinkFetcher(timeout=(1, 0.5), recent_bytes=0)
+
+        try:
+            fetcher.submit(self.base + "/doc.pdf").result(timeout=10)
+            time.sleep(0.05)
+            fetcher.submit(self.base + "/doc.pdf").result(timeout=10)
+        finally:
+            fetcher.close()
+
+        self.assertEqual(self.server.requests[("GET", "/doc.pdf")], 2)
+
+    def testRevalidatesCachedDocuments(self):
+        cache.enableCache(tempfile.mkdtemp(prefix="links-cache-"))
+        fetcher = links.LinkFetcher(timeout=(1, 0.5), recent_bytes=0)
+
+        try:
+            first = fetcher.submit(self.base + "/doc.pdf").result(timeout=10)
+            time.sleep(0.05)
+            second = fetcher.submit(self.base + "/doc.pdf").result(timeout=10)
+        finally:
+            fetcher.close()
+
+        # the second request was answered with 304 and the content came from the cache
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.requests[("GET", "/doc.pdf")], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src")]
+
+import normalize
+
+class NormalizePriceTest(unittest.TestCase):
+    def testReadsUnambiguousPrices(self):
+        cases = {
+            "12.50": "12.50",
+            "USD 1250": "1250.00",
+            "$1,234.50": "1234.50",
+            "1,234,567": "1234567.00",
+            "1.234,50 EUR": "1234.50",
+            "1.234.567": "1234567.00",
+            "12,50": "12.50",
+            "0.250": "0.25",
+            "1250.000": "1250.00",
+            "100 USD/EA": "100.00"
+        }
+
+        for value, expected in cases.items():
+            self.assertEqual(normalize.normalizePrice(value), expected, value)
+
+    def testLeavesAmbiguousPricesOut(self):
+        for value in ["USD 1 250.00", "1 250", "1.250", "1,250", "1.2.3", "TBD"]:
+            self.assertIsNone(normalize.normalizePrice(value), value)
+
+    def testAmbiguousPricesGoToUnresolved(self):
+        normalized, unresolved = normalize.normalizeInfo({"Part No": "ABC-1", "Unit Price": "1.250"})
+
+        self.assertEqual(normalized, {"part_no": "ABC-1"})
+        self.assertEqual(unresolved, {"Unit Price": "1.250"})
+
+class NormalizeDateTest(unittest.TestCase):
+    def tearDown(self):
+        normalize.setDayFirst(False)
+
+    def testReadsSlashDatesMonthFirst(self):
+        self.assertEqual(normalize.normalizeDate("12/03/2024"), "2024-12-03")
+        self.assertEqual(normalize.normalizeDate("25/03/2024"), "2024-03-25")
+
+    def testDayFirstIsConfigurable(self):
+        normalize.setDayFirst(True)
+
+        self.assertEqual(normalize.normalizeDate("12/03/2024"), "2024-03-12")
+        self.assertEqual(normalize.normalizeDate("03/25/2024"), "2024-03-25")
+
+    def testKeepsUnknownDates(self):
+        self.assertEqual(normalize.normalizeDate("2024-03-12"), "2024-03-12")
+        self.assertEqual(normalize.normalizeDate(" soon "), "soon")
+
+if __name__ == "__main__":
+    unittest.main()
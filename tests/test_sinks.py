@@ -0,0 +1,54 @@
+import os
+import sys
+import csv
+import tempfile
+import unittest
+from multiprocessing import Pool
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src")]
+
+try:
+    import sinks
+except ImportError:
+    sinks = None
+
+def writeRows(arguments):
+    path, worker = arguments
+    sink = sinks.CSVSink(path, flush_rows=1)
+
+    for part_index in range(5):
+        sink.write({"part_no": f"P{worker}-{part_index}"}, worker, part_index)
+
+    sink.close()
+
+@unittest.skipIf(sinks is None, "Pillow is not installed")
+class ToRowTest(unittest.TestCase):
+    def testMapsKeysThroughTheAliases(self):
+        row = sinks.toRow({"Part Number": "ABC-1", "Unit Price (USD)": "12.50", "qty": "3", "color": "red"}, 7, 0)
+
+        self.assertEqual((row["part_no"], row["price"], row["qty"]), ("ABC-1", "12.50", "3"))
+        self.assertEqual(row["extra"], '{"color": "red"}')
+
+    def testKeepsTheRowColumnsAndRepeatedKeys(self):
+        row = sinks.toRow({"part_no": "ABC-1", "P/N": "ABC-2", "email": "sales@example.com"}, 7, 2)
+
+        self.assertEqual((row["email"], row["part"], row["part_no"]), ("7", 2, "ABC-1"))
+        self.assertEqual(row["extra"], '{"P/N": "ABC-2", "email": "sales@example.com"}')
+
+@unittest.skipIf(sinks is None, "Pillow is not installed")
+class CSVSinkTest(unittest.TestCase):
+    def testOneHeaderForManyProcesses(self):
+        path = os.path.join(tempfile.mkdtemp(prefix="sinks-"), "parts.csv")
+
+        with Pool(4) as pool:
+            pool.map(writeRows, [(path, worker) for worker in range(8)])
+
+        with open(path, newline='', encoding='utf-8') as file:
+            rows = list(csv.reader(file))
+
+        self.assertEqual(rows[0], sinks.COLUMNS)
+        self.assertEqual(sum(1 for row in rows if row == sinks.COLUMNS), 1)
+        self.assertEqual(len(rows), 41)
+
+if __name__ == "__main__":
+    unittest.main()